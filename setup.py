@@ -33,4 +33,8 @@ setup(name='python-usps2',
           'lxml',
           'xmltodict'
       ],
+      extras_require={
+          'numpy': ['numpy'],
+          'arrow': ['pyarrow'],
+      },
       )
@@ -1,14 +1,37 @@
+import http.client
+import io
+import json
 import os
 import unittest
 import random
+import signal
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError
+from urllib.parse import parse_qs
+from unittest import mock
 from datetime import datetime, timedelta
 from xml.dom import minidom
 from xml.etree import ElementTree
+from xml.parsers.expat import ExpatError
 
 import xmltodict
+from lxml import etree
 
-from constants import CARRIER_PICKUP_SCHEDULE_REQUEST_SERVICE_TYPE
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from constants import CARRIER_PICKUP_SCHEDULE_REQUEST_SERVICE_TYPE, CONTAINER, FIRST_CLASS_MAIL_TYPE
 from usps.addressinformation import *
+from usps.addressinformation import fake
+from usps.addressinformation.base import CarrierPickupInquiry
+from usps.addressinformation.normalize import normalize_line
+from usps import gateway, loadtest, profile, warmup
+from usps.workload import WorkloadGenerator
 
 USERID = os.environ.get('USERID')  # A user id must be defined in the environment variables to run the test
 USPS_CONNECTION_TEST = 'https://secure.shippingapis.com/ShippingAPITest.dll'
@@ -314,5 +337,1312 @@ class TestAddressInformationAPI(unittest.TestCase):
         response_xml = service_delivery.submit_xml(xml)
 
 
+class TestNegativeCache(unittest.TestCase):
+
+    def test_rejected_address_is_not_resubmitted(self):
+        address = Address(user_id='TEST', negative_cache=NegativeCache())
+        not_found = USPSXMLError({'Number': '-2147219401', 'Description': 'Address Not Found.'})
+        with mock.patch.object(address, 'execute', side_effect=not_found) as execute:
+            for _ in range(3):
+                with self.assertRaises(USPSXMLError) as context:
+                    address.validate(address2='1 Nowhere Ln', city='Nowhere', state='CO')
+        self.assertEqual(execute.call_count, 1)
+        self.assertEqual(context.exception.info['Description'], 'Address Not Found.')
+
+    def test_validate_many_skips_rejected_addresses(self):
+        transport = FakeTransport()
+        address = Address(user_id='TEST', transport=transport, negative_cache=NegativeCache())
+        addresses = [{'Address2': '500 E 3rd St', 'City': 'Loveland', 'State': 'CO'},
+                     {'Address2': '', 'City': 'Nowhere', 'State': 'CO'}]
+        first = address.validate_many(addresses, partial=True)
+        self.assertIsInstance(first[1], USPSXMLError)
+        again = address.validate_many(addresses, partial=True)
+        self.assertEqual(transport.requests, 2)
+        self.assertEqual(again[1].info, first[1].info)
+        self.assertEqual(again[0]['City'], 'LOVELAND')
+        with self.assertRaises(USPSXMLError):
+            address.validate_many(addresses[1:])
+        self.assertEqual(transport.requests, 2)
+
+    def test_authorization_errors_are_not_cached(self):
+        address = Address(user_id='TEST', negative_cache=NegativeCache())
+        denied = USPSXMLError({'Number': '80040B1A', 'Description': 'Authorization failure.'})
+        with mock.patch.object(address, 'execute', side_effect=denied) as execute:
+            for _ in range(2):
+                with self.assertRaises(USPSXMLError):
+                    address.validate(address2='500 E 3rd St', city='Loveland', state='CO')
+        self.assertEqual(execute.call_count, 2)
+
+    def test_bloom_filter_round_trip(self):
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        for number in range(1000):
+            bloom.add('%d MAIN ST' % number)
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'rejected.bloom')
+        bloom.save(path)
+        self.addCleanup(os.remove, path)
+        loaded = BloomFilter.load(path)
+        self.assertEqual((loaded.num_bits, loaded.num_hashes), (bloom.num_bits, bloom.num_hashes))
+        self.assertTrue(all('%d MAIN ST' % number in loaded for number in range(1000)))
+        false_positives = sum('%d ELM ST' % number in loaded for number in range(1000))
+        self.assertLess(false_positives, 50)
+
+        # A loaded filter refuses on its own, unless bloom hits must be confirmed
+        self.assertEqual(NegativeCache(bloom=loaded).get('7 MAIN ST'), NegativeCache.BLOOM_ERROR)
+        self.assertIsNone(NegativeCache(bloom=loaded, trust_bloom=False).get('7 MAIN ST'))
+
+        with open(path, 'wb') as output:
+            output.write(BloomFilter.HEADER.pack(BloomFilter.MAGIC, 10 ** 6, 7, 0) + b'\0' * 10)
+        with self.assertRaises(ValueError):
+            BloomFilter.load(path)
+
+    def test_bloom_tier_expires_and_rotates(self):
+        now = [0.0]
+        cache = NegativeCache(ttl=100, bloom=BloomFilter(capacity=10), clock=lambda: now[0])
+        now[0] = 80
+        cache.add('1 NOWHERE LN', {'Description': 'Address Not Found.'})
+        self.assertEqual(cache.get('1 NOWHERE LN')['Description'], 'Address Not Found.')
+        self.assertIsNone(cache.get('2 NOWHERE LN'))
+        now[0] = 150
+        self.assertIsNotNone(cache.get('1 NOWHERE LN'))
+        self.assertIn('1 NOWHERE LN', cache.previous)
+        now[0] = 250
+        self.assertIsNone(cache.get('1 NOWHERE LN'))
+
+        for number in range(11):
+            cache.add('%d ELM ST' % number, {'Description': 'Address Not Found.'})
+        self.assertFalse(cache.bloom.saturated)
+        self.assertLessEqual(len(cache.bloom), 10)
+
+
+class TestTransports(unittest.TestCase):
+
+    def test_fake_transport_round_trip(self):
+        transport = FakeTransport()
+        address = Address(user_id='TEST', transport=transport)
+        response = address.validate(address2='500 E. third st', city='Loveland', state='CO', zip_5='80537')
+        self.assertEqual(response['Address2'], '500 E THIRD ST')
+        self.assertEqual(response['FullZip'], '80537-%s' % response['Zip4'])
+        self.assertEqual(transport.requests, 1)
+
+    def test_fake_transport_raises_usps_errors(self):
+        address = Address(user_id='TEST', transport=FakeTransport())
+        with self.assertRaises(USPSXMLError):
+            address.validate(city='Loveland', state='CO')
+
+    def test_pooled_transport_reuses_connections(self):
+        connections = set()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                connections.add(self.client_address)
+                form = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode('utf8'))
+                body = fake.respond(form['API'][0], form['XML'][0].encode('utf8'))
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        transport = PooledTransport()
+        try:
+            url = 'http://127.0.0.1:%d/ShippingAPI.dll' % server.server_address[1]
+            rate = DomesticRate(user_id='TEST', url=url, transport=transport)
+            for _ in range(3):
+                root = rate.submit_xml(rate.make_xml([{'Service': 'PRIORITY', 'ZipOrigination': 44106,
+                                                        'ZipDestination': 20770, 'Pounds': 1, 'Ounces': 8}]))
+                self.assertEqual(root.tag, 'RateV4Response')
+        finally:
+            transport.close()
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(len(connections), 1)
+
+    def test_pooled_transport_resends_only_idempotent_requests(self):
+        received = list()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                received.append(self.rfile.read(int(self.headers['Content-Length'])))
+                if len(received) in (2, 5):
+                    # Read the request, then drop the connection without answering
+                    self.close_connection = True
+                    return
+                self.send_response(200)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'ok')
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        transport = PooledTransport()
+        self.addCleanup(transport.close)
+        url = 'http://127.0.0.1:%d/ShippingAPI.dll' % server.server_address[1]
+        self.assertEqual(transport.send(url, b'API=Verify').read(), b'ok')
+        self.assertEqual(transport.send(url, b'API=Verify').read(), b'ok')
+        self.assertEqual(len(received), 3)
+
+        self.assertEqual(transport.send(url, b'API=CarrierPickupSchedule', idempotent=False).read(), b'ok')
+        with self.assertRaises(http.client.RemoteDisconnected):
+            transport.send(url, b'API=CarrierPickupSchedule', idempotent=False)
+        self.assertEqual(len(received), 5)
+
+
+class TestCarrierPickupAvailabilityBatch(unittest.TestCase):
+
+    def test_check_many_caches_and_collects_errors(self):
+        transport = FakeTransport()
+        avail = CarrierPickupAvailability(user_id='TEST', transport=transport)
+        locations = [{'Address2': '760 Charcot Ave', 'City': 'San Jose', 'State': 'CA', 'ZIP5': '95131'},
+                     {'Address2': '760  CHARCOT AVE', 'City': 'San Jose', 'State': 'CA', 'ZIP5': '95131'},
+                     {'Address2': '500 E 3rd St', 'City': 'Loveland', 'State': 'CO', 'ZIP5': '80537'},
+                     {'Address2': '1 Bad Rd', 'City': 'Nowhere', 'State': 'CO', 'ZIP5': '00000'}]
+        check = avail.check
+
+        def failing_check(location):
+            if location['ZIP5'] == '00000':
+                raise USPSXMLError({'Number': '-2147219401', 'Description': 'Invalid address.'})
+            return check(location)
+
+        with mock.patch.object(avail, 'check', side_effect=failing_check):
+            merged = avail.check_many(locations, max_workers=2)
+        self.assertEqual(transport.requests, 2)
+        self.assertEqual(list(merged['errors']), [3])
+        self.assertEqual(merged['results'][0], merged['results'][1])
+        self.assertEqual(merged['results'][2]['ZIP5'], '80537')
+        self.assertIsNone(merged['results'][3])
+
+        avail.check_many(locations[:3])
+        self.assertEqual(transport.requests, 2)
+
+    def test_check_many_errors_and_copies(self):
+        avail = CarrierPickupAvailability(user_id='TEST', transport=FakeTransport())
+        good = {'Address2': '760 Charcot Ave', 'City': 'San Jose', 'State': 'CA', 'ZIP5': '95131'}
+        bad = {'Address2': '1 Bad Rd', 'City': 'Nowhere', 'State': 'CO', 'ZIP5': '00000'}
+        check = avail.check
+
+        def garbled_check(location):
+            if location['ZIP5'] == '00000':
+                raise ExpatError('not well-formed')
+            return check(location)
+
+        with mock.patch.object(avail, 'check', side_effect=garbled_check):
+            merged = avail.check_many([good, bad])
+            self.assertIsInstance(merged['errors'][1], ExpatError)
+            with self.assertRaises(ExpatError):
+                avail.check_many([good, bad], partial=False)
+
+        merged['results'][0]['ZIP5'] = 'CHANGED'
+        self.assertEqual(avail.check_many([good])['results'][0]['ZIP5'], '95131')
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class TestRateTable(unittest.TestCase):
+
+    def make_table(self, directory):
+        from usps.addressinformation.rates import RateTable
+        path = os.path.join(directory, 'priority.csv')
+        with open(path, 'w') as output:
+            output.write('Service,Container,Weight,Zone,Price\n')
+            for pounds in range(1, 6):
+                for zone in range(1, 9):
+                    output.write('PRIORITY,,%d,%d,%s\n' % (pounds, zone, fake.fake_postage(zone, pounds, 0)))
+        return RateTable.from_csv(path)
+
+    def test_vectorized_postage(self):
+        with tempfile.TemporaryDirectory() as directory:
+            table = self.make_table(directory)
+            table.save(os.path.join(directory, 'rates.npz'))
+            table = table.load(os.path.join(directory, 'rates.npz'))
+        postage = table.postage({'Service': ['PRIORITY', 'priority', 'PRIORITY', 'EXPRESS'],
+                                 'Container': ['VARIABLE', '', 'VARIABLE', ''],
+                                 'Pounds': [1, 2, 9, 1],
+                                 'Ounces': [0, 4, 0, 0],
+                                 'Zone': [1, 8, 1, 1]})
+        self.assertAlmostEqual(postage[0], float(fake.fake_postage(1, 1, 0)))
+        self.assertAlmostEqual(postage[1], float(fake.fake_postage(8, 3, 0)))
+        self.assertTrue(numpy.isnan(postage[2]) and numpy.isnan(postage[3]))
+
+        arrays = table.postage({'Service': numpy.array(['PRIORITY', 'PRIORITY']),
+                                'Pounds': numpy.array([1.0, numpy.nan]),
+                                'Ounces': numpy.array([8, 0]),
+                                'Zone': numpy.array([2, 2])})
+        self.assertAlmostEqual(arrays[0], float(fake.fake_postage(2, 2, 0)))
+        self.assertAlmostEqual(arrays[1], float(fake.fake_postage(2, 1, 0)))
+
+    def test_cross_check_against_live_api(self):
+        with tempfile.TemporaryDirectory() as directory:
+            table = self.make_table(directory)
+        packages = [{'Service': 'PRIORITY', 'ZipOrigination': '44106', 'ZipDestination': '%05d' % (20770 + i * 1000),
+                     'Pounds': 1 + i % 5, 'Ounces': 0, 'Container': 'VARIABLE'} for i in range(40)]
+        zones = lambda origins, destinations: [fake.fake_zone(o, d) for o, d in zip(origins, destinations)]
+        rate = DomesticRate(user_id='TEST', transport=FakeTransport())
+        report = table.cross_check(rate, packages, sample=30, zones=zones, seed=1)
+        self.assertEqual(report['checked'], 30)
+        self.assertEqual(report['mismatches'], [])
+        self.assertLess(report['max_drift'], 0.001)
+
+        def shuffled(api, xml):
+            # Packages answered in reverse order and one rejected
+            root = etree.fromstring(fake.respond(api, xml))
+            packages = list(root)
+            for package in packages:
+                root.remove(package)
+            for package in reversed(packages):
+                if package.findtext('Pounds') == '3':
+                    package = etree.fromstring('<Package ID="%s"><Error><Number>-2147219500</Number>'
+                                               '<Description>Invalid weight.</Description></Error></Package>'
+                                               % package.get('ID'))
+                root.append(package)
+            return etree.tostring(root)
+
+        rate = DomesticRate(user_id='TEST', transport=FakeTransport(shuffled))
+        report = table.cross_check(rate, packages, sample=40, zones=zones, seed=1)
+        self.assertEqual(sorted(error['index'] for error in report['errors']), list(range(2, 40, 5)))
+        self.assertEqual(report['mismatches'], [])
+
+
+class TestZoneMatrix(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(lambda: [os.remove(os.path.join(directory, name)) for name in os.listdir(directory)])
+        chart = os.path.join(directory, 'zone_charts.csv')
+        with open(chart, 'w') as output:
+            output.write('Origin,DestinationStart,DestinationEnd,Zone\n805,005,098,7\n805,800,816,1\n441,200,212,4\n')
+        self.zone_matrix = ZoneMatrix.build(chart, os.path.join(directory, 'zones.bin'))
+        self.addCleanup(self.zone_matrix.close)
+
+    def test_zone_lookup(self):
+        self.assertEqual(self.zone_matrix.zone(80537, '02108'), 7)
+        self.assertEqual(self.zone_matrix.zone('80537-5773', 80210), 1)
+        self.assertEqual(self.zone_matrix.zone('44106', '99501'), 0)
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_batch_zone_lookup(self):
+        zones = self.zone_matrix.zones([80537, 80537, 44106], ['02108', '80210', '20770'])
+        self.assertEqual(zones.tolist(), [7, 1, 4])
+        zones = self.zone_matrix.zones(numpy.array([80537, 44106]), numpy.array([2108, 20770]))
+        self.assertEqual(zones.tolist(), [7, 4])
+
+    def test_rate_cache_key_uses_zone(self):
+        rate = DomesticRate(user_id='TEST', zone_matrix=self.zone_matrix)
+        package = {'Service': 'PRIORITY', 'ZipOrigination': '44106', 'ZipDestination': '20770', 'Pounds': 1}
+        self.assertEqual(rate.cache_key(package), rate.cache_key(dict(package, ZipDestination='21201')))
+        self.assertNotEqual(rate.cache_key(package), rate.cache_key(dict(package, ZipDestination='99501')))
+
+    def test_zone_cached_rates_echo_the_request_zips(self):
+        rate = DomesticRate(user_id='TEST', transport=FakeTransport(), zone_matrix=self.zone_matrix, cache=TTLCache())
+        package = {'Service': 'PRIORITY', 'ZipOrigination': '44106', 'ZipDestination': '20770', 'Pounds': 1,
+                   'Ounces': 0, 'Container': 'VARIABLE'}
+        first, second = rate.execute_cached([package, dict(package, ZipDestination='21201')])
+        self.assertEqual(rate.transport.requests, 1)
+        self.assertEqual((first['ZipDestination'], second['ZipDestination']), ('20770', '21201'))
+        self.assertEqual(first['Postage'], second['Postage'])
+
+        self.assertIsNone(rate.cache_key({'Service': 'PRIORITY', 'Pounds': 1}))
+        rate.execute_cached([dict(package, ZipDestination='')] * 2)
+        self.assertEqual(rate.transport.requests, 2)
+        self.assertEqual(len(rate.cache), 1)
+
+    def test_delivery_standards_are_keyed_by_zip(self):
+        sdc = ServiceDelivery(user_id='TEST')
+        request = {'MailClass': '1', 'OriginZIP': '44106', 'DestinationZIP': '20770'}
+        self.assertNotEqual(sdc.cache_key(request), sdc.cache_key(dict(request, DestinationZIP='21201')))
+
+
+class TestNormalize(unittest.TestCase):
+
+    def test_spellings_share_a_key(self):
+        spellings = ['500 E. third st', '500 East 3rd Street', '500 E 3RD ST']
+        keys = set(canonical_key({'Address2': spelling, 'City': 'Loveland ', 'State': 'co'}) for spelling in spellings)
+        self.assertEqual(len(keys), 1)
+
+    def test_publication_28_abbreviations(self):
+        normalized = normalize_many([{'Address2': '123 North Main Street Apartment #4', 'Zip5': '80537-5773'},
+                                     {'Address1': 'Suite 200', 'Address2': '12 Park Avenue South'},
+                                     {'Address2': '100 Front St'},
+                                     {'Address2': '500 East St'}])
+        self.assertEqual((normalized[0]['Address1'], normalized[0]['Address2']), ('APT 4', '123 N MAIN ST'))
+        self.assertEqual((normalized[0]['Zip5'], normalized[0]['Zip4']), ('80537', '5773'))
+        self.assertEqual((normalized[1]['Address1'], normalized[1]['Address2']), ('STE 200', '12 PARK AVE S'))
+        self.assertEqual(normalized[2]['Address2'], '100 FRONT ST')
+        self.assertEqual(normalized[3]['Address2'], '500 EAST ST')
+
+    def test_street_names_that_look_like_units(self):
+        self.assertEqual(normalize_line('500 Lower Main St'), '500 LOWER MAIN ST')
+        self.assertEqual(normalize_line('123 Rear Admiral Way'), '123 REAR ADMIRAL WAY')
+        self.assertEqual(normalize_line('500 Twenty First St'), '500 21ST ST')
+        normalized = normalize_many([{'Address2': '500 Main St Rear'}, {'Address2': '12 Park Ave Apt B'},
+                                     {'Address2': '500 Upper Lake Rd Fl 3'}])
+        self.assertEqual([(address['Address2'], address['Address1']) for address in normalized],
+                         [('500 MAIN ST', 'REAR'), ('12 PARK AVE', 'APT B'), ('500 UPPER LAKE RD', 'FL 3')])
+
+    def test_normalize_before_make_xml(self):
+        address = Address(user_id='TEST', transport=FakeTransport(), normalize=True)
+        with mock.patch.object(address, 'make_xml', wraps=address.make_xml) as make_xml:
+            address.validate(address2='500 East Third Street', city='Loveland', state='CO')
+        self.assertEqual(make_xml.call_args[0][1][0]['Address2'], '500 E 3RD ST')
+
+
+class TestAdaptiveBatcher(unittest.TestCase):
+
+    def test_batch_size_converges_on_latency_target(self):
+        now = [0.0]
+        transport = FakeTransport()
+        track = Track(user_id='TEST', transport=transport)
+        execute_batch = track.execute_batch
+
+        def slow_execute_batch(tracker_ids):
+            now[0] += 0.05 + 0.02 * len(tracker_ids)
+            return execute_batch(tracker_ids)
+
+        batcher = AdaptiveBatcher(track, latency_target=0.2, clock=lambda: now[0])
+        with mock.patch.object(track, 'execute_batch', side_effect=slow_execute_batch):
+            results = batcher.run(['94055368978463338933%02d' % i for i in range(200)])
+        self.assertEqual(len(results), 200)
+        decisions = batcher.decisions()
+        self.assertEqual(decisions['api'], 'TrackV2')
+        self.assertEqual(decisions['batch_size'], 7)
+        self.assertAlmostEqual(decisions['per_item_latency'], 0.02)
+
+    def test_respects_service_maximum_and_failures(self):
+        address = Address(user_id='TEST', transport=FakeTransport())
+        batcher = AdaptiveBatcher(address, latency_target=60, max_size=50)
+        self.assertEqual(batcher.max_size, Address.MAX_BATCH_SIZE)
+        batcher.run([{'Address2': '500 E 3rd St', 'City': 'Loveland', 'State': 'CO'}] * 20)
+        self.assertEqual(batcher.batch_size, Address.MAX_BATCH_SIZE)
+        with self.assertRaises(USPSXMLError):
+            batcher.run([{'City': 'Nowhere'}])
+        self.assertEqual(batcher.decisions()['failures'], 1)
+        self.assertLess(batcher.batch_size, Address.MAX_BATCH_SIZE)
+
+
+class TestDeadlines(unittest.TestCase):
+
+    def test_budget_is_shared_across_batches(self):
+        def slow_respond(api, xml):
+            time.sleep(0.03)
+            return fake.respond(api, xml)
+
+        transport = FakeTransport(slow_respond)
+        track = Track(user_id='TEST', transport=transport)
+        batcher = AdaptiveBatcher(track, initial_size=1, max_size=1)
+        with self.assertRaises(USPSDeadlineExceeded):
+            with Deadline(0.1):
+                batcher.run(['9405536897846333893331'] * 10)
+        self.assertLess(transport.requests, 5)
+
+    def test_timeouts_are_capped_by_the_deadline(self):
+        transport = FakeTransport()
+        address = Address(user_id='TEST', transport=transport, timeout=(3.05, 10))
+        with mock.patch.object(transport, 'send', wraps=transport.send) as send:
+            address.validate(address2='500 E 3rd St', city='Loveland', state='CO')
+            self.assertEqual(send.call_args[0][2], (3.05, 10))
+            with Deadline(0.5):
+                address.validate(address2='500 E 3rd St', city='Loveland', state='CO')
+            connect_timeout, read_timeout = send.call_args[0][2]
+        self.assertLessEqual(connect_timeout, 0.5)
+        self.assertLessEqual(read_timeout, 0.5)
+
+    def test_nested_deadline_cannot_extend_outer(self):
+        with Deadline(0.2) as outer:
+            with Deadline(10) as inner:
+                self.assertEqual(inner.expires, outer.expires)
+
+    def test_budget_starts_when_the_block_is_entered(self):
+        now = [0.0]
+        deadline = Deadline(1, clock=lambda: now[0])
+        now[0] = 5
+        with deadline:
+            self.assertEqual(deadline.remaining(), 1)
+            now[0] = 5.5
+        now[0] = 10
+        with deadline:
+            self.assertFalse(deadline.expired)
+            with deadline:
+                self.assertEqual(deadline.expires, 11)
+
+
+class TestHedging(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def respond_slowly_once(self, api, xml):
+        with self.lock:
+            self.calls += 1
+            first = self.calls == 1
+        if first:
+            time.sleep(0.5)
+        return fake.respond(api, xml)
+
+    def test_slow_request_is_hedged(self):
+        hedge = HedgePolicy(max_delay=0.02)
+        self.addCleanup(hedge.close)
+        address = Address(user_id='TEST', transport=FakeTransport(self.respond_slowly_once), hedge=hedge)
+        started = time.monotonic()
+        response = address.validate(address2='500 E 3rd St', city='Loveland', state='CO')
+        self.assertLess(time.monotonic() - started, 0.4)
+        self.assertEqual(response['City'], 'LOVELAND')
+        self.assertEqual(hedge.stats()['backup_wins'], 1)
+
+    def test_attempts_have_finite_timeouts_and_losers_are_bounded(self):
+        hedge = HedgePolicy(max_delay=0.01, timeout=5, max_losers=1)
+        self.addCleanup(hedge.close)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        timeouts = list()
+
+        def send(timeout):
+            with self.lock:
+                timeouts.append(timeout)
+                first = len(timeouts) == 1
+            if first:
+                release.wait(5)
+            return io.BytesIO(b'<Response/>')
+
+        with Deadline(2):
+            self.assertEqual(hedge.run(send).read(), b'<Response/>')
+        self.assertEqual(len(timeouts), 2)
+        self.assertTrue(all(0 < timeout <= 2 for timeout in timeouts))
+        self.assertEqual(hedge.stats()['losers'], 1)
+
+        # The hung primary still holds a worker, the next call is sent directly
+        hedge.run(send)
+        self.assertEqual(timeouts[-1], 5)
+        self.assertEqual(hedge.stats()['unhedged'], 1)
+        release.set()
+        for _ in range(500):
+            if not hedge.stats()['losers']:
+                break
+            time.sleep(0.01)
+        self.assertEqual(hedge.stats()['losers'], 0)
+
+    def test_mutating_calls_are_never_hedged(self):
+        hedge = HedgePolicy(max_delay=0.01)
+        self.addCleanup(hedge.close)
+        transport = FakeTransport(self.respond_slowly_once)
+        cancel = CarrierPickupCancel(user_id='TEST', transport=transport, hedge=hedge)
+        cancel.submit_xml(cancel.make_xml({'Address2': '760 Charcot Ave', 'ConfirmationNumber': 'WTC123'}))
+        self.assertEqual(transport.requests, 1)
+        self.assertEqual(hedge.stats()['requests'], 0)
+
+
+class TestProfiler(unittest.TestCase):
+
+    def test_phases_are_reported_per_service(self):
+        profiler = profile.PhaseProfiler(memory=False)
+        service_class, items = profile.SAMPLES['address']
+        profile.run(service_class('TEST', transport=FakeTransport()), items, 12, 25, profiler)
+        phases = dict((row['phase'], row) for row in profiler.report() if row['service'] == 'Address')
+        self.assertEqual(list(phases), ['make_xml', 'network', 'lxml_parse', 'parse_xml', 'format_response'])
+        self.assertEqual(phases['make_xml']['calls'], 3)
+        self.assertAlmostEqual(sum(row['share'] for row in phases.values()), 1.0)
+
+
+class TestCredentialPool(unittest.TestCase):
+
+    def test_weighted_fair_scheduling_and_rate_limits(self):
+        now = [0.0]
+
+        def sleep(seconds):
+            now[0] += seconds
+
+        pool = CredentialPool(clock=lambda: now[0], sleep=sleep)
+        pool.add('ONE', weight=1, rate=10)
+        pool.add('TWO', weight=3, rate=10)
+        picks = [pool.acquire() for _ in range(8)]
+        self.assertEqual(picks.count('TWO'), 6)
+        self.assertEqual(now[0], 0.0)
+
+        for _ in range(20):
+            pool.acquire()
+        self.assertAlmostEqual(now[0], 0.4)  # 20 burst tokens, the other 8 at 20 per second
+        metrics = pool.metrics()
+        self.assertEqual(metrics['ONE']['requests'] + metrics['TWO']['requests'], 28)
+
+    def test_refused_key_is_cooled_down_and_request_retried(self):
+        seen = list()
+
+        def respond(api, xml):
+            user_id = etree.fromstring(xml).get('USERID')
+            seen.append(user_id)
+            return fake.respond(api, xml.replace(b'USERID="REVOKED"', b'USERID=""'))
+
+        pool = CredentialPool(['REVOKED', 'GOOD'], cooldown=300)
+        address = Address(user_id='IGNORED', transport=FakeTransport(respond), credentials=pool)
+        for _ in range(3):
+            address.validate(address2='500 E 3rd St', city='Loveland', state='CO')
+        self.assertEqual(seen, ['REVOKED', 'GOOD', 'GOOD', 'GOOD'])
+        metrics = pool.metrics()
+        self.assertTrue(metrics['REVOKED']['cooling_down'])
+        self.assertEqual(metrics['REVOKED']['cooldowns'], 1)
+        self.assertEqual(metrics['GOOD']['requests'], 3)
+
+
+class TestPriorityScheduler(unittest.TestCase):
+
+    def test_interactive_goes_ahead_of_queued_batch_work(self):
+        scheduler = PriorityScheduler(capacity=1, classes=[('interactive', {}), ('batch', {})])
+        order = list()
+        self.assertTrue(scheduler.acquire('batch'))
+
+        def request(name):
+            with scheduler.slot(name):
+                order.append(name)
+
+        threads = [threading.Thread(target=request, args=('batch',))]
+        threads[0].start()
+        while not scheduler.metrics()['batch']['queue_depth']:
+            time.sleep(0.001)
+        threads.append(threading.Thread(target=request, args=('interactive',)))
+        threads[1].start()
+        while not scheduler.metrics()['interactive']['queue_depth']:
+            time.sleep(0.001)
+        scheduler.release('batch')
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, ['interactive', 'batch'])
+        self.assertEqual(scheduler.metrics()['batch']['completed'], 2)
+
+    def test_reserved_capacity_and_back_pressure(self):
+        scheduler = PriorityScheduler(capacity=2, classes=[('interactive', {'reserved': 1}),
+                                                           ('batch', {'max_queue': 0, 'block': False})])
+        self.assertTrue(scheduler.acquire('batch'))
+        self.addCleanup(scheduler.release, 'batch')
+        # The reserved slot still admits one interactive request, the next one finds capacity full
+        self.assertTrue(scheduler.acquire('interactive', timeout=0))
+        self.addCleanup(scheduler.release, 'interactive')
+        self.assertFalse(scheduler.acquire('interactive', timeout=0))
+        with self.assertRaises(USPSSchedulerFull):
+            scheduler.acquire('batch')
+        self.assertEqual(scheduler.metrics()['batch']['rejected'], 1)
+        self.assertEqual(scheduler.metrics()['interactive']['in_flight'], 1)
+
+    def test_services_wait_on_their_class(self):
+        scheduler = PriorityScheduler(capacity=4)
+        address = Address(user_id='TEST', transport=FakeTransport(), scheduler=scheduler, priority='batch')
+        address.validate(address2='500 E 3rd St', city='Loveland', state='CO')
+        self.assertEqual(scheduler.metrics()['batch']['completed'], 1)
+        self.assertEqual(scheduler.metrics()['interactive']['completed'], 0)
+
+
+class TestCacheSnapshots(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cache.snap')
+
+    def test_snapshot_round_trip(self):
+        cache = TTLCache(ttl=60)
+        for number in range(500):
+            cache.set('key%d' % number, {'Zip5': '%05d' % number})
+        cache.set('short', 'value', ttl=-1)
+        self.assertEqual(cache.snapshot(self.path), 500)
+
+        restored = TTLCache(ttl=60)
+        self.assertEqual(restored.restore(self.path), 500)
+        self.assertEqual(len(restored), 0)
+        self.assertEqual(restored.get('key42'), {'Zip5': '00042'})
+        self.assertEqual(len(restored), 1)
+        self.assertIsNone(restored.get('short'))
+        self.assertIsNone(restored.get('missing'))
+        restored.delete('key7')
+        self.assertIsNone(restored.get('key7'))
+        self.assertEqual(len(restored.items()), 499)
+        restored.clear()
+
+    def test_newer_writes_are_not_shadowed_by_the_snapshot(self):
+        CacheSnapshot.write(self.path, [('key%d' % number, 'old', time.time() + 60) for number in range(3)])
+        cache = TTLCache(maxsize=1)
+        cache.restore(self.path)
+        cache.set('key0', 'new')
+        cache.set('key1', 'new')
+        # key0 was evicted, the snapshot must not bring the older value back
+        self.assertIsNone(cache.get('key0'))
+        self.assertEqual(cache.get('key1'), 'new')
+        self.assertEqual(cache.get('key2'), 'old')
+        self.assertEqual(sorted(value for _, value, _ in cache.items()), ['old'])
+
+    def test_expired_snapshot_entries_are_ignored(self):
+        CacheSnapshot.write(self.path, [('old', 1, time.time() - 1), ('new', 2, time.time() + 60)])
+        cache = TTLCache()
+        cache.restore(self.path)
+        self.assertIsNone(cache.get('old'))
+        self.assertEqual(cache.get('new'), 2)
+
+    def test_services_read_the_restored_cache(self):
+        address = Address(user_id='TEST', transport=FakeTransport(), cache=TTLCache())
+        rate = DomesticRate(user_id='TEST', transport=FakeTransport(), cache=TTLCache())
+        validated = address.validate(address2='500 E 3rd St', city='Loveland', state='CO', title_case=True)
+        package = {'Service': 'PRIORITY', 'ZipOrigination': '44106', 'ZipDestination': '20770', 'Pounds': 1,
+                   'Ounces': 8, 'Container': 'VARIABLE', 'Machinable': True}
+        postage = rate.execute_cached([package, package])
+        self.assertEqual(rate.transport.requests, 1)
+        address.cache.snapshot(self.path)
+        rate.cache.snapshot(self.path + '.rate')
+
+        address = Address(user_id='TEST', transport=FakeTransport(), cache=TTLCache())
+        address.cache.restore(self.path)
+        self.assertEqual(address.validate(address2='500 E. Third Street', city='Loveland', state='CO',
+                                          title_case=True), validated)
+        rate = DomesticRate(user_id='TEST', transport=FakeTransport(), cache=TTLCache())
+        rate.cache.restore(self.path + '.rate')
+        self.assertEqual(rate.execute_cached([package]), postage[:1])
+        self.assertEqual(address.transport.requests + rate.transport.requests, 0)
+
+    def test_warmup_command(self):
+        source = os.path.join(self.directory, 'history.jsonl')
+        with open(source, 'w') as target:
+            for address2 in ('500 E 3rd St', '', '1 Infinite Loop', '500 E 3rd St'):
+                target.write(json.dumps({'Address2': address2, 'City': 'Loveland', 'State': 'CO'}) + '\n')
+        with mock.patch('usps.warmup.PooledTransport', FakeTransport), mock.patch('sys.stdout'):
+            self.assertEqual(warmup.main(['--service', 'address', '--input', source, '--snapshot', self.path,
+                                          '--user-id', 'TEST']), 0)
+        snapshot = CacheSnapshot(self.path)
+        self.assertEqual(len(snapshot), 2)
+        snapshot.close()
+
+        cache = TTLCache()
+        cache.restore(self.path)
+        address = Address(user_id='TEST', transport=FakeTransport(), cache=cache)
+        requests = [{'Address2': '500 E 3rd St', 'City': 'Loveland', 'State': 'CO'},
+                    {'Address2': '2 Infinite Loop', 'City': 'Cupertino', 'State': 'CA'}]
+        self.assertEqual(warmup.warm(address, requests), (2, 1, 0))
+
+    def test_batch_results_keep_nested_parts(self):
+        package = {'Service': 'PRIORITY', 'ZipOrigination': '44106', 'ZipDestination': '20770', 'Pounds': 1,
+                   'Ounces': 8, 'Container': 'VARIABLE'}
+        rate = DomesticRate(user_id='TEST', transport=FakeTransport())
+        self.assertIn('Rate', rate.execute_batch([package])[0]['Postage'])
+        # parse_xml keeps its flat shape, one text value per child tag
+        flat = rate.parse_xml(rate.submit_xml(rate.make_xml([package])))[0]
+        self.assertEqual(flat['ZipDestination'], '20770')
+        self.assertIsNone(flat['Postage'])
+
+
+class TestSharedCaches(unittest.TestCase):
+
+    def setUp(self):
+        self.server = fake.FakeRedisServer().start()
+        self.addCleanup(self.server.stop)
+        self.directory = tempfile.mkdtemp()
+
+    def backends(self):
+        redis = RedisCache(port=self.server.port, prefix='test:')
+        sqlite = SQLiteCache(os.path.join(self.directory, 'cache.db'))
+        self.addCleanup(redis.close)
+        self.addCleanup(sqlite.close)
+        return redis, sqlite
+
+    def test_backends_round_trip(self):
+        for cache in self.backends():
+            cache.set_many({'a': {'Zip5': '80537'}, 'b': [1, 2]})
+            self.assertEqual(cache.get_many(['a', 'b', 'c']), {'a': {'Zip5': '80537'}, 'b': [1, 2]})
+            self.assertEqual(cache.get('b'), [1, 2])
+            self.assertIn('a', cache)
+            cache.delete('a')
+            self.assertIsNone(cache.get('a'))
+            cache.set('expired', 1, ttl=-1)
+            self.assertIsNone(cache.get('expired'))
+            cache.clear()
+            self.assertEqual(cache.get_many(['a', 'b']), {})
+
+    def test_batch_is_one_round_trip(self):
+        redis, _ = self.backends()
+        redis.set_many(dict(('key%d' % number, number) for number in range(100)))
+        before = self.server.commands
+        self.assertEqual(len(redis.get_many('key%d' % number for number in range(150))), 100)
+        self.assertEqual(self.server.commands - before, 1)
+
+    def test_processes_share_results(self):
+        addresses = [{'Address2': '500 E 3rd St', 'City': 'Loveland', 'State': 'CO'},
+                     {'Address2': '1 Infinite Loop', 'City': 'Cupertino', 'State': 'CA'}]
+        path = os.path.join(self.directory, 'cache.db')
+        for first, second in ((RedisCache(port=self.server.port), RedisCache(port=self.server.port)),
+                              (SQLiteCache(path), SQLiteCache(path))):
+            worker = Address(user_id='TEST', transport=FakeTransport(), cache=first)
+            other = Address(user_id='TEST', transport=FakeTransport(), cache=second)
+            validated = worker.validate_many(addresses, title_case=True)
+            self.assertEqual(other.validate_many(addresses, title_case=True), validated)
+            self.assertEqual(validated[0]['Address2'], '500 E 3Rd St')
+            self.assertEqual(worker.transport.requests, 1)
+            self.assertEqual(other.transport.requests, 0)
+            first.clear()
+
+    def test_cache_failures_fall_through_to_usps(self):
+        server = fake.FakeRedisServer().start()
+        redis = RedisCache(port=server.port, timeout=0.5)
+        server.stop()
+        address = Address(user_id='TEST', transport=FakeTransport(), cache=redis)
+        with self.assertLogs('usps.addressinformation.base', 'WARNING') as logs:
+            validated = address.validate_many([{'Address2': '500 E 3rd St', 'City': 'Loveland', 'State': 'CO'}])
+        self.assertEqual(validated[0]['Zip5'], '80537')
+        self.assertEqual(len(logs.records), 2)
+
+        # The USPS error is raised, not a failure writing the batches before it
+        rate = DomesticRate(user_id='TEST', transport=FakeTransport(), cache=redis)
+        rate.MAX_BATCH_SIZE = 1
+        denied = HTTPError('https://usps.invalid', 503, 'Service Unavailable', {}, None)
+        with mock.patch.object(rate, 'execute_batch', side_effect=[[{'Zone': '1'}], denied]), \
+                self.assertLogs('usps.addressinformation.base', 'WARNING'):
+            with self.assertRaises(HTTPError):
+                rate.execute_cached([{'Pounds': 1}, {'Pounds': 2}])
+
+        avail = CarrierPickupAvailability(user_id='TEST', transport=FakeTransport(), cache=redis)
+        location = {'Address2': '760 Charcot Ave', 'City': 'San Jose', 'State': 'CA', 'ZIP5': '95131'}
+        with self.assertLogs('usps.addressinformation.base', 'WARNING') as logs:
+            checked = avail.check_many([location, location])
+        self.assertEqual(checked['errors'], {})
+        self.assertEqual(avail.transport.requests, 1)
+        self.assertEqual(len(logs.records), 2)
+
+
+class TestLoadTest(unittest.TestCase):
+
+    def test_workload_is_deterministic_and_repeats(self):
+        first = list(WorkloadGenerator(seed=3).stream('address', 500))
+        self.assertEqual(first, list(WorkloadGenerator(seed=3).stream('address', 500)))
+        self.assertLess(len(set(canonical_key(address) for address in first)), 450)
+        for package in WorkloadGenerator(seed=3).stream('domestic_package', 200):
+            self.assertIn(package['Container'], CONTAINER)
+            if package['Service'] == 'FIRST CLASS':
+                self.assertIn(package['FirstClassMailType'], FIRST_CLASS_MAIL_TYPE)
+
+    def test_invalid_items_are_rejected_by_the_stand_in(self):
+        generator = WorkloadGenerator(seed=1, invalid_rate=1.0)
+        track = Track(user_id='TEST', transport=FakeTransport())
+        with self.assertRaises(USPSXMLError):
+            track.execute_batch(list(generator.stream('tracking_id', 3)))
+
+    def test_every_scenario_runs_against_the_stand_in_server(self):
+        with fake.FakeUSPSServer() as server:
+            load_test = loadtest.LoadTest(server.url, concurrency=4, pool=50)
+            try:
+                report = load_test.run(requests=len(loadtest.SCENARIOS) * 3)
+            finally:
+                load_test.transport.close()
+            self.assertEqual(server.requests, len(loadtest.SCENARIOS) * 3)
+        self.assertEqual(report['total']['requests'], len(loadtest.SCENARIOS) * 3)
+        self.assertEqual(report['total']['errors'], 0)
+        self.assertEqual(list(report['services']), list(loadtest.SCENARIOS))
+        self.assertGreater(report['peak_rss'], 0)
+        self.assertIn('p99', loadtest.format_report(report))
+        self.assertIn('peak RSS n/a', loadtest.format_report(dict(report, peak_rss=None)))
+        with mock.patch.dict('sys.modules', {'resource': None}):
+            self.assertIsNone(loadtest.peak_rss())
+
+    def test_stand_in_server_errors_are_counted(self):
+        with fake.FakeUSPSServer(error_rate=1.0) as server:
+            load_test = loadtest.LoadTest(server.url, services=['address'], concurrency=2, pool=10)
+            try:
+                report = load_test.run(requests=4)
+            finally:
+                load_test.transport.close()
+        self.assertEqual(report['services']['address']['error_rate'], 1.0)
+        self.assertEqual(report['services']['address']['error_types'], {'HTTPError': 4})
+
+
+class TestIntlRateDestinations(unittest.TestCase):
+    PARCEL = {'Pounds': 1, 'Ounces': 3, 'MailType': 'Package', 'ValueOfContents': 200, 'Container': 'RECTANGULAR',
+              'Width': 15, 'Length': 30, 'Height': 15, 'OriginZip': '18701'}
+
+    def test_many_countries_in_one_request(self):
+        intl = IntlRateV2(user_id='TEST', transport=FakeTransport())
+        countries = ['Canada', 'Mexico', 'Japan', 'Germany', 'France']
+        quotes = intl.quote_destinations(self.PARCEL, countries + [{'Country': 'Australia',
+                                                                    'DestinationPostalCode': '2000'}])
+        self.assertEqual(intl.transport.requests, 1)
+        self.assertEqual([quote['Service'][0]['Country'] for quote in quotes],
+                         [country.upper() for country in countries] + ['AUSTRALIA'])
+        self.assertEqual(quotes[0]['Service'][1]['SvcDescription'], 'Priority Mail International')
+
+        many = intl.quote_destinations(self.PARCEL, ['Country %d' % number for number in range(30)])
+        self.assertEqual(len(many), 30)
+        self.assertEqual(intl.transport.requests, 3)
+
+    def test_quotes_are_cached_per_country_and_weight_bracket(self):
+        intl = IntlRateV2(user_id='TEST', transport=FakeTransport(), cache=TTLCache(), weight_bracket=16)
+        intl.quote_destinations(self.PARCEL, ['Canada', 'Mexico'])
+        lighter = dict(self.PARCEL, Ounces=9)
+        quotes = intl.quote_destinations(lighter, ['Canada', 'Mexico', 'Japan'])
+        self.assertEqual(intl.transport.requests, 2)
+        self.assertEqual(quotes[0]['Service'][0]['Pounds'], '2')
+        self.assertEqual(quotes[0]['Service'][0]['Ounces'], '0')
+        intl.quote_destinations(dict(self.PARCEL, Container='VARIABLE'), ['Canada'])
+        intl.quote_destinations(dict(self.PARCEL, Pounds=3), ['Canada'])
+        self.assertEqual(intl.transport.requests, 4)
+        content = {'ContentType': 'Documents', 'ContentDescription': 'Contracts'}
+        intl.quote_destinations(dict(self.PARCEL, Content=content), ['Canada'])
+        intl.quote_destinations(dict(self.PARCEL, AcceptanceDateTime='2026-11-02T13:15:00-06:00'), ['Canada'])
+        self.assertEqual(intl.transport.requests, 6)
+
+    def test_unbracketed_quotes_are_not_shared_with_the_bracket(self):
+        intl = IntlRateV2(user_id='TEST', transport=FakeTransport(), cache=TTLCache(), weight_bracket=16)
+        light = intl.execute_cached([dict(self.PARCEL, Pounds=1, Ounces=1, Country='Canada')])[0]
+        heavy = intl.quote_destinations(dict(self.PARCEL, Pounds=1, Ounces=15), ['Canada'])[0]
+        self.assertEqual(intl.transport.requests, 2)
+        self.assertNotEqual(light, heavy)
+        self.assertEqual(intl.quote_destinations(dict(self.PARCEL, Pounds=1, Ounces=9), ['Canada'])[0], heavy)
+        self.assertEqual(intl.transport.requests, 2)
+
+    def test_bracket_rounds_up(self):
+        intl = IntlRateV2(user_id='TEST', weight_bracket=4)
+        self.assertEqual(intl.bracket({'Pounds': 0, 'Ounces': 4}), {'Pounds': 0, 'Ounces': 4})
+        self.assertEqual(intl.bracket({'Pounds': 0, 'Ounces': 13.5}), {'Pounds': 1, 'Ounces': 0})
+        self.assertEqual(IntlRateV2(user_id='TEST', weight_bracket=0.5).bracket({'Pounds': 2, 'Ounces': 1.2}),
+                         {'Pounds': 2, 'Ounces': 1.5})
+
+
+class TestColumnarResults(unittest.TestCase):
+
+    def setUp(self):
+        self.generator = WorkloadGenerator(seed=5, repeat_share=0)
+
+    def test_columns_without_dependencies(self):
+        track = Track(user_id='TEST', transport=FakeTransport())
+        tracking_ids = list(self.generator.stream('tracking_id', 25))
+        columns = track.execute_columnar(tracking_ids, format='columns')
+        self.assertEqual(track.transport.requests, 3)
+        self.assertEqual(columns['TrackID'], tracking_ids)
+        self.assertEqual(columns['Index'], list(range(25)))
+        with self.assertRaises(ValueError):
+            track.execute_columnar(tracking_ids, format='pandas')
+        with self.assertRaises(NotImplementedError):
+            CarrierPickupInquiry(user_id='TEST').execute_columnar([{}])
+
+    def test_partial_keeps_rejected_items_as_error_rows(self):
+        track = Track(user_id='TEST', transport=FakeTransport())
+        tracking_ids = ['9400100000000000000001', '0400100000000000000002', '9400100000000000000003']
+        with self.assertRaises(USPSXMLError):
+            track.execute_columnar(tracking_ids, format='columns')
+        columns = track.execute_columnar(tracking_ids, format='columns', partial=True)
+        self.assertEqual(columns['Index'], [0, 1, 2])
+        self.assertEqual(columns['TrackID'], [tracking_ids[0], None, tracking_ids[2]])
+        self.assertEqual(columns['Error'], [None, 'A status update is not yet available on your package.', None])
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_numpy_structured_arrays(self):
+        addresses = list(self.generator.stream('address', 12))
+        validated = Address(user_id='TEST', transport=FakeTransport()).execute_columnar(addresses)
+        self.assertEqual(validated.dtype.names[:3], ('Index', 'FirmName', 'Address1'))
+        self.assertEqual(list(validated['Index']), list(range(12)))
+        self.assertEqual(validated['City'][3], addresses[3]['City'].upper())
+
+        packages = [{'Service': 'PRIORITY', 'ZipOrigination': '44106', 'ZipDestination': '20770', 'Pounds': 1,
+                     'Ounces': 8, 'Container': 'VARIABLE'}] * 30
+        rates = DomesticRate(user_id='TEST', transport=FakeTransport()).execute_columnar(packages)
+        self.assertEqual(rates.dtype['Rate'], numpy.float64)
+        self.assertEqual(rates.dtype['Zone'], numpy.int64)
+        expected = float(fake.fake_postage(fake.fake_zone('44106', '20770'), 1, 8))
+        self.assertTrue(numpy.allclose(rates['Rate'], expected))
+        self.assertTrue(numpy.isnan(rates['CommercialRate']).all())
+        self.assertEqual(rates['Index'][-1], 29)
+
+    def test_one_row_per_postage(self):
+        response = etree.fromstring(
+            '<RateV4Response><Package ID="0"><Zone>3</Zone><Postage CLASSID="1"><Rate>9.10</Rate></Postage>'
+            '<Postage CLASSID="3"><Rate>26.35</Rate></Postage></Package>'
+            '<Package ID="1"><Zone>5</Zone><Postage CLASSID="1"><Rate>10.20</Rate></Postage></Package>'
+            '</RateV4Response>')
+        columns = Columns(DomesticRate.COLUMNS)
+        columns.add(response, offset=10)
+        data = columns.to_columns()
+        self.assertEqual(data['Index'], [10, 10, 11])
+        self.assertEqual(data['Zone'], ['3', '3', '5'])
+        self.assertEqual(data['CLASSID'], ['1', '3', '1'])
+        self.assertEqual(data['Rate'], ['9.10', '26.35', '10.20'])
+
+    def test_index_follows_ids_not_response_order(self):
+        response = etree.fromstring('<RateV4Response><Package ID="1"><Zone>5</Zone><Postage CLASSID="1"/></Package>'
+                                    '<Package ID="0"><Zone>3</Zone><Postage CLASSID="1"/></Package>'
+                                    '</RateV4Response>')
+        columns = Columns(DomesticRate.COLUMNS)
+        columns.add(response, offset=5)
+        data = columns.to_columns()
+        self.assertEqual(data['Index'], [6, 5])
+        self.assertEqual(data['Zone'], ['5', '3'])
+
+        request = etree.fromstring('<TrackFieldRequest><TrackID ID="EJ2"/><TrackID ID="EJ1"/></TrackFieldRequest>')
+        response = etree.fromstring('<TrackResponse><TrackInfo ID="EJ1"/><TrackInfo ID="EJ2"/></TrackResponse>')
+        columns = Columns(Track.COLUMNS)
+        columns.add(response, request=request)
+        data = columns.to_columns()
+        self.assertEqual(data['Index'], [1, 0])
+
+
+class TestPartialResults(unittest.TestCase):
+    ADDRESSES = [{'Address2': '500 E 3rd St', 'City': 'Loveland', 'State': 'CO'},
+                 {'Address2': '', 'City': 'Nowhere', 'State': 'CO'},
+                 {'Address2': '1 Infinite Loop', 'City': 'Cupertino', 'State': 'CA'}]
+
+    def test_one_bad_item_does_not_fail_the_batch(self):
+        address = Address(user_id='TEST', transport=FakeTransport())
+        with self.assertRaises(USPSXMLError):
+            address.execute_batch(self.ADDRESSES)
+        results = address.execute_batch(self.ADDRESSES, partial=True)
+        self.assertEqual(results[0]['Address2'], '500 E 3RD ST')
+        self.assertIsInstance(results[1], USPSXMLError)
+        self.assertEqual(results[1].info['Number'], '-2147219401')
+        self.assertEqual(results[2]['City'], 'CUPERTINO')
+
+    def test_ids_are_matched_not_positions(self):
+        track = Track(user_id='TEST', transport=FakeTransport(
+            lambda api, xml: b'<TrackResponse><TrackInfo ID="9402"><TrackSummary>Delivered</TrackSummary></TrackInfo>'
+                             b'<TrackInfo ID="0001"><Error><Number>-2147219283</Number><Description>No update'
+                             b'</Description></Error></TrackInfo></TrackResponse>'))
+        results = track.execute_batch(['0001', '9402', '9403'], partial=True)
+        self.assertEqual(results[0].info['Description'], 'No update')
+        self.assertEqual(results[1], {'TrackSummary': 'Delivered'})
+        self.assertEqual(str(results[2]), 'No result for ID 9403')
+
+    def test_root_error_still_raises(self):
+        address = Address(user_id='', transport=FakeTransport())
+        with self.assertRaises(USPSXMLError) as context:
+            address.execute_batch(self.ADDRESSES, partial=True)
+        self.assertIn('Authorization failure', str(context.exception))
+
+    def test_errors_are_not_cached_and_feed_the_negative_cache(self):
+        address = Address(user_id='TEST', transport=FakeTransport(), cache=TTLCache(), negative_cache=NegativeCache())
+        results = address.validate_many(self.ADDRESSES * 2, title_case=True, partial=True)
+        self.assertEqual(address.transport.requests, 1)
+        self.assertEqual(results[3]['Address2'], '500 E 3Rd St')
+        self.assertIsInstance(results[4], USPSXMLError)
+        self.assertEqual(len(address.cache), 2)
+        with self.assertRaises(USPSXMLError):
+            address.validate(address2='', city='Nowhere', state='CO')
+        self.assertEqual(address.transport.requests, 1)
+
+    def test_adaptive_batcher_and_single_item_services(self):
+        batcher = AdaptiveBatcher(Address(user_id='TEST', transport=FakeTransport()))
+        results = batcher.run(self.ADDRESSES, partial=True)
+        self.assertEqual([isinstance(result, USPSXMLError) for result in results], [False, True, False])
+        sdc = ServiceDelivery(user_id='TEST', transport=FakeTransport())
+        located, = sdc.execute_batch([{'MailClass': '1', 'OriginZIP': '80537', 'DestinationZIP': '20770'}],
+                                     partial=True)
+        self.assertEqual(located['OriginZIP'], '80537')
+
+
+class TestSlowRequestRecorder(unittest.TestCase):
+
+    def test_only_slow_and_failed_requests_are_kept(self):
+        recorder = SlowRequestRecorder(threshold=0.05, capacity=2)
+        responses = iter([0.0, 0.08, 0.0, 0.0])
+
+        def handler(api, xml):
+            time.sleep(next(responses))
+            return fake.respond(api, xml)
+
+        address = Address(user_id='SECRET', transport=FakeTransport(handler), recorder=recorder)
+        address.validate(address2='500 E 3rd St', city='Loveland', state='CO')
+        self.assertEqual(recorder.snapshot(), [])
+        address.execute_batch([{'Address2': '500 E 3rd St', 'City': 'Loveland', 'State': 'CO'}] * 3)
+        with self.assertRaises(USPSXMLError):
+            address.validate(address2='', city='Loveland', state='CO')
+
+        slow, failed = recorder.snapshot()
+        self.assertGreaterEqual(slow['latency'], 0.08)
+        self.assertEqual(slow['batch_size'], 3)
+        self.assertIsNone(slow['error'])
+        self.assertIn('USERID="REDACTED"', slow['request'])
+        self.assertNotIn('SECRET', slow['request'])
+        self.assertIn('<AddressValidateResponse>', slow['response'])
+        self.assertLessEqual(slow['network'] + slow['parse'], slow['latency'])
+        self.assertTrue(failed['error'].startswith('USPSXMLError: Address Not Found'))
+        self.assertEqual(recorder.stats(), {'seen': 3, 'recorded': 2, 'buffered': 2})
+
+        with self.assertRaises(USPSXMLError):
+            address.execute_batch([{'Address2': '', 'City': 'Loveland', 'State': 'CO'}])
+        self.assertEqual(len(recorder.snapshot()), 2)
+        self.assertEqual(recorder.snapshot()[0]['error'], failed['error'])
+
+    def test_dump_on_demand_and_on_signal(self):
+        recorder = SlowRequestRecorder(threshold=0, max_body=20)
+        track = Track(user_id='TEST', transport=FakeTransport(), recorder=recorder)
+        track.execute_batch(['9400111899223197428490'])
+        path = os.path.join(tempfile.mkdtemp(), 'slow.jsonl')
+        self.assertEqual(recorder.dump(path), 1)
+        with open(path) as source:
+            entry = json.loads(source.readline())
+        self.assertEqual(entry['api'], 'TrackV2')
+        self.assertTrue(entry['response'].endswith('bytes]'))
+
+        if hasattr(signal, 'SIGUSR1'):
+            os.remove(path)
+            previous = recorder.dump_on_signal(path)
+            try:
+                os.kill(os.getpid(), signal.SIGUSR1)
+                recorder.dumper.join(5)
+                self.assertTrue(os.path.exists(path))
+            finally:
+                signal.signal(signal.SIGUSR1, previous)
+
+
+class TestRevalidatingCache(unittest.TestCase):
+    PACKAGE = {'Service': 'PRIORITY', 'ZipOrigination': '44106', 'ZipDestination': '20770', 'Pounds': 1,
+               'Ounces': 8, 'Container': 'VARIABLE'}
+
+    def setUp(self):
+        self.now = [1000.0]
+        self.release = threading.Event()
+        self.release.set()
+        self.transport = FakeTransport(self.handler)
+
+    def handler(self, api, xml):
+        self.release.wait(5)
+        return fake.respond(api, xml)
+
+    def make_cache(self, **kwargs):
+        clock = lambda: self.now[0]
+        kwargs.setdefault('beta', 0)
+        cache = RevalidatingCache(TTLCache(clock=clock), ttl=10, grace=5, clock=clock, **kwargs)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_stale_values_are_served_while_one_refresh_runs(self):
+        rate = DomesticRate(user_id='TEST', transport=self.transport, cache=self.make_cache())
+        first = rate.execute_cached([self.PACKAGE])
+        self.now[0] += 11
+        self.release.clear()
+        for _ in range(5):
+            self.assertEqual(rate.execute_cached([self.PACKAGE]), first)
+        self.assertEqual(rate.cache.stats()['refreshing'], 1)
+        self.assertFalse(rate.cache.wait(timeout=0.01))
+        self.release.set()
+        self.assertTrue(rate.cache.wait())
+        self.assertEqual(self.transport.requests, 2)
+        self.assertEqual(rate.cache.stats()['refreshes'], 1)
+
+        rate.execute_cached([self.PACKAGE])
+        self.assertEqual(self.transport.requests, 2)
+        self.now[0] += 16
+        rate.execute_cached([self.PACKAGE])
+        self.assertEqual(self.transport.requests, 3)
+
+    def test_early_refresh_is_probabilistic(self):
+        never = DomesticRate(user_id='TEST', transport=self.transport, cache=self.make_cache(beta=1, random=lambda: 1.0))
+        never.execute_cached([self.PACKAGE])
+        self.now[0] += 9
+        never.execute_cached([self.PACKAGE])
+        never.cache.wait()
+        self.assertEqual(self.transport.requests, 1)
+
+        early = DomesticRate(user_id='TEST', transport=self.transport, cache=self.make_cache(beta=1, random=lambda: 1e-6))
+        early.execute_cached([self.PACKAGE])
+        early.execute_cached([self.PACKAGE])
+        early.cache.wait()
+        self.assertEqual(self.transport.requests, 3)
+        self.assertEqual(early.cache.stats()['early_refreshes'], 1)
+
+    def test_failed_refresh_keeps_the_stale_value(self):
+        intl = IntlRateV2(user_id='TEST', transport=self.transport, cache=self.make_cache())
+        parcel = {'Pounds': 1, 'Ounces': 0, 'MailType': 'Package', 'ValueOfContents': 20, 'Container': 'VARIABLE'}
+        quote = intl.quote_destinations(parcel, ['Canada'])
+        intl.USER_ID = ''
+        self.now[0] += 11
+        self.assertEqual(intl.quote_destinations(parcel, ['Canada']), quote)
+        intl.cache.wait()
+        self.assertEqual(intl.cache.stats()['refresh_errors'], 1)
+        self.assertEqual(intl.quote_destinations(parcel, ['Canada']), quote)
+
+    def test_mail_service_and_sdc_lookups(self):
+        sent = list()
+        transport = FakeTransport(lambda api, xml: sent.append(api) or fake.respond(api, xml))
+        mail = MailService(user_id='TEST', transport=transport, cache=self.make_cache())
+        commitment = mail.lookup({'OriginZip': '44106', 'DestinationZip': '20770'}, 'PriorityMail')
+        self.assertEqual(commitment['OriginZip'], '44106')
+        self.assertEqual(mail.lookup({'OriginZip': '44106', 'DestinationZip': '20770'}, 'PriorityMail'), commitment)
+        mail.lookup({'OriginZip': '44106', 'DestinationZip': '20770'}, 'StandardB')
+        self.assertEqual(sent, ['PriorityMail', 'StandardB'])
+
+        sdc = ServiceDelivery(user_id='TEST', transport=transport, cache=self.make_cache())
+        request = {'MailClass': '1', 'OriginZIP': '80537', 'DestinationZIP': '20770'}
+        self.assertEqual(sdc.get_locations(request), sdc.get_locations(request))
+        self.assertEqual(sent[2:], ['SDCGetLocations'])
+
+
+class TestLookups(unittest.TestCase):
+
+    def test_city_state_batches_and_caches(self):
+        sent = list()
+        transport = FakeTransport(lambda api, xml: sent.append((api, xml)) or fake.respond(api, xml))
+        city_state = CityStateLookup(user_id='TEST', transport=transport)
+        self.assertEqual(city_state.lookup('80537-5773'), {'Zip5': '80537', 'City': 'LOVELAND', 'State': 'CO'})
+
+        zip_codes = ['20770', '44106', '80537', '90210', '10001', '20770', '60601']
+        results = city_state.lookup_many(zip_codes)
+        self.assertEqual([result['City'] for result in results][:2], ['GREENBELT', 'CLEVELAND'])
+        self.assertEqual(results[5], results[0])
+        # 80537 came from the cache and 20770 is only asked once, 5 new ZIP codes are one request
+        self.assertEqual(len(sent), 2)
+        api, xml = sent[1]
+        self.assertEqual(api, 'CityStateLookup')
+        self.assertEqual(etree.fromstring(xml).xpath('ZipCode/@ID'), ['0', '1', '2', '3', '4'])
+
+        results[0]['City'] = 'CHANGED'
+        self.assertEqual(city_state.lookup('20770')['City'], 'GREENBELT')
+        self.assertEqual(len(sent), 2)
+
+    def test_city_state_rejects_bad_zip_codes(self):
+        city_state = CityStateLookup(user_id='TEST', transport=FakeTransport())
+        with self.assertRaises(USPSXMLError):
+            city_state.lookup('805')
+        self.assertEqual(city_state.transport.requests, 0)
+        with self.assertRaises(USPSXMLError):
+            city_state.lookup('00012')
+
+        results = city_state.lookup_many(['8053', '00012', '80537'], partial=True)
+        self.assertIsInstance(results[0], USPSXMLError)
+        self.assertEqual(results[1].info['Number'], '-2147219399')
+        self.assertEqual(results[2]['State'], 'CO')
+        self.assertEqual(len(city_state.cache), 1)
+
+    def test_zip_code_lookup(self):
+        sent = list()
+        transport = FakeTransport(lambda api, xml: sent.append(api) or fake.respond(api, xml))
+        zip_code = ZipCodeLookup(user_id='TEST', transport=transport)
+        result = zip_code.lookup(address2='500 E. third st', city='Loveland', state='CO')
+        self.assertEqual(result['FullZip'], '80537-%s' % result['Zip4'])
+        self.assertEqual(zip_code.lookup(address2='500 E. third st', city='Loveland', state='CO'), result)
+        self.assertEqual(sent, ['ZipCodeLookup'])
+
+        addresses = list(WorkloadGenerator(seed=3, repeat_share=0).stream('address', 10))
+        results = zip_code.lookup_many(addresses, title_case=True)
+        self.assertEqual(len(sent), 3)
+        self.assertEqual(results[4]['City'], addresses[4]['City'])
+
+
+class TestGateway(unittest.TestCase):
+
+    def setUp(self):
+        self.sent = list()
+        transport = FakeTransport(self.handler)
+        self.gateway = gateway.Gateway('https://usps.invalid/ShippingAPI.dll', ['GATEWAY'], transport=transport,
+                                       cache=TTLCache(), max_wait=0.01)
+        self.addCleanup(self.gateway.close)
+
+    def handler(self, api, xml):
+        self.sent.append((api, etree.fromstring(xml)))
+        return fake.respond(api, xml)
+
+    def serve(self, server):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def test_concurrent_workers_share_batches_and_cache(self):
+        # Batches only go out full, however the ten workers are scheduled
+        self.gateway.max_wait = 30
+        server = self.serve(gateway.GatewayHTTPServer(self.gateway, port=0))
+        client = GatewayTransport(server.address)
+        addresses = list(WorkloadGenerator(seed=11, repeat_share=0).stream('address', 10))
+        results = [None] * 10
+
+        def validate(index):
+            address = Address(user_id='WORKER', transport=client)
+            results[index] = address.validate_many([addresses[index]])[0]
+
+        threads = [threading.Thread(target=validate, args=(index,)) for index in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([result['City'] for result in results], [address['City'].upper() for address in addresses])
+        self.assertLessEqual(len(self.sent), 2)
+        self.assertEqual(self.gateway.stats()['batched_items'], 10)
+        for api, xml in self.sent:
+            self.assertEqual(api, 'Verify')
+            self.assertEqual(xml.get('USERID'), 'GATEWAY')
+            self.assertEqual(xml.xpath('Address/@ID'), ['0', '1', '2', '3', '4'])
+
+        again = Address(user_id='WORKER', transport=client).validate_many(addresses[:3])
+        self.assertEqual(again, results[:3])
+        self.assertEqual(len(self.sent), 2)
+        self.assertEqual(self.gateway.stats()['cache_hits'], 3)
+
+    def test_unix_socket_and_environment(self):
+        path = os.path.join(tempfile.mkdtemp(), 'gateway.sock')
+        self.serve(gateway.GatewayUnixServer(self.gateway, path))
+        with mock.patch.dict(os.environ, {'USPS_GATEWAY': path}):
+            track = Track(user_id='')
+            rate = DomesticRate(user_id='')
+        self.assertIsInstance(track.transport, GatewayTransport)
+        self.assertIs(track.transport, rate.transport)
+        self.addCleanup(track.transport.close)
+
+        results = track.execute_batch(['9400100000000000000001', '9400100000000000000002'])
+        self.assertEqual(len(results), 2)
+        with self.assertRaises(USPSXMLError):
+            track.execute_batch(['0400100000000000000001'])
+        self.assertEqual(self.sent[0][1].xpath('TrackID/@ID'), ['9400100000000000000001', '9400100000000000000002'])
+
+        package = {'Service': 'PRIORITY', 'ZipOrigination': '44106', 'ZipDestination': '20770', 'Pounds': 1,
+                   'Ounces': 8, 'Container': 'VARIABLE'}
+        self.assertEqual(rate.execute_batch([package, package]), DomesticRate('TEST', transport=FakeTransport())
+                         .execute_batch([package, package]))
+        self.assertEqual(self.sent[-1][1].findtext('Revision'), '2')
+
+    def test_other_apis_pass_through(self):
+        server = self.serve(gateway.GatewayHTTPServer(self.gateway, port=0))
+        client = GatewayTransport('http://%s/ShippingAPI.dll' % server.address)
+        mail = MailService(user_id='', transport=client)
+        self.assertEqual(mail.lookup({'OriginZip': '44106', 'DestinationZip': '20770'}, 'StandardB')['OriginZip'],
+                         '44106')
+        self.assertEqual(self.sent[0][0], 'StandardB')
+        self.assertEqual(self.gateway.stats()['forwarded'], 1)
+
+        bad = CityStateLookup(user_id='', transport=client, cache=TTLCache(ttl=0))
+        with self.assertRaises(USPSXMLError):
+            bad.lookup('00012')
+
+    def test_idle_queues_retire_and_extra_queues_forward(self):
+        self.gateway.idle = 0.01
+        self.gateway.max_queues = 1
+        lookup = b'<CityStateLookupRequest USERID="X"><ZipCode ID="0"><Zip5>44106</Zip5></ZipCode>' \
+                 b'</CityStateLookupRequest>'
+        self.gateway.handle('CityStateLookup', lookup)
+        # A second API while the first queue is still open goes out unbatched
+        self.gateway.max_wait = 30
+        queue = self.gateway.queues[('CityStateLookup', 'CityStateLookupRequest', b'')]
+        with queue.condition:
+            verify = b'<AddressValidateRequest USERID="X"><Revision>1</Revision><Address ID="0">' \
+                     b'<Address2>1 Main St</Address2><City>Cleveland</City><State>OH</State></Address>' \
+                     b'</AddressValidateRequest>'
+            self.assertIn(b'AddressValidateResponse', self.gateway.handle('Verify', verify))
+        self.assertEqual(self.gateway.stats()['over_queue_limit'], 1)
+        queue.thread.join(5)
+        self.assertFalse(queue.thread.is_alive())
+        self.assertEqual(self.gateway.queues, {})
+
+    def test_one_deadline_per_request(self):
+        self.gateway.max_wait = 30
+        self.gateway.timeout = 0.05
+        lookup = b'<CityStateLookupRequest USERID="X"><ZipCode ID="0"><Zip5>44106</Zip5></ZipCode>' \
+                 b'<ZipCode ID="1"><Zip5>20770</Zip5></ZipCode></CityStateLookupRequest>'
+        started = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            self.gateway.handle('CityStateLookup', lookup)
+        self.assertLess(time.monotonic() - started, 1)
+        # The timed out items are cancelled and never sent upstream
+        self.gateway.close()
+        self.assertEqual(self.sent, [])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,5 +1,20 @@
 from usps.addressinformation.base import USPSXMLError, Address, DomesticRate, Track, CarrierPickupAvailability,\
-    CarrierPickupSchedule, CarrierPickupCancel,CarrierPickupChange, IntlRateV2, MailService, ServiceDelivery
+    CarrierPickupSchedule, CarrierPickupCancel,CarrierPickupChange, IntlRateV2, MailService, ServiceDelivery, \
+    CityStateLookup, ZipCodeLookup
+from usps.addressinformation.backends import CacheBackend, RedisCache, SQLiteCache, USPSCacheError
+from usps.addressinformation.batching import AdaptiveBatcher
+from usps.addressinformation.cache import TTLCache, BloomFilter, NegativeCache, RevalidatingCache
+from usps.addressinformation.columnar import ColumnSpec, Columns
+from usps.addressinformation.credentials import CredentialPool, USPSCredentialsExhausted
+from usps.addressinformation.deadline import Deadline, USPSDeadlineExceeded
+from usps.addressinformation.hedge import HedgePolicy
+from usps.addressinformation.normalize import normalize_address, normalize_many, canonical_key
+from usps.addressinformation.recorder import SlowRequestRecorder
+from usps.addressinformation.scheduler import PriorityScheduler, USPSSchedulerFull
+from usps.addressinformation.snapshot import CacheSnapshot
+from usps.addressinformation.transport import Transport, UrllibTransport, PooledTransport, FakeTransport, \
+    GatewayTransport, default_transport
+from usps.addressinformation.zones import ZoneMatrix
 USPS_CONNECTION_HTTP = 'http://production.shippingapis.com/ShippingAPI.dll'
 USPS_CONNECTION = 'https://secure.shippingapis.com/ShippingAPI.dll'
 USPS_CONNECTION_TEST = 'https://secure.shippingapis.com/ShippingAPITest.dll'
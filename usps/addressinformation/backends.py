@@ -0,0 +1,270 @@
+'''
+Result caches shared between processes and hosts.
+
+Any service that takes cache= accepts one of these in place of a TTLCache:
+
+cache = RedisCache(host='cache.internal', prefix='usps:address:', ttl=86400)
+address_validation = Address(user_id='YOUR_USER_ID', cache=cache)
+
+cache = SQLiteCache('/var/cache/usps/rates.db', ttl=3600)
+rate = DomesticRate(user_id='YOUR_USER_ID', cache=cache)
+
+RedisCache speaks the Redis protocol (Redis, Valkey, KeyDB or
+usps.addressinformation.fake.FakeRedisServer in tests) for caches shared by
+many hosts, SQLiteCache keeps one WAL mode database file per host for the
+worker processes on it.  Values are stored as JSON and get_many/set_many
+each cost a single round trip, so a batch of lookups is one MGET and a batch
+of results one pipelined write.
+'''
+
+import json
+import socket
+import sqlite3
+import threading
+import time
+
+
+class USPSCacheError(Exception):
+    pass
+
+
+class CacheBackend(object):
+    """ Same interface as TTLCache.  Subclasses implement get_many, set_many,
+    delete and clear, single key calls go through them.
+    """
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def set(self, key, value, ttl=None):
+        self.set_many({key: value}, ttl)
+
+    def get_many(self, keys):
+        """ Return a dict holding only the keys that were found. """
+        raise NotImplementedError
+
+    def set_many(self, mapping, ttl=None):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def dumps(value):
+        return json.dumps(value, separators=(',', ':'))
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data)
+
+
+class RedisCache(CacheBackend):
+    """ Minimal Redis protocol client, one connection per thread.  Keys are
+    stored under prefix and expire with SET ... EX ttl.
+    """
+
+    def __init__(self, host='127.0.0.1', port=6379, db=0, password=None, prefix='usps:', ttl=3600, timeout=1.0,
+                 unix_socket=None):
+        super(RedisCache, self).__init__(ttl)
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.prefix = prefix
+        self.timeout = timeout
+        self.unix_socket = unix_socket
+        self._local = threading.local()
+
+    def _connect(self):
+        if self.unix_socket:
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.settimeout(self.timeout)
+            connection.connect(self.unix_socket)
+        else:
+            connection = socket.create_connection((self.host, self.port), self.timeout)
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._local.connection = connection
+        self._local.reader = connection.makefile('rb')
+        setup = list()
+        if self.password:
+            setup.append(('AUTH', self.password))
+        if self.db:
+            setup.append(('SELECT', self.db))
+        if setup:
+            self._roundtrip(setup)
+
+    def _disconnect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            self._local.reader.close()
+            connection.close()
+            self._local.connection = None
+
+    @staticmethod
+    def encode(command):
+        parts = [b'*%d\r\n' % len(command)]
+        for argument in command:
+            if not isinstance(argument, bytes):
+                argument = str(argument).encode('utf-8')
+            parts.append(b'$%d\r\n%s\r\n' % (len(argument), argument))
+        return b''.join(parts)
+
+    def _reply(self):
+        line = self._local.reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError('Connection to the cache server closed')
+        kind, payload = line[:1], line[1:-2]
+        if kind == b'+':
+            return payload.decode('utf-8')
+        if kind == b'-':
+            return USPSCacheError(payload.decode('utf-8'))
+        if kind == b':':
+            return int(payload)
+        if kind == b'$':
+            length = int(payload)
+            if length < 0:
+                return None
+            data = self._local.reader.read(length + 2)
+            return data[:-2]
+        if kind == b'*':
+            length = int(payload)
+            if length < 0:
+                return None
+            return [self._reply() for _ in range(length)]
+        raise USPSCacheError('Unexpected reply %r' % line)
+
+    def _roundtrip(self, commands):
+        """ Pipeline commands on this thread's connection and return their replies """
+        self._local.connection.sendall(b''.join(self.encode(command) for command in commands))
+        replies = [self._reply() for _ in commands]
+        for reply in replies:
+            if isinstance(reply, USPSCacheError):
+                raise reply
+        return replies
+
+    def execute(self, *commands):
+        """ Send one or more commands in a single round trip, reconnecting once
+        if a pooled connection went away.
+        """
+        for attempt in (0, 1):
+            if getattr(self._local, 'connection', None) is None:
+                self._connect()
+            try:
+                return self._roundtrip(commands)
+            except OSError:
+                self._disconnect()
+                if attempt:
+                    raise
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return dict()
+        values, = self.execute(['MGET'] + [self.prefix + key for key in keys])
+        return dict((key, self.loads(value)) for key, value in zip(keys, values) if value is not None)
+
+    def set_many(self, mapping, ttl=None):
+        if not mapping:
+            return
+        ttl = int(self.ttl if ttl is None else ttl)
+        if ttl <= 0:
+            return
+        self.execute(*[('SET', self.prefix + key, self.dumps(value), 'EX', ttl) for key, value in mapping.items()])
+
+    def delete(self, key):
+        self.execute(('DEL', self.prefix + key))
+
+    def clear(self):
+        """ Delete every key under prefix """
+        cursor = '0'
+        while True:
+            (cursor, keys), = self.execute(('SCAN', cursor, 'MATCH', self.prefix + '*', 'COUNT', 1000))
+            if keys:
+                self.execute(['DEL'] + keys)
+            if cursor in (b'0', '0'):
+                return
+
+    def close(self):
+        self._disconnect()
+
+
+class SQLiteCache(CacheBackend):
+    """ Cache in a SQLite database in WAL mode, so readers in other processes
+    never wait on a writer.  Each thread gets its own connection.
+    """
+    # SQLite's default limit on host parameters is 999
+    CHUNK = 500
+
+    def __init__(self, path, ttl=3600, timeout=5.0, clock=time.time):
+        super(SQLiteCache, self).__init__(ttl)
+        self.path = path
+        self.timeout = timeout
+        self.clock = clock
+        self._local = threading.local()
+        self._connection().execute('CREATE TABLE IF NOT EXISTS usps_cache '
+                                   '(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)')
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def __len__(self):
+        row = self._connection().execute('SELECT COUNT(*) FROM usps_cache WHERE expires > ?',
+                                         (self.clock(),)).fetchone()
+        return row[0]
+
+    def get_many(self, keys):
+        keys = list(keys)
+        found = dict()
+        now = self.clock()
+        connection = self._connection()
+        for start in range(0, len(keys), self.CHUNK):
+            chunk = keys[start:start + self.CHUNK]
+            rows = connection.execute('SELECT key, value FROM usps_cache WHERE expires > ? AND key IN (%s)'
+                                      % ','.join('?' * len(chunk)), [now] + chunk)
+            for key, value in rows:
+                found[key] = self.loads(value)
+        return found
+
+    def set_many(self, mapping, ttl=None):
+        if not mapping:
+            return
+        expires = self.clock() + (self.ttl if ttl is None else ttl)
+        connection = self._connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.executemany('INSERT OR REPLACE INTO usps_cache (key, value, expires) VALUES (?, ?, ?)',
+                                   [(key, self.dumps(value), expires) for key, value in mapping.items()])
+
+    def delete(self, key):
+        self._connection().execute('DELETE FROM usps_cache WHERE key = ?', (key,))
+
+    def purge(self):
+        """ Drop expired rows, returns how many were removed """
+        return self._connection().execute('DELETE FROM usps_cache WHERE expires <= ?', (self.clock(),)).rowcount
+
+    def clear(self):
+        self._connection().execute('DELETE FROM usps_cache')
+
+    def close(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
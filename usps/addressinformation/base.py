@@ -2,15 +2,32 @@
 See https://www.usps.com/business/web-tools-apis/Address-Information-v3-2.htm for complete documentation of the API
 '''
 
+import contextvars
 import html
+import io
 import json
+import logging
+import math
+import socket
 import xmltodict as XTD
+from collections import OrderedDict, deque
+from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError, URLError
 from urllib.parse import urlencode
-from urllib.request import urlopen
 
 from lxml import etree
 from lxml.etree import SubElement, Element
 
+from usps.addressinformation.cache import RevalidatingCache, TTLCache
+from usps.addressinformation.columnar import ColumnSpec, Columns
+from usps.addressinformation.deadline import USPSDeadlineExceeded, current_deadline
+from usps.addressinformation.normalize import canonical_key, normalize_address, normalize_many
+from usps.addressinformation.scheduler import USPSSchedulerFull
+from usps.addressinformation.transport import default_transport
+
+logger = logging.getLogger(__name__)
+
 
 def utf8urlencode(data):
     ret = dict()
@@ -34,6 +51,17 @@ def dicttoxml(dictionary, parent, tagname, attributes=None):
     return element
 
 
+def cache_key(dictionary, keys):
+    """ Case and whitespace insensitive key built from the values of keys """
+    parts = list()
+    for key in keys:
+        value = dictionary.get(key)
+        if isinstance(value, (dict, list)):
+            value = json.dumps(value, sort_keys=True)
+        parts.append(' '.join(str('' if value is None else value).upper().split()))
+    return '|'.join(parts)
+
+
 def xmltodict(element):
     ret = dict()
     for item in element:
@@ -43,7 +71,8 @@ def xmltodict(element):
 
 class USPSXMLError(Exception):
     def __init__(self, element):
-        self.info = xmltodict(element)
+        # A dict is accepted so errors remembered by a NegativeCache can be raised again
+        self.info = dict(element) if isinstance(element, dict) else xmltodict(element)
         super(USPSXMLError, self).__init__(self.info['Description'])
 
 
@@ -52,22 +81,131 @@ class USPSService(object):
     API = None
     CHILD_XML_NAME = None
     PARAMETERS = None
-
-    def __init__(self, url='https://secure.shippingapis.com/ShippingAPI.dll'):
+    MAX_BATCH_SIZE = 1  # Most items USPS accepts in one request
+    IDEMPOTENT = True  # Safe to send twice, only these are hedged
+    COLUMNS = None  # ColumnSpec for execute_columnar
+
+    def __init__(self, url='https://secure.shippingapis.com/ShippingAPI.dll', transport=None, timeout=None,
+                 hedge=None, credentials=None, scheduler=None, priority='interactive', cache=None, recorder=None):
+        """ timeout is seconds or a (connect, read) tuple applied to every request,
+        hedge is an optional HedgePolicy, credentials an optional CredentialPool
+        whose USERIDs replace the one written by make_xml and scheduler an optional
+        PriorityScheduler that every request waits on in its priority class.  All
+        three can be shared between services.  cache is an optional result cache
+        (TTLCache or anything with get_many/set_many) keyed by cache_key and
+        recorder an optional SlowRequestRecorder.
+        """
         self.url = url
-
-    def submit_xml(self, xml):
+        self.transport = transport or default_transport()
+        self.timeout = timeout
+        self.hedge = hedge
+        self.credentials = credentials
+        self.scheduler = scheduler
+        self.priority = priority
+        self.cache = cache
+        self.recorder = recorder
+
+    def api_name(self, xml):
+        return self.API
+
+    def send_xml(self, xml):
+        """ Hand the request to the transport and return the raw response stream """
         data = {'XML': etree.tostring(xml),
-                'API': self.API}
-        response = urlopen(self.url, utf8urlencode(data))
-        root = etree.parse(response).getroot()
+                'API': self.api_name(xml)}
+        timeout = self.timeout
+        deadline = current_deadline()
+        data = utf8urlencode(data)
+        try:
+            if self.hedge is not None and self.IDEMPOTENT:
+                # Each attempt is capped at the Deadline when it starts
+                return self.hedge.run(lambda limit: self.transport.send(self.url, data, limit), timeout)
+            if deadline is not None:
+                timeout = deadline.limit(timeout)
+            return self.transport.send(self.url, data, timeout, idempotent=self.IDEMPOTENT)
+        except (socket.timeout, URLError) as error:
+            if deadline is not None and deadline.expired:
+                raise USPSDeadlineExceeded('Deadline of %.3fs exceeded waiting for %s' % (deadline.seconds, self.API))\
+                    from error
+            raise
+
+    def read_response(self, response, partial=False):
+        """ Parse the response and raise USPSXMLError for an Error in it.  With
+        partial only an Error root raises, item level errors are left for
+        split_results.
+        """
+        deadline = current_deadline()
+        if deadline is not None:
+            deadline.check('reading the %s response' % self.API)
+        try:
+            root = etree.parse(response).getroot()
+        except socket.timeout as error:
+            if deadline is not None and deadline.expired:
+                raise USPSDeadlineExceeded('Deadline of %.3fs exceeded reading %s' % (deadline.seconds, self.API))\
+                    from error
+            raise
         if root.tag == 'Error':
             raise USPSXMLError(root)
-        error = root.find('.//Error')
+        error = None if partial else root.find('.//Error')
         if error is not None:
             raise USPSXMLError(error)
         return root
 
+    def submit_xml(self, xml, partial=False):
+        if self.scheduler is None:
+            return self._submit_xml(xml, partial)
+
+        deadline = current_deadline()
+        try:
+            with self.scheduler.slot(self.priority, timeout=deadline and max(0.0, deadline.remaining())):
+                return self._submit_xml(xml, partial)
+        except USPSSchedulerFull as error:
+            if deadline is not None and deadline.expired:
+                raise USPSDeadlineExceeded('Deadline of %.3fs exceeded queued for %s' % (deadline.seconds, self.API))\
+                    from error
+            raise
+
+    def _exchange(self, xml, partial=False):
+        """ One round trip, timed and handed to self.recorder when there is one """
+        if self.recorder is None:
+            return self.read_response(self.send_xml(xml), partial)
+
+        clock = self.recorder.clock
+        started = clock()
+        body = received = error = None
+        try:
+            response = self.send_xml(xml)
+            try:
+                body = response.read()
+            finally:
+                response.close()
+            received = clock()
+            return self.read_response(io.BytesIO(body), partial)
+        except Exception as exception:
+            error = exception
+            raise
+        finally:
+            self.recorder.observe(self, xml, body, started, received, clock(), error)
+
+    def _submit_xml(self, xml, partial=False):
+        if self.credentials is None:
+            return self._exchange(xml, partial)
+
+        tried = list()
+        while True:
+            deadline = current_deadline()
+            user_id = self.credentials.acquire(timeout=deadline and max(0.0, deadline.remaining()), exclude=tried)
+            xml.attrib['USERID'] = user_id
+            try:
+                root = self._exchange(xml, partial)
+            except (USPSXMLError, HTTPError) as error:
+                # Retry on another key when this one was refused, otherwise fail as usual
+                if not self.credentials.report(user_id, error) or len(tried) + 1 >= len(self.credentials):
+                    raise
+                tried.append(user_id)
+                continue
+            self.credentials.report(user_id)
+            return root
+
     @staticmethod
     def parse_xml(xml):
         items = list()
@@ -75,10 +213,153 @@ class USPSService(object):
             items.append(xmltodict(item))
         return items
 
+    def parse_results(self, xml):
+        """ Results for execute_batch, split_results and execute_cached.  The
+        same as parse_xml unless a service keeps nested parts of the response.
+        """
+        return self.parse_xml(xml)
+
     def execute(self, userid, object_dicts):
         xml = self.make_xml(userid, object_dicts)
         return self.parse_xml(self.submit_xml(xml))
 
+    def make_batch_xml(self, object_dicts):
+        """ Request xml for a batch of items, the same call for every batching service """
+        return self.make_xml(object_dicts)
+
+    def split_results(self, xml, root):
+        """ Pair every ID in the request xml with its parsed result or a
+        USPSXMLError, in request order.
+        """
+        positions = dict()
+        count = 0
+        for element in xml.iterchildren():
+            if element.get('ID') is not None:
+                positions.setdefault(element.get('ID'), deque()).append(count)
+                count += 1
+        if not count:
+            # A single item request without IDs, such as SDCGetLocations
+            error = root.find('.//Error')
+            return [USPSXMLError(error) if error is not None else self.parse_results(root)[0]]
+        results = [None] * count
+        for item in list(root.iterchildren()):
+            waiting = positions.get(item.get('ID'))
+            if not waiting:
+                continue
+            error = item.find('.//Error')
+            if error is not None:
+                results[waiting.popleft()] = USPSXMLError(error)
+                continue
+            # parse_results expects a response root, give it one holding just this item
+            single = Element(root.tag)
+            single.append(item)
+            results[waiting.popleft()] = self.parse_results(single)[0]
+        for item_id, waiting in positions.items():
+            for position in waiting:
+                results[position] = USPSXMLError({'Number': '', 'Source': self.API,
+                                                  'Description': 'No result for ID %s' % item_id})
+        return results
+
+    def execute_batch(self, object_dicts, partial=False):
+        """ With partial each item gets its result or its own USPSXMLError instead
+        of one bad item raising for the whole batch.
+        """
+        xml = self.make_batch_xml(object_dicts)
+        if not partial:
+            return self.parse_results(self.submit_xml(xml))
+        return self.split_results(xml, self.submit_xml(xml, partial=True))
+
+    def execute_columnar(self, object_dicts, format='numpy', partial=False):
+        """ Run object_dicts in batches of MAX_BATCH_SIZE and return the results
+        as columns, see usps.addressinformation.columnar.  With partial a
+        rejected item fills the Error column instead of raising.
+        """
+        if self.COLUMNS is None:
+            raise NotImplementedError('%s has no columnar result mode' % type(self).__name__)
+        columns = Columns(self.COLUMNS, errors=partial)
+        object_dicts = list(object_dicts)
+        for start in range(0, len(object_dicts), self.MAX_BATCH_SIZE):
+            chunk = object_dicts[start:start + self.MAX_BATCH_SIZE]
+            xml = self.make_batch_xml(chunk)
+            columns.add(self.submit_xml(xml, partial=partial), start, xml)
+        return columns.build(format)
+
+    def cache_key(self, object_dict):
+        """ Key for self.cache, None to never cache object_dict """
+        return json.dumps(object_dict, sort_keys=True, default=str)
+
+    def cached_result(self, object_dict, result):
+        """ Fit a result stored under object_dict's key to object_dict, called
+        on every execute_cached result.
+        """
+        return result
+
+    def execute_cached(self, object_dicts, partial=False):
+        """ Like execute_batch for any number of items.  Answers already in
+        self.cache are reused, the rest are requested once per distinct key in
+        batches of MAX_BATCH_SIZE and stored.  Item errors are never cached.
+        """
+        keys = list()
+        for index, object_dict in enumerate(object_dicts):
+            key = self.cache_key(object_dict)
+            # Items without a key are fetched on their own and never stored
+            keys.append((None, index) if key is None else key)
+        cacheable = [key for key in keys if isinstance(key, str)]
+        results = self._cache_get_many(cacheable, dict(zip(keys, object_dicts)))
+
+        missing = OrderedDict()
+        for key, object_dict in zip(keys, object_dicts):
+            if key not in results:
+                missing.setdefault(key, object_dict)
+        missing_keys = list(missing)
+        fetched = dict()
+        try:
+            for start in range(0, len(missing_keys), self.MAX_BATCH_SIZE):
+                chunk = missing_keys[start:start + self.MAX_BATCH_SIZE]
+                fetched.update(zip(chunk, self.execute_batch([missing[key] for key in chunk], partial)))
+        except Exception:
+            # Keep what earlier batches fetched, _cache_set_many never raises over the error
+            self._cache_set_many(fetched)
+            raise
+        self._cache_set_many(fetched)
+        results.update(fetched)
+        return [self.cached_result(object_dict, results[key]) for object_dict, key in zip(object_dicts, keys)]
+
+    def _cache_get_many(self, keys, by_key):
+        """ Cached results for keys.  A failing cache is logged and treated as empty """
+        if self.cache is None or not keys:
+            return dict()
+        try:
+            if isinstance(self.cache, RevalidatingCache):
+                return self.cache.get_many(keys, refresh=lambda stale: self._refetch([by_key[key] for key in stale]))
+            return self.cache.get_many(keys)
+        except Exception:
+            logger.warning('%s cache read failed, asking USPS', self.API, exc_info=True)
+            return dict()
+
+    def _cache_set_many(self, fetched):
+        """ Store the successful results in one write, shared caches pay a round
+        trip per set_many.  A failing cache is logged, never raised.
+        """
+        good = dict((key, result) for key, result in fetched.items()
+                    if isinstance(key, str) and not isinstance(result, USPSXMLError))
+        if self.cache is None or not good:
+            return
+        try:
+            self.cache.set_many(good)
+        except Exception:
+            logger.warning('%s cache write failed', self.API, exc_info=True)
+
+    def _refetch(self, object_dicts):
+        """ Fresh results for a RevalidatingCache, keyed by cache_key, rejected items left out """
+        fetched = dict()
+        for start in range(0, len(object_dicts), self.MAX_BATCH_SIZE):
+            chunk = object_dicts[start:start + self.MAX_BATCH_SIZE]
+            for object_dict, result in zip(chunk, self.execute_batch(chunk, partial=True)):
+                if not isinstance(result, USPSXMLError):
+                    fetched[self.cache_key(object_dict)] = result
+        return fetched
+
     def to_json(self, xml):
         return_dict = XTD.parse(etree.tostring(xml))
         return json.loads(json.dumps(return_dict))
@@ -116,11 +397,18 @@ class Address(USPSService):
 
     If an address is invalid (Doesn't exist) will raise USPSXMLError
 
+    Pass negative_cache=NegativeCache() to remember addresses USPS rejected, repeats
+    then raise USPSXMLError locally without a round trip, in validate_many too.
+
+    Pass normalize=True to rewrite addresses with the local Publication 28 normalizer
+    before they are sent, and cache=TTLCache() to reuse validated addresses.
+
     """
     SERVICE_NAME = 'AddressValidate'
     CHILD_XML_NAME = 'Address'
     API = 'Verify'
     USER_ID = ''
+    MAX_BATCH_SIZE = 5
     PARAMETERS = ['FirmName',
                   'Address1',
                   'Address2',
@@ -128,10 +416,31 @@ class Address(USPSService):
                   'State',
                   'Zip5',
                   'Zip4']
-
-    def __init__(self, user_id, *args, **kwargs):
+    COLUMNS = ColumnSpec('Address', [('FirmName', 'FirmName', 'str'),
+                                     ('Address1', 'Address1', 'str'),
+                                     ('Address2', 'Address2', 'str'),
+                                     ('City', 'City', 'str'),
+                                     ('State', 'State', 'str'),
+                                     ('Zip5', 'Zip5', 'str'),
+                                     ('Zip4', 'Zip4', 'str'),
+                                     ('DeliveryPoint', 'DeliveryPoint', 'str'),
+                                     ('CarrierRoute', 'CarrierRoute', 'str')])
+    # Error numbers that mean the address itself is bad, only these are negatively cached
+    NOT_FOUND_ERRORS = ['-2147219399',  # Invalid Zip Code
+                        '-2147219400',  # Invalid City
+                        '-2147219401',  # Address Not Found
+                        '-2147219402',  # Invalid State Code
+                        '-2147219403']  # Multiple addresses were found
+
+    def __init__(self, user_id, *args, negative_cache=None, normalize=False, **kwargs):
         super(Address, self).__init__(*args, **kwargs)
         self.USER_ID = user_id
+        self.negative_cache = negative_cache
+        self.normalize = normalize
+
+    def cache_key(self, address_dict):
+        """ Every spelling of the same address shares one key, see usps.addressinformation.normalize """
+        return canonical_key(address_dict)
 
     def format_response(self, address_dict, title_case):
         """ Format the response with title case.  Ensures
@@ -167,10 +476,63 @@ class Address(USPSService):
                         'State': state,
                         'Zip5': zip_5,
                         'Zip4': zip_4}
+        if self.normalize:
+            address_dict = normalize_address(address_dict)
+
+        key = None
+        if self.negative_cache is not None:
+            key = self.cache_key(address_dict)
+            info = self.negative_cache.get(key)
+            if info is not None:
+                raise USPSXMLError(info)
 
-        valid_address = self.execute(self.USER_ID, [address_dict])
+        try:
+            if self.cache is not None:
+                valid_address = [dict(result) for result in self.execute_cached([address_dict])]
+            else:
+                valid_address = self.execute(self.USER_ID, [address_dict])
+        except USPSXMLError as error:
+            if key is not None and error.info.get('Number') in self.NOT_FOUND_ERRORS:
+                self.negative_cache.add(key, error.info)
+            raise
         return self.format_response(valid_address[0], title_case)
 
+    def validate_many(self, address_dicts, title_case=False, partial=False):
+        """ Validate a list of address dicts (the PARAMETERS keys) in batches of
+        MAX_BATCH_SIZE, reading and filling self.cache with one call each.
+        Raises USPSXMLError if any address is rejected, with partial a rejected
+        address gets its USPSXMLError in place of the result instead.
+        """
+        if self.normalize:
+            address_dicts = normalize_many(address_dicts)
+        address_dicts = list(address_dicts)
+        refused = dict()
+        if self.negative_cache is not None:
+            for index, address_dict in enumerate(address_dicts):
+                info = self.negative_cache.get(self.cache_key(address_dict))
+                if info is not None:
+                    if not partial:
+                        raise USPSXMLError(info)
+                    refused[index] = USPSXMLError(info)
+        sent = [address_dict for index, address_dict in enumerate(address_dicts) if index not in refused]
+        answers = iter(self.execute_cached(sent, partial))
+        results = list()
+        for index, address_dict in enumerate(address_dicts):
+            if index in refused:
+                results.append(refused[index])
+                continue
+            result = next(answers)
+            if isinstance(result, USPSXMLError):
+                if self.negative_cache is not None and result.info.get('Number') in self.NOT_FOUND_ERRORS:
+                    self.negative_cache.add(self.cache_key(address_dict), result.info)
+                results.append(result)
+            else:
+                results.append(self.format_response(dict(result), title_case))
+        return results
+
+    def make_batch_xml(self, addresses):
+        return self.make_xml(self.USER_ID, addresses)
+
     def make_xml(self, userid, addresses):
         root = Element(self.SERVICE_NAME + 'Request')
         root.attrib['USERID'] = userid
@@ -182,6 +544,90 @@ class Address(USPSService):
         return root
 
 
+class CityStateLookup(USPSService):
+    """ City and state for a ZIP code, cheaper than a full Address validation.
+
+    city_state = CityStateLookup(user_id='YOUR_USER_ID')
+    city_state.lookup('80537')
+    {'Zip5': '80537', 'City': 'LOVELAND', 'State': 'CO'}
+
+    lookup_many packs up to MAX_BATCH_SIZE ZIP codes in each request.  Answers
+    are kept for a day in a TTLCache unless another cache is passed, and
+    anything that is not five digits is rejected without a round trip, so
+    it can be called on every keystroke of a ZIP field.
+    """
+    SERVICE_NAME = 'CityStateLookup'
+    CHILD_XML_NAME = 'ZipCode'
+    API = 'CityStateLookup'
+    USER_ID = ''
+    MAX_BATCH_SIZE = 5
+    COLUMNS = ColumnSpec('ZipCode', [('Zip5', 'Zip5', 'str'),
+                                     ('City', 'City', 'str'),
+                                     ('State', 'State', 'str')])
+    INVALID_ZIP_CODE = {'Number': '-2147219399', 'Source': 'CityStateLookup', 'Description': 'Invalid Zip Code.'}
+
+    def __init__(self, user_id, *args, cache=None, **kwargs):
+        super(CityStateLookup, self).__init__(*args, cache=cache if cache is not None else TTLCache(ttl=86400),
+                                              **kwargs)
+        self.USER_ID = user_id
+
+    def cache_key(self, zip_code):
+        return str(zip_code).strip()[:5]
+
+    def lookup(self, zip_code):
+        return self.lookup_many([zip_code])[0]
+
+    def lookup_many(self, zip_codes, partial=False):
+        """ One dict per ZIP code (ZIP+4 is accepted), in order.  Raises
+        USPSXMLError for a bad ZIP code, with partial it takes that result's
+        place instead.
+        """
+        zip_codes = [self.cache_key(zip_code) for zip_code in zip_codes]
+        valid = [zip_code for zip_code in zip_codes if len(zip_code) == 5 and zip_code.isdigit()]
+        if not partial and len(valid) < len(zip_codes):
+            raise USPSXMLError(self.INVALID_ZIP_CODE)
+        found = dict(zip(valid, self.execute_cached(valid, partial)))
+        results = list()
+        for zip_code in zip_codes:
+            result = found.get(zip_code, USPSXMLError(self.INVALID_ZIP_CODE))
+            # Cached dicts are shared, hand out copies
+            results.append(result if isinstance(result, USPSXMLError) else dict(result))
+        return results
+
+    def make_xml(self, zip_codes):
+        root = Element(self.SERVICE_NAME + 'Request')
+        root.attrib['USERID'] = self.USER_ID
+        for index, zip_code in enumerate(zip_codes):
+            element = SubElement(root, self.CHILD_XML_NAME, ID=str(index))
+            SubElement(element, 'Zip5').text = zip_code
+        return root
+
+
+class ZipCodeLookup(Address):
+    """ ZIP and ZIP+4 for a street address, the same input and result fields
+    as Address.
+
+    zip_code = ZipCodeLookup(user_id='YOUR_USER_ID')
+    zip_code.lookup(address2='500 E. third st', city='Loveland', state='CO')
+    {'Address2': '500 E 3RD ST', 'City': 'LOVELAND', 'State': 'CO', 'Zip5': '80537', 'Zip4': '5773', 'FullZip': '80537-5773'}
+
+    Batches up to MAX_BATCH_SIZE addresses per request and keeps answers for
+    a day in a TTLCache unless another cache is passed.
+    """
+    SERVICE_NAME = 'ZipCodeLookup'
+    API = 'ZipCodeLookup'
+
+    def __init__(self, user_id, *args, cache=None, **kwargs):
+        super(ZipCodeLookup, self).__init__(user_id, *args, cache=cache if cache is not None else TTLCache(ttl=86400),
+                                            **kwargs)
+
+    def lookup(self, firm_name='', address1='', address2='', city='', state='', zip_5='', title_case=False):
+        return self.validate(firm_name, address1, address2, city, state, zip_5, title_case=title_case)
+
+    def lookup_many(self, address_dicts, title_case=False, partial=False):
+        return self.validate_many(address_dicts, title_case, partial)
+
+
 #######################Rate API #############################################################
 
 class DomesticRate(USPSService):
@@ -190,6 +636,7 @@ class DomesticRate(USPSService):
     SERVICE_NAME = 'RateV4'
     API = 'RateV4'
     USER_ID = ''
+    MAX_BATCH_SIZE = 25
     PACKAGE_CHILD_XML_NAME = 'Package'
     PACKAGE_PARAMETERS = [
         'Service',
@@ -235,13 +682,60 @@ class DomesticRate(USPSService):
     SPECIAL_SERVICE_CHILD_XML_NAME = 'SpecialServices'
     SPECIAL_SERVICE_PARAMETERS = ['SpecialService']
 
+    # One row per Postage, a Service of ALL returns several per Package
+    COLUMNS = ColumnSpec('Package', [('ZipOrigination', 'ZipOrigination', 'str'),
+                                     ('ZipDestination', 'ZipDestination', 'str'),
+                                     ('Pounds', 'Pounds', 'float'),
+                                     ('Ounces', 'Ounces', 'float'),
+                                     ('Container', 'Container', 'str'),
+                                     ('Zone', 'Zone', 'int')],
+                         row='Postage', row_columns=[('CLASSID', '@CLASSID', 'int'),
+                                                     ('MailService', 'MailService', 'str'),
+                                                     ('Rate', 'Rate', 'float'),
+                                                     ('CommercialRate', 'CommercialRate', 'float')])
+
     CONTENT_CHILD_XML_NAME = 'Content'
     CONTENT_PARAMETERS = ['ContentType',
                           'ContentDescription']
 
-    def __init__(self, user_id, *args, **kwargs):
+    def __init__(self, user_id, *args, zone_matrix=None, **kwargs):
         super(DomesticRate, self).__init__(*args, **kwargs)
         self.USER_ID = user_id
+        self.zone_matrix = zone_matrix
+
+    def cache_key(self, package_dict):
+        """ With a ZoneMatrix the origin/destination pair is replaced by its zone,
+        so every package of the same service and weight to the same zone shares a key.
+        None, so the package is not cached, when the ZIPs are missing or malformed.
+        """
+        keys = self.PACKAGE_PARAMETERS
+        if self.zone_matrix is not None:
+            origin, destination = package_dict.get('ZipOrigination'), package_dict.get('ZipDestination')
+            if not origin or not destination:
+                return None
+            try:
+                zone = self.zone_matrix.zone(origin, destination)
+            except ValueError:
+                return None
+            if zone:
+                keys = [key for key in keys if key not in ('ZipOrigination', 'ZipDestination')]
+                return 'ZONE%d|%s' % (zone, cache_key(package_dict, keys))
+        return cache_key(package_dict, keys)
+
+    def cached_result(self, package_dict, result):
+        """ A zone keyed answer may have been fetched for other ZIPs, echo this package's """
+        if self.zone_matrix is None or not isinstance(result, dict):
+            return result
+        result = dict(result)
+        for key in ('ZipOrigination', 'ZipDestination'):
+            if key in result and package_dict.get(key) is not None:
+                result[key] = str(package_dict[key])
+        return result
+
+    @staticmethod
+    def parse_results(xml):
+        """ One dict per Package including the nested Postage and SpecialServices """
+        return [XTD.parse(etree.tostring(item))[item.tag] for item in xml]
 
     def make_xml(self, package_dicts):
         root = Element(self.SERVICE_NAME + 'Request')
@@ -281,6 +775,7 @@ class IntlRateV2(USPSService):
     SERVICE_NAME = "IntlRateV2"
     API = "IntlRateV2"
     USER_ID = ""
+    MAX_BATCH_SIZE = 25
     PACKAGE_CHILD_XML_NAME = 'Package'
     PACKAGE_PARAMETERS = [
         'Pounds',
@@ -329,9 +824,79 @@ class IntlRateV2(USPSService):
     CONTENT_CHILD_XML_NAME = 'Content'
     CONTENT_PARAMETERS = ['ContentType', 'ContentDescription']
 
-    def __init__(self, user_id, *args, **kwargs):
+    # Everything else that changes the quote, Pounds and Ounces are keyed as total ounces
+    CACHE_KEY_PARAMETERS = [
+        'Country',
+        'DestinationPostalCode',
+        'MailType',
+        'Container',
+        'Size',
+        'Width',
+        'Length',
+        'Height',
+        'Girth',
+        'Machinable',
+        'GXG',
+        'ValueOfContents',
+        'OriginZip',
+        'CommercialFlag',
+        'CommercialPlusFlag',
+        'ExtraServices',
+        'Content',
+        'AcceptanceDateTime',
+    ]
+
+    def __init__(self, user_id, *args, weight_bracket=1, **kwargs):
+        """ weight_bracket is in ounces, quote_destinations rounds weights up to a
+        multiple of it so parcels in the same bracket share cached quotes.  Most
+        international prices step per pound, weight_bracket=16 matches that.
+        """
         super(IntlRateV2, self).__init__(*args, **kwargs)
         self.USER_ID = user_id
+        self.weight_bracket = weight_bracket
+
+    def bracket(self, package_dict):
+        """ Copy of package_dict with the weight rounded up to the weight bracket """
+        ounces = float(package_dict.get('Pounds') or 0) * 16 + float(package_dict.get('Ounces') or 0)
+        ounces = math.ceil(round(ounces / self.weight_bracket, 6)) * self.weight_bracket
+        pounds = int(ounces // 16)
+        ounces = round(ounces - pounds * 16, 2)
+        bracketed = dict(package_dict)
+        bracketed['Pounds'] = pounds
+        bracketed['Ounces'] = int(ounces) if ounces == int(ounces) else ounces
+        return bracketed
+
+    def cache_key(self, package_dict):
+        """ Keyed on the weight actually sent, quote_destinations brackets it
+        before this is called.  None, so the package is not cached, when the
+        weight is not a number.
+        """
+        try:
+            ounces = float(package_dict.get('Pounds') or 0) * 16 + float(package_dict.get('Ounces') or 0)
+        except (TypeError, ValueError):
+            return None
+        return '%r|%s' % (round(ounces, 6), cache_key(package_dict, self.CACHE_KEY_PARAMETERS))
+
+    @staticmethod
+    def parse_results(xml):
+        """ One nested dict per Package in ID order, Service entries included """
+        packages = sorted(xml.iterchildren('Package'), key=lambda package: int(package.get('ID', 0)))
+        return [XTD.parse(etree.tostring(package))['Package'] for package in packages]
+
+    def quote_destinations(self, package_dict, destinations, partial=False):
+        """ Quote one parcel to many destinations, packing up to MAX_BATCH_SIZE
+        of them into each request.  destinations are country names or dicts with
+        Country and optionally DestinationPostalCode.  Returns the Package result
+        for each destination in the same order, from self.cache where possible.
+        With partial a destination USPS rejects gets its USPSXMLError instead.
+        """
+        package_dict = self.bracket(package_dict)
+        packages = list()
+        for destination in destinations:
+            if not isinstance(destination, dict):
+                destination = {'Country': destination}
+            packages.append(dict(package_dict, **destination))
+        return self.execute_cached(packages, partial)
 
     def make_xml(self, package_dicts):
         root = Element(self.SERVICE_NAME + 'Request')
@@ -375,13 +940,19 @@ class Track(USPSService):
     SERVICE_NAME = 'Track'
     API = 'TrackV2'
     USER_ID = ''
+    MAX_BATCH_SIZE = 10
     TRACK_CHILD_XML_NAME = 'TrackID'
     TRACK_PARAMETERS = []
+    COLUMNS = ColumnSpec('TrackInfo', [('TrackID', '@ID', 'str'),
+                                       ('TrackSummary', 'TrackSummary', 'str')])
 
     def __init__(self, user_id, *args, **kwargs):
         super(Track, self).__init__(*args, **kwargs)
         self.USER_ID = user_id
 
+    def cache_key(self, tracker_id):
+        return tracker_id
+
     def make_xml(self, tracker_ids):
         root = Element(self.SERVICE_NAME + 'Request')
         root.attrib['USERID'] = self.USER_ID
@@ -410,8 +981,12 @@ class CarrierPickupAvailability(USPSService):
         'Date'
     ]
 
-    def __init__(self, user_id, *args, **kwargs):
-        super(CarrierPickupAvailability, self).__init__(*args, **kwargs)
+    # Availability only changes per street, ZIP and day
+    CACHE_KEY_PARAMETERS = ['Address2', 'ZIP5', 'Date']
+
+    def __init__(self, user_id, *args, cache=None, **kwargs):
+        super(CarrierPickupAvailability, self).__init__(*args, cache=cache if cache is not None else TTLCache(ttl=3600),
+                                                        **kwargs)
         self.USER_ID = user_id
 
     def make_xml(self, pickup_availability_dict):
@@ -423,12 +998,77 @@ class CarrierPickupAvailability(USPSService):
 
         return root
 
+    def cache_key(self, pickup_availability_dict):
+        return cache_key(pickup_availability_dict, self.CACHE_KEY_PARAMETERS)
+
+    def check(self, pickup_availability_dict):
+        """ Look up a single location, returns the response fields as a dict """
+        return xmltodict(self.submit_xml(self.make_xml(pickup_availability_dict)))
+
+    def check_many(self, locations, max_workers=8, partial=True):
+        """ Check pickup availability for many locations concurrently.
+
+        At most max_workers lookups run at once and each (Address2, ZIP5, Date)
+        is only requested once, answers are kept in self.cache.  With partial
+        a failing location (USPS error, network failure or a response that
+        does not parse) does not abort the others, returns:
+
+        {'results': [result dict or None, ...], 'errors': {index: exception}}
+
+        Without partial the first failure is raised once every lookup is done.
+        """
+        keys = [self.cache_key(location) for location in locations]
+        # One read for all locations, a failing shared cache counts as empty
+        cached = self._cache_get_many(list(set(keys)), dict(zip(keys, locations)))
+        results = [cached.get(key) for key in keys]
+
+        pending = dict()
+        for index, key in enumerate(keys):
+            if results[index] is None and key not in pending:
+                pending[key] = locations[index]
+
+        fetched = dict()
+        failures = dict()
+        if pending:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                # Copy the context so a surrounding Deadline also covers the worker threads
+                futures = dict((key, executor.submit(contextvars.copy_context().run, self.check, location))
+                               for key, location in pending.items())
+            for key, future in futures.items():
+                try:
+                    fetched[key] = future.result()
+                except Exception as error:
+                    failures[key] = error
+            self._cache_set_many(fetched)
+
+        errors = dict()
+        for index, key in enumerate(keys):
+            if key in failures:
+                if not partial:
+                    raise failures[key]
+                errors[index] = failures[key]
+            else:
+                # Cached dicts are shared, hand out copies
+                results[index] = deepcopy(results[index] if results[index] is not None else fetched[key])
+        return {'results': results, 'errors': errors}
+
+    def _refetch(self, locations):
+        """ Fresh answers for a RevalidatingCache, one check per location, failures left out """
+        fetched = dict()
+        for location in locations:
+            try:
+                fetched[self.cache_key(location)] = self.check(location)
+            except Exception:
+                continue
+        return fetched
+
 
 class CarrierPickupSchedule(USPSService):
     # https://www.usps.com/business/web-tools-apis/package-pickup-api.htm
     SERVICE_NAME = 'CarrierPickupSchedule'
     API = "CarrierPickupSchedule"
     USER_ID = ''
+    IDEMPOTENT = False
     CARRIER_PICKUP_SCHEDULE = [
         'FirstName',
         'LastName',
@@ -478,6 +1118,7 @@ class CarrierPickupCancel(USPSService):
     SERVICE_NAME = 'CarrierPickupCancel'
     API = 'CarrierPickupCancel'
     USER_ID = ''
+    IDEMPOTENT = False
     CARRIER_PICKUP_CANCEL_PARAMETERS = [
         'FirmName',
         'SuiteOrApt',
@@ -507,6 +1148,7 @@ class CarrierPickupChange(USPSService):
     SERVICE_NAME = "CarrierPickupChange"
     API = "CarrierPickupChange"
     USER_ID = ''
+    IDEMPOTENT = False
     CARRIER_PICKUP_SCHEDULE = [
         'FirstName',
         'LastName',
@@ -607,6 +1249,22 @@ class MailService(USPSService):
         super(MailService, self).__init__(*args, **kwargs)
         self.USER_ID = user_id
 
+    def api_name(self, xml):
+        """ Each service name is its own API, taken from the request root """
+        return xml.tag[:-len('Request')]
+
+    def lookup(self, mail_service_dict, service_name):
+        """ The response as nested dicts, kept in self.cache when one is set """
+        return self.execute_cached([dict(mail_service_dict, ServiceName=service_name)])[0]
+
+    @staticmethod
+    def parse_results(xml):
+        return [XTD.parse(etree.tostring(xml))[xml.tag]]
+
+    def make_batch_xml(self, mail_service_dicts):
+        mail_service_dict, = mail_service_dicts
+        return self.make_xml(mail_service_dict, mail_service_dict['ServiceName'])
+
     def make_xml(self, mail_service_dict, service_name):
         if service_name in self.SERVICE_NAMES:
             root = Element(service_name + 'Request')
@@ -656,6 +1314,22 @@ class ServiceDelivery(USPSService):
         super(ServiceDelivery, self).__init__(*args, **kwargs)
         self.USER_ID = user_id
 
+    def cache_key(self, sdc_get_location_dict):
+        """ Responses list locations and dates for the exact ZIPs, so they are never shared by zone """
+        return cache_key(sdc_get_location_dict, self.SERVICE_DELIVERY_PARAMETERS)
+
+    def get_locations(self, sdc_get_location_dict):
+        """ The whole response as nested dicts, kept in self.cache when one is set """
+        return self.execute_cached([sdc_get_location_dict])[0]
+
+    @staticmethod
+    def parse_results(xml):
+        return [XTD.parse(etree.tostring(xml))[xml.tag]]
+
+    def make_batch_xml(self, sdc_get_location_dicts):
+        sdc_get_location_dict, = sdc_get_location_dicts
+        return self.make_xml(sdc_get_location_dict)
+
     def make_xml(self, sdc_get_location_dict):
         root = Element(self.SERVICE_NAME + 'Request')
         root.attrib['USERID'] = self.USER_ID
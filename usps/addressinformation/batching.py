@@ -0,0 +1,120 @@
+'''
+Latency driven batch sizing for the services that accept several items per
+request (Address, DomesticRate, IntlRateV2, Track).
+'''
+
+import threading
+import time
+from collections import deque
+
+
+class AdaptiveBatcher(object):
+    """ Splits items into requests sized for the most items per second while
+    each request stays within latency_target seconds.
+
+    Request latency is modelled as fixed + per_item * size from the last window
+    observations, so the best size is the largest one predicted to finish within
+    the target, never above service.MAX_BATCH_SIZE.  While the window holds a
+    single size the size grows by one under target and halves over it, and any
+    failed request halves it, which keeps the blast radius of bad items small.
+
+    batcher = AdaptiveBatcher(Address(user_id='YOUR_USER_ID'), latency_target=0.5)
+    results = batcher.run(address_dicts)
+    batcher.decisions()
+    """
+
+    def __init__(self, service, latency_target=1.0, max_size=None, initial_size=None, window=50,
+                 clock=time.monotonic):
+        self.service = service
+        self.latency_target = latency_target
+        self.max_size = min(max_size or service.MAX_BATCH_SIZE, service.MAX_BATCH_SIZE)
+        self.batch_size = min(initial_size or max(1, self.max_size // 2), self.max_size)
+        self.clock = clock
+        self.observations = deque(maxlen=window)
+        self.fixed = None
+        self.per_item = None
+        self.requests = 0
+        self.items = 0
+        self.failures = 0
+        self.busy = 0.0
+        self._lock = threading.Lock()
+
+    def run(self, items, partial=False):
+        """ Execute every item, returning the parsed results in order.  With
+        partial a rejected item gets its USPSXMLError in place of a result.
+        """
+        items = list(items)
+        results = list()
+        index = 0
+        while index < len(items):
+            batch = items[index:index + self.batch_size]
+            started = self.clock()
+            try:
+                if partial:
+                    results.extend(self.service.execute_batch(batch, partial=True))
+                else:
+                    results.extend(self.service.execute_batch(batch))
+            except Exception:
+                self.record_failure(len(batch))
+                raise
+            self.record(len(batch), self.clock() - started)
+            index += len(batch)
+        return results
+
+    def record(self, size, latency):
+        with self._lock:
+            self.requests += 1
+            self.items += size
+            self.busy += latency
+            self.observations.append((size, latency))
+            self._fit()
+            self.batch_size = self._choose(latency)
+
+    def record_failure(self, size):
+        with self._lock:
+            self.failures += 1
+            self.batch_size = max(1, self.batch_size // 2)
+
+    def _fit(self):
+        """ Least squares fit of latency = fixed + per_item * size """
+        count = len(self.observations)
+        mean_size = sum(size for size, _ in self.observations) / count
+        mean_latency = sum(latency for _, latency in self.observations) / count
+        variance = sum((size - mean_size) ** 2 for size, _ in self.observations)
+        if variance == 0:
+            self.fixed = self.per_item = None
+            return
+        covariance = sum((size - mean_size) * (latency - mean_latency) for size, latency in self.observations)
+        self.per_item = covariance / variance
+        self.fixed = max(0.0, mean_latency - self.per_item * mean_size)
+
+    def _choose(self, latency):
+        if self.per_item is None:
+            if latency > self.latency_target:
+                return max(1, self.batch_size // 2)
+            return min(self.max_size, self.batch_size + 1)
+        if self.per_item <= 0:
+            best = self.max_size
+        else:
+            best = int((self.latency_target - self.fixed) / self.per_item)
+        return max(1, min(self.max_size, best))
+
+    def predicted_latency(self, size):
+        if self.per_item is None:
+            return None
+        return self.fixed + self.per_item * size
+
+    def decisions(self):
+        """ Current state for monitoring """
+        with self._lock:
+            return {'api': self.service.API,
+                    'batch_size': self.batch_size,
+                    'max_size': self.max_size,
+                    'latency_target': self.latency_target,
+                    'fixed_latency': self.fixed,
+                    'per_item_latency': self.per_item,
+                    'predicted_latency': self.predicted_latency(self.batch_size),
+                    'requests': self.requests,
+                    'items': self.items,
+                    'failures': self.failures,
+                    'items_per_second': self.items / self.busy if self.busy else None}
@@ -0,0 +1,397 @@
+'''
+In-process caches used to avoid repeating USPS round trips.
+'''
+
+import hashlib
+import math
+import random
+import struct
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from usps.addressinformation.snapshot import CacheSnapshot
+
+
+class TTLCache(object):
+    """ Thread safe in-memory cache with a per entry time to live and
+    least recently used eviction once maxsize entries are stored.
+    """
+
+    def __init__(self, ttl=3600, maxsize=100000, clock=time.monotonic):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._dropped = set()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                entry = self._from_snapshot(key)
+            if entry is None:
+                return default
+            expires, value = entry
+            if expires <= self.clock():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = self.clock() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            if self._snapshot is not None and key not in self._dropped and self._snapshot.lookup(key) is not None:
+                # Once this write is evicted the older snapshot value must not come back
+                self._dropped.add(key)
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            if self._snapshot is not None:
+                self._dropped.add(key)
+
+    def get_many(self, keys):
+        """ Return a dict holding only the keys that were found. """
+        found = dict()
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                found[key] = value
+        return found
+
+    def set_many(self, mapping, ttl=None):
+        for key, value in mapping.items():
+            self.set(key, value, ttl)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._detach()
+
+    def items(self):
+        """ (key, value, seconds left) for every live entry, restored ones included """
+        now = self.clock()
+        with self._lock:
+            live = [(key, value, expires - now) for key, (expires, value) in self._data.items() if expires > now]
+            snapshot = self._snapshot
+        if snapshot is not None:
+            wall = time.time()
+            seen = set(key for key, _, _ in live)
+            live.extend((key, value, expires - wall) for key, value, expires in snapshot.items()
+                        if expires > wall and key not in seen and key not in self._dropped)
+        return live
+
+    def snapshot(self, path):
+        """ Write every live entry to path, returns the number written """
+        wall = time.time()
+        return CacheSnapshot.write(path, ((key, value, wall + left) for key, value, left in self.items()))
+
+    def restore(self, path):
+        """ Serve misses from the snapshot at path.  The file is only mapped,
+        entries are copied into memory with their remaining time to live the
+        first time they are read.
+        """
+        snapshot = CacheSnapshot(path)
+        with self._lock:
+            self._detach()
+            self._snapshot = snapshot
+        return len(snapshot)
+
+    def _from_snapshot(self, key):
+        # Called with the lock held
+        if self._snapshot is None or key in self._dropped:
+            return None
+        found = self._snapshot.lookup(key)
+        if found is None:
+            return None
+        value, expires = found
+        left = expires - time.time()
+        if left <= 0:
+            return None
+        entry = (self.clock() + left, value)
+        self._data[key] = entry
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+        return entry
+
+    def _detach(self):
+        if self._snapshot is not None:
+            self._snapshot.close()
+            self._snapshot = None
+        self._dropped = set()
+
+
+class BloomFilter(object):
+    """ Fixed size probabilistic set.  Membership tests may return false
+    positives at roughly error_rate but never false negatives.
+
+    At a 1% error rate each entry costs about 9.6 bits, so ten million
+    fingerprints fit in 12MB; at 5% it is about 6.2 bits per entry.
+    """
+    MAGIC = b'USBF'
+    HEADER = struct.Struct('<4sQIQ')
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf8'), digest_size=16).digest()
+        first, second = struct.unpack('<QQ', digest)
+        for i in range(self.num_hashes):
+            yield (first + i * second) % self.num_bits
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        for position in self._positions(key):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def saturated(self):
+        """ More keys than capacity were added, false positives exceed error_rate """
+        return self.count > self.capacity
+
+    def empty(self):
+        """ A new, empty filter of the same size """
+        bloom = self.__class__.__new__(self.__class__)
+        bloom.__dict__.update(self.__dict__)
+        bloom.bits = bytearray(len(self.bits))
+        bloom.count = 0
+        return bloom
+
+    def save(self, path):
+        with open(path, 'wb') as output:
+            output.write(self.HEADER.pack(self.MAGIC, self.num_bits, self.num_hashes, self.count))
+            output.write(self.bits)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as source:
+            magic, num_bits, num_hashes, count = cls.HEADER.unpack(source.read(cls.HEADER.size))
+            if magic != cls.MAGIC:
+                raise ValueError('%s is not a bloom filter file' % path)
+            bits = bytearray(source.read())
+        if num_bits < 1 or num_hashes < 1 or len(bits) != (num_bits + 7) // 8:
+            raise ValueError('%s is truncated or corrupt, expected %d bytes of bits and found %d'
+                             % (path, (num_bits + 7) // 8, len(bits)))
+        bloom = cls.__new__(cls)
+        bloom.num_bits = num_bits
+        bloom.num_hashes = num_hashes
+        bloom.count = count
+        # Recovered from the optimal hash count, k = bits / capacity * ln 2
+        bloom.capacity = max(1, int(num_bits * math.log(2) / num_hashes))
+        bloom.error_rate = 0.5 ** num_hashes
+        bloom.bits = bits
+        return bloom
+
+
+class NegativeCache(object):
+    """ Remembers requests that USPS rejected so repeats can be refused locally.
+
+    Failures are kept with their USPSXMLError info in a TTLCache for ttl
+    seconds.  An optional BloomFilter behind it holds far more fingerprints
+    than the TTLCache can and survives restarts with save() and load(), a
+    key it holds but the TTLCache no longer has is refused with BLOOM_ERROR.
+    Roughly error_rate of never rejected keys are refused that way too, pass
+    trust_bloom=False to have bloom hits only confirmed against the TTLCache.
+    The filter is replaced by an empty one every bloom_ttl seconds (ttl by
+    default), or as soon as it fills to its capacity, and the previous one is
+    still checked until the next replacement.
+    """
+    BLOOM_ERROR = {'Number': '', 'Source': 'NegativeCache', 'Description': 'Previously rejected by USPS.'}
+
+    def __init__(self, ttl=86400, maxsize=100000, bloom=None, clock=time.monotonic, trust_bloom=True,
+                 bloom_ttl=None):
+        self.errors = TTLCache(ttl=ttl, maxsize=maxsize, clock=clock)
+        self.ttl = ttl
+        self.bloom_ttl = ttl if bloom_ttl is None else bloom_ttl
+        self.clock = clock
+        self.bloom = bloom
+        self.trust_bloom = trust_bloom
+        self.previous = None
+        self.rotated = clock()
+        self._lock = threading.Lock()
+
+    def _rotate(self):
+        now = self.clock()
+        # Replaced once full, so the filter never goes past its error_rate
+        if now - self.rotated >= self.bloom_ttl or len(self.bloom) >= self.bloom.capacity:
+            self.previous = self.bloom
+            self.bloom = self.bloom.empty()
+            self.rotated = now
+
+    def add(self, key, info):
+        self.errors.set(key, info)
+        if self.bloom is not None:
+            with self._lock:
+                self._rotate()
+                self.bloom.add(key)
+
+    def get(self, key):
+        """ The info of the rejection remembered for key, None if there is none """
+        if self.bloom is not None:
+            with self._lock:
+                self._rotate()
+                maybe = key in self.bloom or (self.previous is not None and key in self.previous)
+            if not maybe:
+                return None
+        info = self.errors.get(key)
+        if info is None and self.bloom is not None and self.trust_bloom:
+            return dict(self.BLOOM_ERROR)
+        return info
+
+
+class RevalidatingCache(object):
+    """ Stale-while-revalidate in front of a TTLCache or shared backend.
+
+    cache = RevalidatingCache(TTLCache(maxsize=500000), ttl=3600, grace=600)
+    rate = DomesticRate(user_id='YOUR_USER_ID', cache=cache)
+
+    Entries are fresh for ttl seconds and then served stale for up to grace
+    more while a single background refresh per key asks USPS again.  Each read
+    of a fresh entry may also refresh it early with a probability that rises
+    as expiry nears (the XFetch rule, scaled by beta and the recent refresh
+    time), so hot keys written together do not all go stale together.
+    Services pass refresh to get_many, a callable taking a list of keys and
+    returning a dict of new values.
+    """
+
+    def __init__(self, cache=None, ttl=3600, grace=300, beta=1.0, max_workers=4, clock=time.time,
+                 random=random.random):
+        self.cache = cache if cache is not None else TTLCache(ttl=ttl + grace)
+        self.ttl = ttl
+        self.grace = grace
+        self.beta = beta
+        self.clock = clock
+        self.random = random
+        self.delta = 1.0  # Moving average of refresh time in seconds
+        self.refreshes = 0
+        self.early_refreshes = 0
+        self.refresh_errors = 0
+        self._refreshing = set()
+        self._futures = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='usps-revalidate')
+
+    def __len__(self):
+        return len(self.cache)
+
+    def _early(self, fresh_until, now):
+        if self.beta <= 0:
+            return False
+        # XFetch: -log(random) is exponentially distributed with mean 1
+        return now - self.delta * self.beta * math.log(max(self.random(), 1e-12)) >= fresh_until
+
+    def get_many(self, keys, refresh=None):
+        """ Return a dict of the values found, fresh or stale.  Stale keys, and
+        keys picked for early refresh, are refreshed in the background when
+        refresh is given and no refresh for them is already running.
+        """
+        found = dict()
+        stale = list()
+        early = 0
+        now = self.clock()
+        for key, envelope in self.cache.get_many(keys).items():
+            found[key] = envelope['value']
+            if refresh is None:
+                continue
+            if now >= envelope['fresh_until']:
+                stale.append(key)
+            elif self._early(envelope['fresh_until'], now):
+                stale.append(key)
+                early += 1
+        if stale:
+            with self._lock:
+                self.early_refreshes += early
+                stale = [key for key in stale if key not in self._refreshing]
+                self._refreshing.update(stale)
+            if stale:
+                future = self._executor.submit(self._refresh, stale, refresh)
+                with self._lock:
+                    self._futures.add(future)
+                future.add_done_callback(self._done)
+        return found
+
+    def _done(self, future):
+        with self._lock:
+            self._futures.discard(future)
+
+    def _refresh(self, keys, refresh):
+        started = self.clock()
+        try:
+            self.set_many(refresh(keys))
+            with self._lock:
+                self.refreshes += 1
+                self.delta = 0.8 * self.delta + 0.2 * (self.clock() - started)
+        except Exception:
+            # Keep serving the stale value, the next read past expiry tries again
+            with self._lock:
+                self.refresh_errors += 1
+        finally:
+            with self._lock:
+                self._refreshing.difference_update(keys)
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def set_many(self, mapping, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        fresh_until = self.clock() + ttl
+        self.cache.set_many(dict((key, {'value': value, 'fresh_until': fresh_until})
+                                 for key, value in mapping.items()), ttl + self.grace)
+
+    def set(self, key, value, ttl=None):
+        self.set_many({key: value}, ttl)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+    def clear(self):
+        self.cache.clear()
+
+    def wait(self, timeout=None):
+        """ Block until the refreshes already started have finished, or timeout
+        seconds have passed.  Returns True if none is left running.
+        """
+        with self._lock:
+            pending = set(self._futures)
+        return not wait(pending, timeout).not_done
+
+    def stats(self):
+        with self._lock:
+            return {'refreshes': self.refreshes,
+                    'early_refreshes': self.early_refreshes,
+                    'refresh_errors': self.refresh_errors,
+                    'refreshing': len(self._refreshing),
+                    'delta': self.delta}
+
+    def close(self):
+        self._executor.shutdown(wait=False)
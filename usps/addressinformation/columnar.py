@@ -0,0 +1,167 @@
+'''
+Column oriented results for bulk Address, DomesticRate and Track calls.
+
+validated = address_validation.execute_columnar(address_dicts)
+validated['Zip4'], validated['Index']
+
+rates = rate.execute_columnar(package_dicts, format='arrow')
+
+Field text is appended straight from the response XML to one list per
+column, without a dict per item, and converted to typed arrays once at the
+end: a NumPy structured array (format='numpy', the default), a pyarrow
+RecordBatch (format='arrow', needs pyarrow) or a dict of lists
+(format='columns', no dependencies).  Index is the position of the item in
+the input, matched by ID whatever order USPS answers in.  Missing numbers
+are NaN for floats and -1 for integers in NumPy, null in Arrow.  With
+partial=True rejected items are kept as one row with an Error column.
+'''
+
+from collections import deque
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+try:
+    import pyarrow as pa
+except ImportError:  # pragma: no cover
+    pa = None
+
+FORMATS = ('numpy', 'arrow', 'columns')
+NUMPY_TYPES = {'str': 'U', 'int': 'i8', 'float': 'f8', 'bool': '?'}
+MISSING = {'int': '-1', 'float': 'nan'}
+
+
+class ColumnSpec(object):
+    """ Where each column comes from in a response.
+
+    item is the tag of one result per input item, columns are (name, path,
+    type) read relative to it, path '@NAME' reads an attribute.  With row set,
+    every matching child of an item becomes its own row and row_columns are
+    read relative to that child, for example one row per Postage of a Package.
+    type is one of str, int, float or bool.
+    """
+
+    def __init__(self, item, columns, row=None, row_columns=()):
+        self.item = item
+        self.columns = list(columns)
+        self.row = row
+        self.row_columns = list(row_columns)
+
+    @property
+    def names(self):
+        return ['Index'] + [column[0] for column in self.columns + self.row_columns]
+
+    @property
+    def types(self):
+        return ['int'] + [column[2] for column in self.columns + self.row_columns]
+
+
+def _read(element, path):
+    if path.startswith('@'):
+        return element.get(path[1:])
+    return element.findtext(path)
+
+
+class Columns(object):
+    """ Accumulates the columns of one or more batch responses.  With errors
+    an Error column holds the Description of each item USPS rejected, that
+    item gets one row with every other column missing.
+    """
+
+    def __init__(self, spec, errors=False):
+        self.spec = spec
+        self.errors = errors
+        self.names = spec.names + (['Error'] if errors else [])
+        self.types = spec.types + (['str'] if errors else [])
+        self.data = [list() for _ in self.names]
+
+    def __len__(self):
+        return len(self.data[0])
+
+    def add(self, root, offset=0, request=None):
+        """ Append the items of a response root, offset is the input position
+        of its first item.  Items are placed by their ID attribute, looked up
+        in the request xml when given (Track IDs are the tracking numbers) and
+        read as a number otherwise, like split_results does.
+        """
+        spec = self.spec
+        index_column = self.data[0]
+        item_columns = self.data[1:1 + len(spec.columns)]
+        row_columns = self.data[1 + len(spec.columns):len(spec.names)]
+        error_column = self.data[-1] if self.errors else None
+        positions = dict()
+        if request is not None:
+            for position, element in enumerate(element for element in request.iterchildren()
+                                               if element.get('ID') is not None):
+                positions.setdefault(element.get('ID'), deque()).append(position)
+        for position, item in enumerate(root.iterchildren(spec.item)):
+            item_id = item.get('ID')
+            if positions.get(item_id):
+                position = positions[item_id].popleft()
+            elif request is None and item_id is not None and item_id.isdigit():
+                position = int(item_id)
+            error = item.find('.//Error')
+            if error is not None and error_column is not None:
+                index_column.append(offset + position)
+                for column in item_columns + row_columns:
+                    column.append(None)
+                error_column.append(error.findtext('Description') or '')
+                continue
+            item_values = [_read(item, path) for _, path, _ in spec.columns]
+            rows = [item] if spec.row is None else item.iterfind(spec.row)
+            for row in rows:
+                index_column.append(offset + position)
+                for column, value in zip(item_columns, item_values):
+                    column.append(value)
+                for column, (_, path, _) in zip(row_columns, spec.row_columns):
+                    column.append(_read(row, path))
+                if error_column is not None:
+                    error_column.append(None)
+
+    def to_columns(self):
+        return dict(zip(self.names, self.data))
+
+    def to_numpy(self):
+        if np is None:
+            raise ImportError('numpy is required for format="numpy", pip install numpy')
+        arrays = list()
+        for values, kind in zip(self.data, self.types):
+            if values is self.data[0]:
+                arrays.append(np.array(values, dtype='i8'))
+            elif kind == 'str':
+                arrays.append(np.array([value or '' for value in values], dtype='U'))
+            elif kind == 'bool':
+                arrays.append(np.char.lower(np.array([value or '' for value in values], dtype='U')) == 'true')
+            else:
+                strings = np.array([value or MISSING[kind] for value in values], dtype='U')
+                arrays.append(strings.astype(NUMPY_TYPES[kind]))
+        dtype = [(name, array.dtype.str if array.dtype.kind == 'U' else NUMPY_TYPES[kind])
+                 for name, kind, array in zip(self.names, self.types, arrays)]
+        table = np.zeros(len(self), dtype=dtype)
+        for name, array in zip(self.names, arrays):
+            if len(array):
+                table[name] = array
+        return table
+
+    def to_arrow(self):
+        if pa is None:
+            raise ImportError('pyarrow is required for format="arrow", pip install pyarrow')
+        types = {'str': pa.string(), 'int': pa.int64(), 'float': pa.float64(), 'bool': pa.bool_()}
+        arrays = list()
+        for values, kind in zip(self.data, self.types):
+            if values is self.data[0]:
+                arrays.append(pa.array(values, type=pa.int64()))
+                continue
+            if kind != 'str':
+                # An empty field is a missing value, as MISSING is for NumPy
+                values = [value if value else None for value in values]
+            array = pa.array(values, type=pa.string())
+            arrays.append(array if array.type == types[kind] else array.cast(types[kind]))
+        return pa.RecordBatch.from_arrays(arrays, names=self.names)
+
+    def build(self, format='numpy'):
+        if format not in FORMATS:
+            raise ValueError('format must be one of %s' % ', '.join(FORMATS))
+        return getattr(self, 'to_' + format)()
@@ -0,0 +1,151 @@
+'''
+Spread requests over several USPS Web Tools USERIDs.
+
+pool = CredentialPool(['USERID1', 'USERID2'], rate=5)
+pool.add('USERID3', weight=2, rate=10)
+address_validation = Address(user_id='USERID1', credentials=pool)
+
+Each key has its own token bucket (rate requests per second, None for no
+limit) and keys are picked by smooth weighted round robin among those with a
+token.  A key that gets an authorization or throttling error is cooled down
+for cooldown seconds and the request is retried on another key.
+'''
+
+import threading
+import time
+
+from urllib.error import HTTPError
+
+
+class USPSCredentialsExhausted(Exception):
+    pass
+
+
+class Credential(object):
+
+    def __init__(self, user_id, weight=1, rate=None, burst=None):
+        self.user_id = user_id
+        self.weight = weight
+        self.rate = rate
+        self.burst = burst or max(1.0, rate or 1.0)
+        self.tokens = self.burst
+        self.updated = None
+        self.current = 0
+        self.cooldown_until = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.cooldowns = 0
+        self.waited = 0.0
+
+    def refill(self, now):
+        if self.rate is not None and self.updated is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """ Seconds until this key may be used again """
+        cooling = max(0.0, self.cooldown_until - now)
+        if self.rate is None or self.tokens >= 1:
+            return cooling
+        return max(cooling, (1 - self.tokens) / self.rate)
+
+    def metrics(self):
+        return {'weight': self.weight,
+                'rate': self.rate,
+                'requests': self.requests,
+                'errors': self.errors,
+                'cooldowns': self.cooldowns,
+                'waited': self.waited}
+
+
+class CredentialPool(object):
+    # Matched against USPSXMLError descriptions, lower case
+    COOLDOWN_ERRORS = ('authorization failure', 'not authorized', 'throttl', 'rate limit', 'too many requests')
+    COOLDOWN_STATUS = (401, 403, 429, 503)
+
+    def __init__(self, user_ids=(), weight=1, rate=None, cooldown=60, clock=time.monotonic, sleep=time.sleep):
+        self.cooldown = cooldown
+        self.clock = clock
+        self.sleep = sleep
+        self.credentials = dict()
+        self._lock = threading.Lock()
+        for user_id in user_ids:
+            self.add(user_id, weight=weight, rate=rate)
+
+    def __len__(self):
+        return len(self.credentials)
+
+    def add(self, user_id, weight=1, rate=None, burst=None):
+        with self._lock:
+            self.credentials[user_id] = Credential(user_id, weight, rate, burst)
+
+    def _pick(self, now, exclude):
+        candidates = list()
+        for credential in self.credentials.values():
+            credential.refill(now)
+            if credential.user_id not in exclude and credential.wait_time(now) == 0:
+                candidates.append(credential)
+        if not candidates:
+            return None
+        total = 0
+        for credential in candidates:
+            credential.current += credential.weight
+            total += credential.weight
+        chosen = max(candidates, key=lambda credential: credential.current)
+        chosen.current -= total
+        if chosen.rate is not None:
+            chosen.tokens -= 1
+        chosen.requests += 1
+        return chosen
+
+    def acquire(self, timeout=None, exclude=()):
+        """ Return the USERID to use next, waiting for a token if every key is
+        busy.  Raises USPSCredentialsExhausted when none frees up within timeout.
+        """
+        started = self.clock()
+        while True:
+            with self._lock:
+                now = self.clock()
+                chosen = self._pick(now, exclude)
+                if chosen is not None:
+                    chosen.waited += now - started
+                    return chosen.user_id
+                waits = [credential.wait_time(now) for credential in self.credentials.values()
+                         if credential.user_id not in exclude]
+            if not waits:
+                raise USPSCredentialsExhausted('No USPS credentials left to try')
+            delay = min(waits)
+            if timeout is not None and now + delay > started + timeout:
+                raise USPSCredentialsExhausted('No USPS credentials available within %.3fs' % timeout)
+            self.sleep(delay)
+
+    def should_cool_down(self, error):
+        if isinstance(error, HTTPError):
+            return error.code in self.COOLDOWN_STATUS
+        info = getattr(error, 'info', None)
+        if isinstance(info, dict):
+            description = (info.get('Description') or '').lower()
+            return any(text in description for text in self.COOLDOWN_ERRORS)
+        return False
+
+    def report(self, user_id, error=None):
+        """ Record the outcome of a request, returns True when the key was cooled down """
+        if error is None:
+            return False
+        with self._lock:
+            credential = self.credentials[user_id]
+            credential.errors += 1
+            if not self.should_cool_down(error):
+                return False
+            credential.cooldowns += 1
+            credential.cooldown_until = self.clock() + self.cooldown
+            return True
+
+    def metrics(self):
+        with self._lock:
+            now = self.clock()
+            metrics = dict()
+            for user_id, credential in self.credentials.items():
+                metrics[user_id] = credential.metrics()
+                metrics[user_id]['cooling_down'] = credential.cooldown_until > now
+            return metrics
@@ -0,0 +1,74 @@
+'''
+End-to-end time budgets for USPS calls.
+
+with Deadline(0.3):
+    address_validation.validate(address2='500 E. third st', city='Loveland', state='CO')
+
+Every request made inside the block, including each batch of a batched call
+and the parsing of each response, draws on the same budget.  Socket timeouts
+are capped at the time left and once it is spent USPSDeadlineExceeded is
+raised instead of starting more work.
+'''
+
+import contextvars
+import time
+
+_current = contextvars.ContextVar('usps_deadline', default=None)
+
+
+class USPSDeadlineExceeded(TimeoutError):
+    pass
+
+
+def current_deadline():
+    """ The innermost Deadline in effect, or None """
+    return _current.get()
+
+
+class Deadline(object):
+    """ seconds start counting when the with block is entered, so a Deadline
+    can be built ahead of time and reused for several blocks.
+    """
+
+    def __init__(self, seconds, clock=time.monotonic):
+        self.seconds = seconds
+        self.clock = clock
+        self.expires = None
+        self._tokens = list()
+
+    def __enter__(self):
+        # Re-entering a block that is already running keeps its budget
+        if not self._tokens:
+            self.expires = self.clock() + self.seconds
+            outer = current_deadline()
+            # A nested budget can never outlive the one around it
+            if outer is not None and outer.expires < self.expires:
+                self.expires = outer.expires
+        self._tokens.append(_current.set(self))
+        return self
+
+    def __exit__(self, *exc_info):
+        _current.reset(self._tokens.pop())
+
+    def remaining(self):
+        if self.expires is None:
+            return self.seconds
+        return self.expires - self.clock()
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+    def check(self, step='request'):
+        if self.expired:
+            raise USPSDeadlineExceeded('Deadline of %.3fs exceeded before %s' % (self.seconds, step))
+
+    def limit(self, timeout):
+        """ Cap a timeout (None, seconds or (connect, read)) at the time left """
+        self.check()
+        remaining = self.remaining()
+        if isinstance(timeout, tuple):
+            return tuple(remaining if value is None else min(value, remaining) for value in timeout)
+        if timeout is None:
+            return remaining
+        return min(timeout, remaining)
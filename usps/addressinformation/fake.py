@@ -0,0 +1,357 @@
+'''
+Deterministic stand-in for the USPS Web Tools server.
+
+respond(api, xml) answers a request the way USPS would, without a network,
+for tests, benchmarks and local load testing.  Addresses without an Address2
+are reported as not found and tracking numbers starting with "0" as unknown
+so error paths can be exercised too, as are ZIP codes starting with "000"
+in CityStateLookup.
+
+FakeUSPSServer serves respond() over loopback HTTP for end-to-end runs and
+FakeRedisServer is an in-process server speaking enough of the Redis
+protocol for RedisCache.
+'''
+
+import fnmatch
+import random
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from lxml import etree
+from lxml.etree import SubElement, Element
+
+
+CITY_STATES = {'80537': ('LOVELAND', 'CO'), '20770': ('GREENBELT', 'MD'), '44106': ('CLEVELAND', 'OH'),
+               '90210': ('BEVERLY HILLS', 'CA'), '10001': ('NEW YORK', 'NY')}
+
+
+def _error(parent, number, description, source='clsAMS'):
+    error = SubElement(parent, 'Error')
+    SubElement(error, 'Number').text = number
+    SubElement(error, 'Source').text = source
+    SubElement(error, 'Description').text = description
+    SubElement(error, 'HelpFile')
+    SubElement(error, 'HelpContext')
+    return error
+
+
+def _number(element, tag):
+    try:
+        return float(element.findtext(tag) or 0)
+    except ValueError:
+        return 0.0
+
+
+def fake_zone(origin, destination):
+    """ A stable, made up zone between 1 and 8 for two ZIP codes """
+    try:
+        return 1 + abs(int(str(origin)[:3]) - int(str(destination)[:3])) % 8
+    except ValueError:
+        return 1
+
+
+def fake_postage(zone, pounds, ounces):
+    return '%.2f' % (4.5 + zone * 0.75 + pounds * 1.1 + ounces * 0.07)
+
+
+def _verify(request, response):
+    for address in request.iter('Address'):
+        item = SubElement(response, 'Address', ID=address.get('ID', '0'))
+        if not (address.findtext('Address2') or '').strip():
+            _error(item, '-2147219401', 'Address Not Found.')
+            continue
+        for tag in ('FirmName', 'Address1', 'Address2', 'City', 'State'):
+            text = address.findtext(tag)
+            if text:
+                SubElement(item, tag).text = ' '.join(text.upper().replace('.', '').split())
+        SubElement(item, 'Zip5').text = (address.findtext('Zip5') or '80537')[:5]
+        SubElement(item, 'Zip4').text = address.findtext('Zip4') or '%04d' % (len(address.findtext('Address2')) * 97 % 10000)
+
+
+def _city_state(request, response):
+    for zip_code in request.iter('ZipCode'):
+        item = SubElement(response, 'ZipCode', ID=zip_code.get('ID', '0'))
+        zip5 = zip_code.findtext('Zip5') or ''
+        if zip5.startswith('000'):
+            _error(item, '-2147219399', 'Invalid Zip Code.')
+            continue
+        city, state = CITY_STATES.get(zip5, ('TOWN %s' % zip5[:3], 'CO'))
+        SubElement(item, 'Zip5').text = zip5
+        SubElement(item, 'City').text = city
+        SubElement(item, 'State').text = state
+
+
+def _rate(request, response):
+    for package in request.iter('Package'):
+        item = SubElement(response, 'Package', ID=package.get('ID', '0'))
+        origin = package.findtext('ZipOrigination') or ''
+        destination = package.findtext('ZipDestination') or ''
+        zone = fake_zone(origin, destination)
+        for tag in ('ZipOrigination', 'ZipDestination', 'Pounds', 'Ounces', 'Container', 'Machinable'):
+            if package.find(tag) is not None:
+                SubElement(item, tag).text = package.findtext(tag)
+        SubElement(item, 'Zone').text = str(zone)
+        postage = SubElement(item, 'Postage', CLASSID='1')
+        SubElement(postage, 'MailService').text = package.findtext('Service') or 'PRIORITY'
+        SubElement(postage, 'Rate').text = fake_postage(zone, _number(package, 'Pounds'), _number(package, 'Ounces'))
+
+
+def _intl_rate(request, response):
+    for package in request.iter('Package'):
+        item = SubElement(response, 'Package', ID=package.get('ID', '0'))
+        SubElement(item, 'Prohibitions').text = 'None'
+        country = package.findtext('Country') or ''
+        zone = 1 + sum(country.encode('utf8')) % 8
+        for service_id, description in (('1', 'Priority Mail Express International'),
+                                        ('2', 'Priority Mail International')):
+            service = SubElement(item, 'Service', ID=service_id)
+            SubElement(service, 'Pounds').text = package.findtext('Pounds')
+            SubElement(service, 'Ounces').text = package.findtext('Ounces')
+            SubElement(service, 'MailType').text = package.findtext('MailType')
+            SubElement(service, 'Country').text = country.upper()
+            SubElement(service, 'Postage').text = fake_postage(zone * int(service_id) + 10,
+                                                               _number(package, 'Pounds'),
+                                                               _number(package, 'Ounces'))
+            SubElement(service, 'SvcDescription').text = description
+
+
+def _track(request, response):
+    for track_id in request.iter('TrackID'):
+        number = track_id.get('ID', '')
+        item = SubElement(response, 'TrackInfo', ID=number)
+        if number.startswith('0'):
+            _error(item, '-2147219283', 'A status update is not yet available on your package.', 'clsTrack')
+            continue
+        SubElement(item, 'TrackSummary').text = 'Your item was delivered at 12:00 pm.'
+
+
+def _pickup_availability(request, response):
+    for child in request:
+        SubElement(response, child.tag).text = child.text
+    SubElement(response, 'DayOfWeek').text = 'Monday'
+    SubElement(response, 'Date').text = request.findtext('Date') or '2030-01-07'
+    SubElement(response, 'CarrierRoute').text = 'C001'
+
+
+def _echo(request, response):
+    for child in request:
+        response.append(etree.fromstring(etree.tostring(child)))
+
+
+HANDLERS = {
+    'Verify': _verify,
+    'ZipCodeLookup': _verify,
+    'CityStateLookup': _city_state,
+    'RateV4': _rate,
+    'IntlRateV2': _intl_rate,
+    'TrackV2': _track,
+    'CarrierPickupAvailability': _pickup_availability,
+}
+
+
+def respond(api, xml):
+    """ Build the response bytes USPS would send for the request xml """
+    request = etree.fromstring(xml)
+    if not request.get('USERID'):
+        root = Element('Error')
+        for tag, text in (('Number', '80040B1A'), ('Source', 'USPSCOM::DoAuth'),
+                          ('Description', 'Authorization failure.  Perhaps username and/or password is incorrect.')):
+            SubElement(root, tag).text = text
+        return etree.tostring(root, xml_declaration=True, encoding='UTF-8')
+
+    name = request.tag[:-len('Request')] if request.tag.endswith('Request') else request.tag
+    response = Element(name + 'Response')
+    HANDLERS.get(api, _echo)(request, response)
+    return etree.tostring(response, xml_declaration=True, encoding='UTF-8')
+
+
+class _USPSHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes, without this every keep-alive
+    # response waits out the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def _answer(self, form):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency * (0.5 + server.random.random()))
+        with server.lock:
+            server.requests += 1
+            failed = server.random.random() < server.error_rate
+        if failed:
+            self.send_error(503, 'Service Unavailable')
+            return
+        body = respond(form['API'][0], form['XML'][0].encode('utf8'))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self._answer(parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode('utf8')))
+
+    def do_GET(self):
+        self._answer(parse_qs(urlsplit(self.path).query))
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeUSPSServer(ThreadingHTTPServer):
+    """ respond() behind a loopback ShippingAPI.dll endpoint.  latency adds a
+    random 0.5x-1.5x delay per request and error_rate answers that share of
+    requests with HTTP 503.
+    """
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0, seed=None):
+        ThreadingHTTPServer.__init__(self, (host, port), _USPSHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    @property
+    def url(self):
+        return 'http://%s:%d/ShippingAPI.dll' % self.server_address[:2]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class _RedisHandler(socketserver.StreamRequestHandler):
+
+    def _command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            return line.split()
+        command = list()
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            command.append(self.rfile.read(length + 2)[:-2])
+        return command
+
+    def handle(self):
+        while True:
+            command = self._command()
+            if command is None:
+                return
+            self.server.commands += 1
+            try:
+                reply = self.server.dispatch(command[0].upper().decode('ascii'), command[1:])
+            except Exception as error:
+                reply = error
+            self.wfile.write(_encode_reply(reply))
+
+
+def _encode_reply(reply):
+    if reply is None:
+        return b'$-1\r\n'
+    if isinstance(reply, Exception):
+        return b'-ERR %s\r\n' % str(reply).encode('utf-8')
+    if reply is True:
+        return b'+OK\r\n'
+    if isinstance(reply, int):
+        return b':%d\r\n' % reply
+    if isinstance(reply, bytes):
+        return b'$%d\r\n%s\r\n' % (len(reply), reply)
+    return b'*%d\r\n' % len(reply) + b''.join(_encode_reply(item) for item in reply)
+
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    """ Redis stand-in for tests: PING, AUTH, SELECT, GET, MGET, SET (EX/PX),
+    DEL, SCAN, DBSIZE and FLUSHDB on a dict.  Use as a context manager or call
+    start() and stop().
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0, clock=time.monotonic):
+        socketserver.ThreadingTCPServer.__init__(self, (host, port), _RedisHandler)
+        self.clock = clock
+        self.data = dict()
+        self.commands = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _get(self, key):
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires is not None and expires <= self.clock():
+            del self.data[key]
+            return None
+        return value
+
+    def dispatch(self, name, arguments):
+        with self._lock:
+            if name == 'PING':
+                return b'PONG'
+            if name in ('AUTH', 'SELECT'):
+                return True
+            if name == 'GET':
+                return self._get(arguments[0])
+            if name == 'MGET':
+                return [self._get(key) for key in arguments]
+            if name == 'SET':
+                expires = None
+                options = [option.upper() for option in arguments[2:]]
+                if b'EX' in options:
+                    expires = self.clock() + int(arguments[2 + options.index(b'EX') + 1])
+                elif b'PX' in options:
+                    expires = self.clock() + int(arguments[2 + options.index(b'PX') + 1]) / 1000.0
+                self.data[arguments[0]] = (arguments[1], expires)
+                return True
+            if name == 'DEL':
+                return sum(1 for key in arguments if self.data.pop(key, None) is not None)
+            if name == 'SCAN':
+                pattern = b'*'
+                if b'MATCH' in [argument.upper() for argument in arguments]:
+                    pattern = arguments[[argument.upper() for argument in arguments].index(b'MATCH') + 1]
+                keys = [key for key in list(self.data) if self._get(key) is not None
+                        and fnmatch.fnmatchcase(key.decode('utf-8'), pattern.decode('utf-8'))]
+                return [b'0', keys]
+            if name == 'DBSIZE':
+                return len([key for key in list(self.data) if self._get(key) is not None])
+            if name == 'FLUSHDB':
+                self.data.clear()
+                return True
+            raise ValueError("unknown command '%s'" % name)
@@ -0,0 +1,146 @@
+'''
+Hedged requests for the read-only USPS APIs.
+
+When a request has not answered within the recent latency percentile a
+duplicate is sent and whichever answers first is used.  The slower one is
+cancelled if it has not started yet, otherwise its response is thrown away.
+Only services with IDEMPOTENT = True are hedged, CarrierPickupSchedule,
+CarrierPickupChange and CarrierPickupCancel never are.
+
+hedge = HedgePolicy(percentile=95)
+address_validation = Address(user_id='YOUR_USER_ID', hedge=hedge)
+'''
+
+import contextvars
+import io
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from usps.addressinformation.deadline import current_deadline
+
+
+class HedgePolicy(object):
+    """ Sends a backup request once the primary is slower than the given
+    percentile of the last window latencies, bounded by min_delay and max_delay.
+    Until min_samples latencies are known the delay is max_delay.
+
+    Every attempt gets a finite timeout, the service's own or else this
+    policy's timeout, capped at what the active Deadline has left when the
+    attempt starts.  A slower attempt that already started keeps a worker
+    until it finishes, once max_losers of them are in flight requests are
+    sent without hedging until some finish.
+    """
+
+    def __init__(self, percentile=95, min_delay=0.05, max_delay=2.0, window=500, min_samples=20, max_workers=32,
+                 timeout=10.0, max_losers=None, clock=time.monotonic):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.min_samples = min_samples
+        self.timeout = timeout
+        self.max_losers = max_workers // 2 if max_losers is None else max_losers
+        self.clock = clock
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.hedged = 0
+        self.backup_wins = 0
+        self.unhedged = 0
+        self.losers = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='usps-hedge')
+        self._lock = threading.Lock()
+
+    def delay(self):
+        with self._lock:
+            if len(self.latencies) < self.min_samples:
+                return self.max_delay
+            ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100.0))
+        return min(self.max_delay, max(self.min_delay, ordered[index]))
+
+    def _limit(self, timeout):
+        """ Timeout for an attempt starting now """
+        if timeout is None:
+            timeout = self.timeout
+        deadline = current_deadline()
+        return timeout if deadline is None else deadline.limit(timeout)
+
+    def _submit(self, send, timeout):
+        started = self.clock()
+        timeout = self._limit(timeout)
+
+        def timed():
+            # Read the whole body so the race covers the transfer, not just the headers
+            response = send(timeout)
+            try:
+                body = response.read()
+            finally:
+                response.close()
+            with self._lock:
+                self.latencies.append(self.clock() - started)
+            return io.BytesIO(body)
+
+        return self._executor.submit(contextvars.copy_context().run, timed)
+
+    def _abandon(self, loser):
+        if loser.cancel() or loser.done():
+            return
+        with self._lock:
+            self.losers += 1
+        loser.add_done_callback(self._finished)
+
+    def _finished(self, loser):
+        with self._lock:
+            self.losers -= 1
+
+    def run(self, send, timeout=None):
+        """ Call send (takes a timeout, returns a response stream) with hedging,
+        returns a stream.  timeout is the one the service would use, None for
+        this policy's.
+        """
+        with self._lock:
+            self.requests += 1
+            saturated = self.losers >= self.max_losers
+            if saturated:
+                self.unhedged += 1
+        if saturated:
+            # Abandoned attempts hold the workers, do not queue behind them
+            return send(self._limit(timeout))
+
+        primary = self._submit(send, timeout)
+        done, _ = wait([primary], timeout=self.delay())
+        if done:
+            return primary.result()
+
+        with self._lock:
+            self.hedged += 1
+        # The backup gets its own timeout, from what the Deadline has left now
+        backup = self._submit(send, timeout)
+        pending = {primary, backup}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for loser in pending:
+                        self._abandon(loser)
+                    if future is backup:
+                        with self._lock:
+                            self.backup_wins += 1
+                    return future.result()
+                error = error or future.exception()
+        raise error
+
+    def stats(self):
+        delay = self.delay()
+        with self._lock:
+            return {'requests': self.requests,
+                    'hedged': self.hedged,
+                    'backup_wins': self.backup_wins,
+                    'unhedged': self.unhedged,
+                    'losers': self.losers,
+                    'delay': delay}
+
+    def close(self):
+        self._executor.shutdown(wait=False)
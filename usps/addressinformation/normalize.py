@@ -0,0 +1,218 @@
+'''
+Local address normalizer following USPS Publication 28 abbreviations.
+
+This is not a replacement for Verify, it only puts addresses into one spelling
+so "500 E. third st", "500 East 3rd Street" and "500 E 3RD ST" share a cache
+key, and so duplicates can be dropped before they reach USPS.
+
+normalize_address({'Address2': '500 East Third Street', 'City': 'loveland', 'State': 'co'})
+{'FirmName': '', 'Address1': '', 'Address2': '500 E 3RD ST', 'City': 'LOVELAND', 'State': 'CO', 'Zip5': '', 'Zip4': ''}
+'''
+
+import re
+from functools import lru_cache
+
+# Publication 28 Appendix C1, every accepted spelling -> standard suffix abbreviation
+STREET_SUFFIXES = dict()
+for _abbreviation, _spellings in (
+        ('ALY', 'ALLEE ALLEY ALLY ALY'), ('ANX', 'ANEX ANNEX ANNX ANX'), ('ARC', 'ARC ARCADE'),
+        ('AVE', 'AV AVE AVEN AVENU AVENUE AVN AVNUE'), ('BYU', 'BAYOO BAYOU'), ('BCH', 'BCH BEACH'),
+        ('BND', 'BEND BND'), ('BLF', 'BLF BLUF BLUFF'), ('BLFS', 'BLUFFS'), ('BTM', 'BOT BTM BOTTM BOTTOM'),
+        ('BLVD', 'BLVD BOUL BOULEVARD BOULV'), ('BR', 'BR BRNCH BRANCH'), ('BRG', 'BRDGE BRG BRIDGE'),
+        ('BRK', 'BRK BROOK'), ('BRKS', 'BROOKS'), ('BG', 'BURG'), ('BGS', 'BURGS'), ('BYP', 'BYP BYPA BYPAS BYPASS BYPS'),
+        ('CP', 'CAMP CP CMP'), ('CYN', 'CANYN CANYON CNYN CYN'), ('CPE', 'CAPE CPE'),
+        ('CSWY', 'CAUSEWAY CAUSWA CSWY'), ('CTR', 'CEN CENT CENTER CENTR CENTRE CNTER CNTR CTR'),
+        ('CTRS', 'CENTERS'), ('CIR', 'CIR CIRC CIRCL CIRCLE CRCL CRCLE'), ('CIRS', 'CIRCLES'),
+        ('CLF', 'CLF CLIFF'), ('CLFS', 'CLFS CLIFFS'), ('CLB', 'CLB CLUB'), ('CMN', 'COMMON'), ('CMNS', 'COMMONS'),
+        ('COR', 'COR CORNER'), ('CORS', 'CORNERS CORS'), ('CRSE', 'COURSE CRSE'), ('CT', 'COURT CT'),
+        ('CTS', 'COURTS CTS'), ('CV', 'COVE CV'), ('CVS', 'COVES'), ('CRK', 'CREEK CRK'),
+        ('CRES', 'CRESCENT CRES CRSENT CRSNT'), ('CRST', 'CREST'), ('XING', 'CROSSING CRSSNG XING'),
+        ('XRD', 'CROSSROAD'), ('XRDS', 'CROSSROADS'), ('CURV', 'CURVE'), ('DL', 'DALE DL'), ('DM', 'DAM DM'),
+        ('DV', 'DIV DIVIDE DV DVD'), ('DR', 'DR DRIV DRIVE DRV'), ('DRS', 'DRIVES'), ('EST', 'ESTATE EST'),
+        ('ESTS', 'ESTATES ESTS'), ('EXPY', 'EXP EXPR EXPRESS EXPRESSWAY EXPW EXPY'),
+        ('EXT', 'EXT EXTENSION EXTN EXTNSN'), ('EXTS', 'EXTS'), ('FALL', 'FALL'), ('FLS', 'FALLS FLS'),
+        ('FRY', 'FERRY FRRY FRY'), ('FLD', 'FIELD FLD'), ('FLDS', 'FIELDS FLDS'), ('FLT', 'FLAT FLT'),
+        ('FLTS', 'FLATS FLTS'), ('FRD', 'FORD FRD'), ('FRDS', 'FORDS'), ('FRST', 'FOREST FORESTS FRST'),
+        ('FRG', 'FORG FORGE FRG'), ('FRGS', 'FORGES'), ('FRK', 'FORK FRK'), ('FRKS', 'FORKS FRKS'),
+        ('FT', 'FORT FRT FT'), ('FWY', 'FREEWAY FREEWY FRWAY FRWY FWY'), ('GDN', 'GARDEN GARDN GRDEN GRDN'),
+        ('GDNS', 'GARDENS GDNS GRDNS'), ('GTWY', 'GATEWAY GATEWY GATWAY GTWAY GTWY'), ('GLN', 'GLEN GLN'),
+        ('GLNS', 'GLENS'), ('GRN', 'GREEN GRN'), ('GRNS', 'GREENS'), ('GRV', 'GROV GROVE GRV'), ('GRVS', 'GROVES'),
+        ('HBR', 'HARB HARBOR HARBR HBR HRBOR'), ('HBRS', 'HARBORS'), ('HVN', 'HAVEN HVN'),
+        ('HTS', 'HT HTS HEIGHTS'), ('HWY', 'HIGHWAY HIGHWY HIWAY HIWY HWAY HWY'), ('HL', 'HILL HL'),
+        ('HLS', 'HILLS HLS'), ('HOLW', 'HLLW HOLLOW HOLLOWS HOLW HOLWS'), ('INLT', 'INLT'), ('IS', 'IS ISLAND ISLND'),
+        ('ISS', 'ISLANDS ISLNDS ISS'), ('ISLE', 'ISLE ISLES'), ('JCT', 'JCT JCTION JCTN JUNCTION JUNCTN JUNCTON'),
+        ('JCTS', 'JCTNS JCTS JUNCTIONS'), ('KY', 'KEY KY'), ('KYS', 'KEYS KYS'), ('KNL', 'KNL KNOL KNOLL'),
+        ('KNLS', 'KNLS KNOLLS'), ('LK', 'LK LAKE'), ('LKS', 'LKS LAKES'), ('LAND', 'LAND'),
+        ('LNDG', 'LANDING LNDG LNDNG'), ('LN', 'LANE LN'), ('LGT', 'LGT LIGHT'), ('LGTS', 'LIGHTS'),
+        ('LF', 'LF LOAF'), ('LCK', 'LCK LOCK'), ('LCKS', 'LCKS LOCKS'), ('LDG', 'LDG LDGE LODG LODGE'),
+        ('LOOP', 'LOOP LOOPS'), ('MALL', 'MALL'), ('MNR', 'MNR MANOR'), ('MNRS', 'MANORS MNRS'),
+        ('MDW', 'MEADOW'), ('MDWS', 'MDW MDWS MEADOWS MEDOWS'), ('MEWS', 'MEWS'), ('ML', 'MILL'), ('MLS', 'MILLS'),
+        ('MSN', 'MISSN MSSN'), ('MTWY', 'MOTORWAY'), ('MT', 'MNT MT MOUNT'),
+        ('MTN', 'MNTAIN MNTN MOUNTAIN MOUNTIN MTIN MTN'), ('MTNS', 'MNTNS MOUNTAINS'), ('NCK', 'NCK NECK'),
+        ('ORCH', 'ORCH ORCHARD ORCHRD'), ('OVAL', 'OVAL OVL'), ('OPAS', 'OVERPASS'), ('PARK', 'PARK PRK PARKS'),
+        ('PKWY', 'PARKWAY PARKWY PKWAY PKWY PKY PARKWAYS PKWYS'), ('PASS', 'PASS'), ('PSGE', 'PASSAGE'),
+        ('PATH', 'PATH PATHS'), ('PIKE', 'PIKE PIKES'), ('PNE', 'PINE'), ('PNES', 'PINES PNES'), ('PL', 'PL PLACE'),
+        ('PLN', 'PLAIN PLN'), ('PLNS', 'PLAINS PLNS'), ('PLZ', 'PLAZA PLZ PLZA'), ('PT', 'POINT PT'),
+        ('PTS', 'POINTS PTS'), ('PRT', 'PORT PRT'), ('PRTS', 'PORTS PRTS'), ('PR', 'PR PRAIRIE PRR'),
+        ('RADL', 'RAD RADIAL RADIEL RADL'), ('RAMP', 'RAMP'), ('RNCH', 'RANCH RANCHES RNCH RNCHS'),
+        ('RPD', 'RAPID RPD'), ('RPDS', 'RAPIDS RPDS'), ('RST', 'REST RST'), ('RDG', 'RDG RDGE RIDGE'),
+        ('RDGS', 'RDGS RIDGES'), ('RIV', 'RIV RIVER RVR RIVR'), ('RD', 'RD ROAD'), ('RDS', 'ROADS RDS'),
+        ('RTE', 'ROUTE'), ('ROW', 'ROW'), ('RUE', 'RUE'), ('RUN', 'RUN'), ('SHL', 'SHL SHOAL'), ('SHLS', 'SHLS SHOALS'),
+        ('SHR', 'SHOAR SHORE SHR'), ('SHRS', 'SHOARS SHORES SHRS'), ('SKWY', 'SKYWAY'), ('SPG', 'SPG SPNG SPRING SPRNG'),
+        ('SPGS', 'SPGS SPNGS SPRINGS SPRNGS'), ('SPUR', 'SPUR SPURS'), ('SQ', 'SQ SQR SQRE SQU SQUARE'),
+        ('SQS', 'SQRS SQUARES'), ('STA', 'STA STATION STATN STN'), ('STRA', 'STRA STRAV STRAVEN STRAVENUE STRAVN STRVN STRVNUE'),
+        ('STRM', 'STREAM STREME STRM'), ('ST', 'STREET STRT ST STR'), ('STS', 'STREETS'), ('SMT', 'SMT SUMIT SUMITT SUMMIT'),
+        ('TER', 'TER TERR TERRACE'), ('TRWY', 'THROUGHWAY'), ('TRCE', 'TRACE TRACES TRCE'),
+        ('TRAK', 'TRACK TRACKS TRAK TRK TRKS'), ('TRFY', 'TRAFFICWAY'), ('TRL', 'TRAIL TRAILS TRL TRLS'),
+        ('TRLR', 'TRAILER TRLR TRLRS'), ('TUNL', 'TUNEL TUNL TUNLS TUNNEL TUNNELS TUNNL'),
+        ('TPKE', 'TRNPK TURNPIKE TURNPK'), ('UPAS', 'UNDERPASS'), ('UN', 'UN UNION'), ('UNS', 'UNIONS'),
+        ('VLY', 'VALLEY VALLY VLLY VLY'), ('VLYS', 'VALLEYS VLYS'), ('VIA', 'VDCT VIA VIADCT VIADUCT'),
+        ('VW', 'VIEW VW'), ('VWS', 'VIEWS VWS'), ('VLG', 'VILL VILLAG VILLAGE VILLG VILLIAGE VLG'),
+        ('VLGS', 'VILLAGES VLGS'), ('VL', 'VILLE VL'), ('VIS', 'VIS VIST VISTA VST VSTA'), ('WALK', 'WALK WALKS'),
+        ('WALL', 'WALL'), ('WAY', 'WY WAY'), ('WAYS', 'WAYS'), ('WL', 'WELL'), ('WLS', 'WELLS WLS')):
+    for _spelling in _spellings.split():
+        STREET_SUFFIXES[_spelling] = _abbreviation
+
+DIRECTIONALS = {'NORTH': 'N', 'SOUTH': 'S', 'EAST': 'E', 'WEST': 'W',
+                'NORTHEAST': 'NE', 'NORTHWEST': 'NW', 'SOUTHEAST': 'SE', 'SOUTHWEST': 'SW'}
+for _abbreviation in list(DIRECTIONALS.values()):
+    DIRECTIONALS[_abbreviation] = _abbreviation
+
+# Publication 28 Appendix C2
+SECONDARY_UNITS = {'APARTMENT': 'APT', 'APT': 'APT', 'BASEMENT': 'BSMT', 'BSMT': 'BSMT',
+                   'BUILDING': 'BLDG', 'BLDG': 'BLDG', 'DEPARTMENT': 'DEPT', 'DEPT': 'DEPT',
+                   'FLOOR': 'FL', 'FL': 'FL', 'FRONT': 'FRNT', 'FRNT': 'FRNT', 'HANGAR': 'HNGR', 'HNGR': 'HNGR',
+                   'LOBBY': 'LBBY', 'LBBY': 'LBBY', 'LOT': 'LOT', 'LOWER': 'LOWR', 'LOWR': 'LOWR',
+                   'OFFICE': 'OFC', 'OFC': 'OFC', 'PENTHOUSE': 'PH', 'PH': 'PH', 'PIER': 'PIER', 'REAR': 'REAR',
+                   'ROOM': 'RM', 'RM': 'RM', 'SIDE': 'SIDE', 'SLIP': 'SLIP', 'SPACE': 'SPC', 'SPC': 'SPC',
+                   'STOP': 'STOP', 'SUITE': 'STE', 'STE': 'STE', 'UNIT': 'UNIT', 'UPPER': 'UPPR', 'UPPR': 'UPPR',
+                   '#': '#'}
+# Designators written without a unit number, only recognised at the end of a street line
+UNNUMBERED_UNITS = {'BSMT', 'FRNT', 'LBBY', 'LOWR', 'OFC', 'PH', 'REAR', 'SIDE', 'UPPR'}
+
+ORDINALS = {'FIRST': '1ST', 'SECOND': '2ND', 'THIRD': '3RD', 'FOURTH': '4TH', 'FIFTH': '5TH', 'SIXTH': '6TH',
+            'SEVENTH': '7TH', 'EIGHTH': '8TH', 'NINTH': '9TH', 'TENTH': '10TH', 'ELEVENTH': '11TH',
+            'TWELFTH': '12TH', 'THIRTEENTH': '13TH', 'FOURTEENTH': '14TH', 'FIFTEENTH': '15TH',
+            'SIXTEENTH': '16TH', 'SEVENTEENTH': '17TH', 'EIGHTEENTH': '18TH', 'NINETEENTH': '19TH',
+            'TWENTIETH': '20TH'}
+TENS = {'TWENTY': 20, 'THIRTY': 30, 'FORTY': 40, 'FIFTY': 50, 'SIXTY': 60, 'SEVENTY': 70, 'EIGHTY': 80,
+        'NINETY': 90}
+
+FIELDS = ['FirmName', 'Address1', 'Address2', 'City', 'State', 'Zip5', 'Zip4']
+
+_PUNCTUATION = re.compile(r'[.,;:]')
+_SEPARATE_HASH = re.compile(r'#(?=\S)')
+
+
+def _unit_number(token):
+    """ Unit numbers are '#', anything with a digit or a single letter """
+    return token == '#' or any(character.isdigit() for character in token) or (len(token) == 1 and token.isalpha())
+
+
+def _ordinals(tokens):
+    """ Spelled out ordinals as numbers, 'TWENTY FIRST' -> '21ST' """
+    result = list()
+    for token in tokens:
+        ordinal = ORDINALS.get(token)
+        if ordinal is not None and result and result[-1] in TENS and len(ordinal) == 3:
+            result[-1] = '%d%s' % (TENS[result[-1]] + int(ordinal[0]), ordinal[1:])
+        else:
+            result.append(ordinal or token)
+    return result
+
+
+@lru_cache(maxsize=65536)
+def split_line(line):
+    """ Normalize one street line into its (street, secondary unit) parts """
+    tokens = _SEPARATE_HASH.sub('# ', _PUNCTUATION.sub(' ', line.upper())).split()
+    if not tokens:
+        return '', ''
+
+    # Everything from the first unit designator on is the secondary address.  Only a
+    # designator with a unit number counts, or an unnumbered one ending the line, so
+    # street names such as "Lower Main St" or "Rear Admiral Way" are left alone.
+    split = len(tokens)
+    for index in range(1, len(tokens)):
+        if tokens[index] not in SECONDARY_UNITS:
+            continue
+        if index + 1 < len(tokens) and _unit_number(tokens[index + 1]):
+            split = index
+            break
+        if index == len(tokens) - 1 and index > 1 and SECONDARY_UNITS[tokens[index]] in UNNUMBERED_UNITS:
+            split = index
+            break
+    street, unit = _ordinals(tokens[:split]), tokens[split:]
+
+    last = len(street) - 1
+    if last >= 2 and street[last] in DIRECTIONALS and street[last - 1] in STREET_SUFFIXES:
+        street[last] = DIRECTIONALS[street[last]]
+        last -= 1
+    if last >= 2 and street[last] in STREET_SUFFIXES:
+        street[last] = STREET_SUFFIXES[street[last]]
+        last -= 1
+    # A leading directional is only a pre-directional when a street name follows it
+    if len(street) > 1 and street[0][:1].isdigit() and street[1] in DIRECTIONALS and last > 1:
+        street[1] = DIRECTIONALS[street[1]]
+
+    if unit:
+        unit[0] = SECONDARY_UNITS[unit[0]]
+        if len(unit) > 2 and unit[1] == '#':
+            del unit[1]
+    return ' '.join(street), ' '.join(unit)
+
+
+def normalize_line(line):
+    """ Normalize one street line, e.g. '500 East Third Street Suite 4' -> '500 E 3RD ST STE 4' """
+    return ' '.join(part for part in split_line(line) if part)
+
+
+def normalize_unit(line):
+    """ Normalize a secondary unit line, e.g. 'Suite #4' -> 'STE 4' """
+    tokens = _SEPARATE_HASH.sub('# ', _PUNCTUATION.sub(' ', line.upper())).split()
+    if tokens and tokens[0] in SECONDARY_UNITS:
+        tokens[0] = SECONDARY_UNITS[tokens[0]]
+        if len(tokens) > 2 and tokens[1] == '#':
+            del tokens[1]
+        return ' '.join(tokens)
+    return normalize_line(line)
+
+
+def _collapse(value):
+    return ' '.join(_PUNCTUATION.sub(' ', str(value or '').upper()).split())
+
+
+def normalize_address(address_dict):
+    """ Return a normalized copy of an Address style dict (FirmName, Address1,
+    Address2, City, State, Zip5, Zip4).  A secondary unit written on the street
+    line is moved to Address1 where Verify expects it.
+    """
+    address2, unit = split_line(str(address_dict.get('Address2') or ''))
+    address1 = normalize_unit(str(address_dict.get('Address1') or ''))
+    if not address1:
+        address1 = unit
+    elif unit:
+        address2 = '%s %s' % (address2, unit)
+
+    zip5 = str(address_dict.get('Zip5') or '').strip()
+    zip4 = str(address_dict.get('Zip4') or '').strip()
+    if '-' in zip5:
+        zip5, zip4 = zip5.split('-', 1)
+
+    return {'FirmName': _collapse(address_dict.get('FirmName')),
+            'Address1': address1,
+            'Address2': address2,
+            'City': _collapse(address_dict.get('City')),
+            'State': _collapse(address_dict.get('State')),
+            'Zip5': zip5[:5],
+            'Zip4': zip4[:4]}
+
+
+def normalize_many(address_dicts):
+    """ Normalize an iterable of address dicts, repeated street lines are only parsed once """
+    return [normalize_address(address_dict) for address_dict in address_dicts]
+
+
+def canonical_key(address_dict):
+    """ Key shared by every spelling of the same address """
+    normalized = normalize_address(address_dict)
+    return '|'.join(normalized[field] for field in FIELDS)
@@ -0,0 +1,205 @@
+'''
+Offline domestic postage from USPS published price tables.
+
+Price files are CSV with one price per row:
+
+    Service,Container,Weight,Zone,Price
+    PRIORITY,VARIABLE,1,1,9.35
+    PRIORITY,VARIABLE,1,2,9.85
+    ...
+
+Weight is the upper bound of the weight step in pounds (0.25, 0.5, 1, 2, ...),
+a package is charged at the first step at or above its weight.  An empty
+Container applies to every container of that Service without its own table.
+
+Requires numpy (pip install python-usps2[numpy]).
+'''
+
+import csv
+import random
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError('numpy is required for the offline rate engine, pip install numpy')
+
+
+class RateTable(object):
+    """ Zone x weight x (Service, Container) price cube held in NumPy arrays.
+
+    rate_table = RateTable.from_csv('priority.csv', 'ground_advantage.csv')
+    postage = rate_table.postage(package_dicts, zones=zone_matrix.zones)
+
+    postage() accepts the same keys as DomesticRate.PACKAGE_PARAMETERS, either
+    as a list of dicts or as a dict of columns, and returns a float array with
+    NaN where no price applies.
+    """
+
+    def __init__(self, tables, weights, prices):
+        _require_numpy()
+        self.tables = dict(tables)  # (SERVICE, CONTAINER) -> first axis of prices
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.prices = np.asarray(prices, dtype=np.float64)
+
+    @classmethod
+    def from_csv(cls, *paths):
+        _require_numpy()
+        rows = list()
+        for path in paths:
+            with open(path, newline='') as source:
+                for row in csv.DictReader(source):
+                    rows.append(((row['Service'].strip().upper(), row['Container'].strip().upper()),
+                                 float(row['Weight']), int(row['Zone']), float(row['Price'])))
+
+        tables = dict()
+        for key, _, _, _ in rows:
+            tables.setdefault(key, len(tables))
+        weights = sorted(set(row[1] for row in rows))
+        zones = max(row[2] for row in rows) if rows else 1
+
+        prices = np.full((len(tables), len(weights), zones), np.nan)
+        weight_index = dict((weight, index) for index, weight in enumerate(weights))
+        for key, weight, zone, price in rows:
+            prices[tables[key], weight_index[weight], zone - 1] = price
+
+        # A weight step missing from one table is priced at that table's next step up
+        for table in prices:
+            for zone in range(zones):
+                column = table[:, zone]
+                following = np.nan
+                for index in range(len(column) - 1, -1, -1):
+                    if np.isnan(column[index]):
+                        column[index] = following
+                    else:
+                        following = column[index]
+        return cls(tables, weights, prices)
+
+    def save(self, path):
+        keys = sorted(self.tables, key=self.tables.get)
+        np.savez(path, services=np.array([key[0] for key in keys], dtype=str),
+                 containers=np.array([key[1] for key in keys], dtype=str),
+                 weights=self.weights, prices=self.prices)
+
+    @classmethod
+    def load(cls, path):
+        _require_numpy()
+        with np.load(path) as data:
+            tables = dict(((service, container), index) for index, (service, container)
+                          in enumerate(zip(data['services'].tolist(), data['containers'].tolist())))
+            return cls(tables, data['weights'], data['prices'])
+
+    @staticmethod
+    def columns(packages, keys):
+        if isinstance(packages, dict):
+            return dict((key, packages.get(key)) for key in keys)
+        return dict((key, [package.get(key) for package in packages]) for key in keys)
+
+    @staticmethod
+    def numbers(values, count):
+        """ Column as a float array, missing values (None, '' or NaN) are 0 """
+        if values is None:
+            return np.zeros(count)
+        values = np.asarray(values)
+        if values.dtype.kind in 'OUS':
+            values = np.where(np.equal(values, None) | np.equal(values, ''), 0, values)
+        return np.nan_to_num(values.astype(np.float64))
+
+    @staticmethod
+    def labels(values, count):
+        """ Column as an array of upper case stripped strings, missing values are '' """
+        if values is None:
+            return np.full(count, '')
+        values = np.asarray(values, dtype=object)
+        values = np.where(np.equal(values, None), '', values).astype(str)
+        return np.char.upper(np.char.strip(values))
+
+    def table_index(self, services, containers):
+        """ Map Service/Container columns to the first axis of prices, -1 when unknown """
+        count = len(services)
+        labels = np.char.add(np.char.add(self.labels(services, count), '|'), self.labels(containers, count))
+        unique, inverse = np.unique(labels, return_inverse=True)
+        # One dict lookup per distinct Service/Container pair, not per package
+        lookup = np.empty(len(unique), dtype=np.intp)
+        for position, label in enumerate(unique.tolist()):
+            service, container = label.split('|', 1)
+            lookup[position] = self.tables.get((service, container), self.tables.get((service, ''), -1))
+        return lookup[inverse.reshape(-1)]
+
+    def postage(self, packages, zones=None):
+        """ Postage for every package, zones is either a callable taking the
+        ZipOrigination and ZipDestination columns or is omitted when the
+        packages carry a Zone value.  Columns may be lists or NumPy arrays.
+        """
+        columns = self.columns(packages, ['Service', 'Container', 'Pounds', 'Ounces',
+                                          'ZipOrigination', 'ZipDestination', 'Zone'])
+        count = len(columns['Service'])
+        weight = self.numbers(columns['Pounds'], count) + self.numbers(columns['Ounces'], count) / 16.0
+
+        if zones is not None:
+            zone = np.asarray(zones(columns['ZipOrigination'], columns['ZipDestination']), dtype=np.intp)
+        elif columns['Zone'] is not None:
+            zone = self.numbers(columns['Zone'], count).astype(np.intp)
+        else:
+            raise ValueError('packages need a Zone or a zones lookup for ZipOrigination/ZipDestination')
+
+        table = self.table_index(columns['Service'], columns['Container'])
+        step = np.searchsorted(self.weights, weight - 1e-9, side='left')
+
+        valid = (table >= 0) & (step < len(self.weights)) & (zone >= 1) & (zone <= self.prices.shape[2])
+        result = np.full(count, np.nan)
+        result[valid] = self.prices[table[valid], step[valid], zone[valid] - 1]
+        return result
+
+    def cross_check(self, rate_service, packages, sample=25, tolerance=0.005, zones=None, seed=None):
+        """ Price a random sample of packages with the live DomesticRate API
+        and compare against the local tables.
+
+        Returns {'checked': n, 'mismatches': [{'index', 'local', 'live'}, ...],
+        'errors': [{'index', 'error'}, ...], 'max_drift': largest absolute
+        difference}.  A package USPS rejects is listed in errors and not
+        compared.
+        """
+        if isinstance(packages, dict):
+            count = len(packages['Service'])
+            rows = [dict((key, values[index]) for key, values in packages.items()) for index in range(count)]
+        else:
+            rows = list(packages)
+        indexes = random.Random(seed).sample(range(len(rows)), min(sample, len(rows)))
+        local = self.postage([rows[index] for index in indexes], zones=zones)
+
+        live = list()
+        for start in range(0, len(indexes), rate_service.MAX_BATCH_SIZE):
+            chunk = [rows[index] for index in indexes[start:start + rate_service.MAX_BATCH_SIZE]]
+            # Results come back matched to their package by ID, errors in place
+            live.extend(rate_service.execute_batch(chunk, partial=True))
+
+        mismatches = list()
+        errors = list()
+        max_drift = 0.0
+        for index, local_price, result in zip(indexes, local.tolist(), live):
+            if isinstance(result, Exception):
+                errors.append({'index': index, 'error': result})
+                continue
+            live_price = _live_rate(result)
+            drift = abs(local_price - live_price)
+            if not drift <= tolerance:
+                mismatches.append({'index': index, 'local': local_price, 'live': live_price})
+            if not np.isnan(drift):
+                max_drift = max(max_drift, drift)
+        return {'checked': len(indexes), 'mismatches': mismatches, 'errors': errors, 'max_drift': max_drift}
+
+
+def _live_rate(package):
+    """ Rate of the first Postage of a DomesticRate result, NaN if it has none """
+    postage = package.get('Postage')
+    if isinstance(postage, list):
+        postage = postage[0] if postage else None
+    if not postage:
+        return np.nan
+    rate = postage.get('Rate') or postage.get('CommercialRate')
+    return float(rate) if rate else np.nan
@@ -0,0 +1,110 @@
+'''
+Bounded capture of slow and failed USPS requests for diagnostics.
+
+recorder = SlowRequestRecorder(threshold=2.0, capacity=200)
+recorder.dump_on_signal('/tmp/usps-slow.jsonl')  # kill -USR1 <pid> writes the file
+address_validation = Address(user_id='YOUR_USER_ID', recorder=recorder)
+...
+recorder.dump('/tmp/usps-slow.jsonl')
+
+Only requests slower than threshold seconds, answered with an Error or
+failing outright are kept, the oldest are dropped once capacity is reached.  Entries hold the
+request XML with the USERID redacted, the response body, network and parse
+timings and the batch size.  Nothing is serialized for fast, successful
+requests.
+'''
+
+import json
+import re
+import signal
+import threading
+import time
+from collections import deque
+
+from lxml import etree
+
+USERID = re.compile(br'USERID="[^"]*"')
+
+
+class SlowRequestRecorder(object):
+
+    def __init__(self, threshold=1.0, capacity=200, max_body=65536, clock=time.perf_counter):
+        self.threshold = threshold
+        self.max_body = max_body
+        self.clock = clock
+        self.entries = deque(maxlen=capacity)
+        self.seen = 0
+        self.recorded = 0
+        self.dumper = None  # Thread writing the last signal triggered dump
+        self._lock = threading.Lock()
+
+    def _clip(self, data):
+        if data is None:
+            return None
+        clipped = data[:self.max_body].decode('utf-8', 'replace')
+        if len(data) > self.max_body:
+            clipped += '...[%d bytes]' % len(data)
+        return clipped
+
+    def observe(self, service, xml, body, started, received, finished, error=None):
+        """ Called by USPSService after every request, keeps the slow and failed ones """
+        latency = finished - started
+        failed = error is not None or (body is not None and b'<Error>' in body)
+        with self._lock:
+            self.seen += 1
+        if latency < self.threshold and not failed:
+            return False
+
+        request = USERID.sub(b'USERID="REDACTED"', etree.tostring(xml))
+        entry = {'time': time.time(),
+                 'service': type(service).__name__,
+                 'api': service.API,
+                 'url': service.url,
+                 'batch_size': sum(1 for item in xml.iterchildren() if item.get('ID') is not None) or 1,
+                 'latency': latency,
+                 'network': (finished if received is None else received) - started,
+                 'parse': finished - received if received is not None else None,
+                 'error': None if error is None else '%s: %s' % (type(error).__name__, error),
+                 'request': self._clip(request),
+                 'response': self._clip(body)}
+        with self._lock:
+            self.entries.append(entry)
+            self.recorded += 1
+        return True
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.entries)
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+    def dump(self, path):
+        """ Write the buffered entries to path as JSON lines, returns how many """
+        entries = self.snapshot()
+        with open(path, 'w') as target:
+            for entry in entries:
+                target.write(json.dumps(entry) + '\n')
+        return len(entries)
+
+    def dump_on_signal(self, path, signum=None):
+        """ Dump to path whenever the process receives signum, SIGUSR1 by
+        default.  Must be called from the main thread, returns the previous
+        handler.
+        """
+        if signum is None:
+            signum = getattr(signal, 'SIGUSR1', None)
+            if signum is None:
+                raise ValueError('SIGUSR1 is not available on this platform, pass signum')
+
+        def handler(received, frame):
+            # The main thread may be inside observe() holding the lock, dump from another thread
+            self.dumper = threading.Thread(target=self.dump, args=(path,), name='usps-recorder-dump', daemon=True)
+            self.dumper.start()
+
+        return signal.signal(signum, handler)
+
+    def stats(self):
+        with self._lock:
+            return {'seen': self.seen, 'recorded': self.recorded, 'buffered': len(self.entries)}
@@ -0,0 +1,147 @@
+'''
+Priority classes in front of submit_xml so interactive calls are not stuck
+behind bulk jobs sharing the same USPS quota and connections.
+
+scheduler = PriorityScheduler(capacity=8)
+checkout = Address(user_id='YOUR_USER_ID', scheduler=scheduler, priority='interactive')
+cleanse = Address(user_id='YOUR_USER_ID', scheduler=scheduler, priority='batch')
+
+At most capacity requests run at once.  A waiting request of a higher priority
+class always gets the next free slot, each class keeps reserved slots that
+other classes cannot take, and a class with max_queue waiting requests either
+blocks new ones (block=True) or rejects them with USPSSchedulerFull.
+'''
+
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+
+class USPSSchedulerFull(Exception):
+    pass
+
+
+class PriorityClass(object):
+
+    def __init__(self, name, priority, reserved=0, max_queue=None, block=True):
+        self.name = name
+        self.priority = priority
+        self.reserved = reserved
+        self.max_queue = max_queue
+        self.block = block
+        self.waiting = deque()
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self.waited = 0.0
+        self.max_wait = 0.0
+
+    def metrics(self):
+        started = self.completed + self.in_flight
+        return {'priority': self.priority,
+                'reserved': self.reserved,
+                'queue_depth': len(self.waiting),
+                'max_queue': self.max_queue,
+                'in_flight': self.in_flight,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'mean_wait': self.waited / started if started else 0.0,
+                'max_wait': self.max_wait}
+
+
+class PriorityScheduler(object):
+    DEFAULT_CLASSES = (('interactive', {'reserved': 2}),
+                       ('batch', {'max_queue': 1000}))
+
+    def __init__(self, capacity=8, classes=DEFAULT_CLASSES, clock=time.monotonic):
+        """ classes lists (name, options) from highest to lowest priority, options
+        are reserved, max_queue and block.
+        """
+        self.capacity = capacity
+        self.clock = clock
+        self.classes = OrderedDict()
+        for priority, (name, options) in enumerate(classes):
+            self.classes[name] = PriorityClass(name, priority, **options)
+        for priority_class in self.classes.values():
+            if self._free_for(priority_class) <= 0:
+                raise ValueError('Reservations leave no capacity for the %s class' % priority_class.name)
+        self._condition = threading.Condition()
+
+    def _free_for(self, priority_class):
+        """ Slots this class may take without touching other classes' reservations """
+        in_flight = sum(other.in_flight for other in self.classes.values())
+        held_back = sum(max(0, other.reserved - other.in_flight) for other in self.classes.values()
+                        if other is not priority_class)
+        return self.capacity - in_flight - held_back
+
+    def _may_run(self, priority_class, ticket):
+        if priority_class.waiting[0] is not ticket:
+            return False
+        return self._slot_free(priority_class)
+
+    def _slot_free(self, priority_class):
+        if self._free_for(priority_class) <= 0:
+            return False
+        for other in self.classes.values():
+            if other.priority >= priority_class.priority:
+                break
+            if other.waiting and self._free_for(other) > 0:
+                return False
+        return True
+
+    def _queue_full(self, priority_class):
+        if priority_class.max_queue is None or len(priority_class.waiting) < priority_class.max_queue:
+            return False
+        # A request that can start right away never queues
+        return bool(priority_class.waiting) or not self._slot_free(priority_class)
+
+    def acquire(self, name, timeout=None):
+        """ Wait for a slot in class name, False if timeout passes first """
+        priority_class = self.classes[name]
+        started = self.clock()
+        ticket = object()
+        with self._condition:
+            while self._queue_full(priority_class):
+                remaining = None if timeout is None else timeout - (self.clock() - started)
+                if not priority_class.block or (remaining is not None and remaining <= 0):
+                    priority_class.rejected += 1
+                    raise USPSSchedulerFull('%s queue is full (%d waiting)' % (name, len(priority_class.waiting)))
+                self._condition.wait(remaining)
+
+            priority_class.waiting.append(ticket)
+            try:
+                while not self._may_run(priority_class, ticket):
+                    remaining = None if timeout is None else timeout - (self.clock() - started)
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+            finally:
+                priority_class.waiting.remove(ticket)
+                self._condition.notify_all()
+
+            waited = self.clock() - started
+            priority_class.in_flight += 1
+            priority_class.waited += waited
+            priority_class.max_wait = max(priority_class.max_wait, waited)
+            return True
+
+    def release(self, name):
+        with self._condition:
+            priority_class = self.classes[name]
+            priority_class.in_flight -= 1
+            priority_class.completed += 1
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self, name, timeout=None):
+        if not self.acquire(name, timeout):
+            raise USPSSchedulerFull('No %s slot within %.3fs' % (name, timeout))
+        try:
+            yield
+        finally:
+            self.release(name)
+
+    def metrics(self):
+        with self._condition:
+            return OrderedDict((name, priority_class.metrics()) for name, priority_class in self.classes.items())
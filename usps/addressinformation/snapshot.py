@@ -0,0 +1,115 @@
+'''
+Compact, memory mapped snapshots of result caches.
+
+cache = TTLCache(ttl=86400)
+address_validation = Address(user_id='YOUR_USER_ID', cache=cache)
+...
+cache.snapshot('address.snap')
+
+and in the next process
+
+cache = TTLCache(ttl=86400)
+cache.restore('address.snap')
+
+A snapshot is a sorted table of fixed size index records (64 bit key hash,
+offset, key and value lengths, expiry as a Unix timestamp) followed by the
+keys and JSON encoded values.  Opening one only maps the file, lookups are a
+binary search over the index, so restoring millions of entries costs no more
+than the entries that are actually read.
+'''
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+
+HEADER = struct.Struct('<8sQ')
+RECORD = struct.Struct('<QQIId')
+
+
+def key_hash(key):
+    return struct.unpack('<Q', hashlib.blake2b(key, digest_size=8).digest())[0]
+
+
+class CacheSnapshot(object):
+    """ Read only view of a snapshot file written by CacheSnapshot.write """
+    MAGIC = b'USPSSNP1'
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as source:
+            self._map = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = HEADER.unpack_from(self._map, 0)
+        if magic != self.MAGIC:
+            self._map.close()
+            raise ValueError('%s is not a cache snapshot' % path)
+        self._data_start = HEADER.size + self.count * RECORD.size
+
+    @classmethod
+    def write(cls, path, items):
+        """ items yields (key, value, expires) with expires a Unix timestamp.
+        The file is written next to path and renamed into place.
+        """
+        records = list()
+        blob = bytearray()
+        for key, value, expires in items:
+            key = key.encode('utf-8')
+            value = json.dumps(value, separators=(',', ':')).encode('utf-8')
+            records.append((key_hash(key), len(blob), len(key), len(value), expires))
+            blob += key
+            blob += value
+        records.sort()
+
+        partial = path + '.tmp'
+        with open(partial, 'wb') as target:
+            target.write(HEADER.pack(cls.MAGIC, len(records)))
+            for record in records:
+                target.write(RECORD.pack(*record))
+            target.write(blob)
+        os.replace(partial, path)
+        return len(records)
+
+    def __len__(self):
+        return self.count
+
+    def _record(self, index):
+        return RECORD.unpack_from(self._map, HEADER.size + index * RECORD.size)
+
+    def _key(self, record):
+        start = self._data_start + record[1]
+        return self._map[start:start + record[2]]
+
+    def _value(self, record):
+        start = self._data_start + record[1] + record[2]
+        return json.loads(self._map[start:start + record[3]].decode('utf-8'))
+
+    def lookup(self, key):
+        """ Return (value, expires) or None """
+        key = key.encode('utf-8')
+        wanted = key_hash(key)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._record(middle)[0] < wanted:
+                low = middle + 1
+            else:
+                high = middle
+        # Equal hashes are adjacent, compare the stored keys
+        while low < self.count:
+            record = self._record(low)
+            if record[0] != wanted:
+                break
+            if self._key(record) == key:
+                return self._value(record), record[4]
+            low += 1
+        return None
+
+    def items(self):
+        """ Yield every (key, value, expires) """
+        for index in range(self.count):
+            record = self._record(index)
+            yield self._key(record).decode('utf-8'), self._value(record), record[4]
+
+    def close(self):
+        self._map.close()
@@ -0,0 +1,225 @@
+'''
+Transports move an encoded request to USPS and hand back the response stream.
+
+USPSService delegates every round trip to its transport so the HTTP client can
+be swapped without touching make_xml/parse_xml.  Services created without a
+transport use default_transport(), which routes through a local usps.gateway
+when the USPS_GATEWAY environment variable names one.
+'''
+
+import http.client
+import io
+import os
+import queue
+import socket
+import threading
+from urllib.error import HTTPError
+from urllib.parse import parse_qs, urlsplit
+from urllib.request import urlopen
+
+
+def split_timeout(timeout):
+    """ Timeouts are None, seconds for both phases or a (connect, read) tuple """
+    if isinstance(timeout, tuple):
+        return timeout
+    return timeout, timeout
+
+
+class Transport(object):
+    """ Send the urlencoded body to url and return a readable binary stream.
+
+    timeout is None, a number of seconds or a (connect, read) tuple.
+    idempotent is False for requests that must never be sent twice.
+    """
+
+    def send(self, url, data, timeout=None, idempotent=True):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class UrllibTransport(Transport):
+    """ One urllib connection per request, the original behaviour.  urllib has a
+    single socket timeout so the larger of connect and read is used.
+    """
+
+    def send(self, url, data, timeout=None, idempotent=True):
+        if timeout is None:
+            return urlopen(url, data)
+        connect_timeout, read_timeout = split_timeout(timeout)
+        if connect_timeout is None or read_timeout is None:
+            return urlopen(url, data, connect_timeout or read_timeout)
+        return urlopen(url, data, max(connect_timeout, read_timeout))
+
+
+class PooledTransport(Transport):
+    """ Keeps up to maxsize persistent http.client connections per host. """
+    HEADERS = {'Content-Type': 'application/x-www-form-urlencoded',
+               'Connection': 'keep-alive'}
+
+    def __init__(self, maxsize=10):
+        self.maxsize = maxsize
+        self._pools = dict()
+        self._lock = threading.Lock()
+
+    def _pool(self, key):
+        with self._lock:
+            if key not in self._pools:
+                self._pools[key] = queue.LifoQueue(self.maxsize)
+            return self._pools[key]
+
+    def _connect(self, scheme, host, timeout):
+        connect_timeout, read_timeout = split_timeout(timeout)
+        if scheme == 'https':
+            connection = http.client.HTTPSConnection(host, timeout=connect_timeout)
+        else:
+            connection = http.client.HTTPConnection(host, timeout=connect_timeout)
+        connection.connect()
+        connection.sock.settimeout(read_timeout)
+        return connection
+
+    def send(self, url, data, timeout=None, idempotent=True):
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        pool = self._pool((parts.scheme, parts.netloc))
+
+        try:
+            connection = pool.get_nowait()
+        except queue.Empty:
+            connection = None
+        reused = connection is not None and connection.sock is not None
+        if reused:
+            connection.sock.settimeout(split_timeout(timeout)[1])
+        else:
+            connection = self._connect(parts.scheme, parts.netloc, timeout)
+
+        try:
+            written = False
+            try:
+                connection.request('POST', path, body=data, headers=self.HEADERS)
+                written = True
+                response = connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # Once the whole request went out USPS may have acted on it, only
+                # idempotent requests are sent again then
+                if not reused or (written and not idempotent):
+                    raise
+                # The server dropped an idle keep-alive connection, retry once on a fresh one
+                connection.close()
+                connection = self._connect(parts.scheme, parts.netloc, timeout)
+                connection.request('POST', path, body=data, headers=self.HEADERS)
+                response = connection.getresponse()
+            body = response.read()
+        except Exception:
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            try:
+                pool.put_nowait(connection)
+            except queue.Full:
+                connection.close()
+        if response.status >= 400:
+            # Same as urlopen, so callers and CredentialPool see the status
+            raise HTTPError(url, response.status, response.reason, response.msg, io.BytesIO(body))
+        return io.BytesIO(body)
+
+    def close(self):
+        with self._lock:
+            pools, self._pools = self._pools, dict()
+        for pool in pools.values():
+            while not pool.empty():
+                pool.get_nowait().close()
+
+
+class FakeTransport(Transport):
+    """ Answers in-process without any network.
+
+    handler is called with (api, xml_bytes) and returns the response bytes,
+    it defaults to usps.addressinformation.fake.respond.  Every request is
+    counted so tests and benchmarks can assert on round trips.
+    """
+
+    def __init__(self, handler=None):
+        if handler is None:
+            from usps.addressinformation.fake import respond as handler
+        self.handler = handler
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def send(self, url, data, timeout=None, idempotent=True):
+        form = parse_qs(data.decode('utf8'))
+        with self._lock:
+            self.requests += 1
+        return io.BytesIO(self.handler(form['API'][0], form['XML'][0].encode('utf8')))
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path, timeout=None):
+        http.client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class GatewayTransport(PooledTransport):
+    """ Sends every request to a usps.gateway daemon instead of the service url.
+
+    address is the gateway's Unix socket path (or "unix:" followed by it), a
+    "host:port" pair or an http:// URL.  The gateway batches, caches and
+    rate limits on behalf of every process pointed at it and signs requests
+    with its own USERIDs.
+    """
+
+    def __init__(self, address, maxsize=10):
+        super(GatewayTransport, self).__init__(maxsize)
+        self.address = address
+        self.unix_socket = None
+        if address.startswith('unix:'):
+            self.unix_socket = address[len('unix:'):]
+        elif address.startswith('/'):
+            self.unix_socket = address
+        if self.unix_socket is not None:
+            self.url = 'http://localhost/ShippingAPI.dll'
+        elif '://' in address:
+            self.url = address
+        else:
+            self.url = 'http://%s/ShippingAPI.dll' % address
+
+    def _connect(self, scheme, host, timeout):
+        if self.unix_socket is None:
+            return super(GatewayTransport, self)._connect(scheme, host, timeout)
+        connect_timeout, read_timeout = split_timeout(timeout)
+        connection = _UnixHTTPConnection(self.unix_socket, timeout=connect_timeout)
+        connection.connect()
+        connection.sock.settimeout(read_timeout)
+        return connection
+
+    def send(self, url, data, timeout=None, idempotent=True):
+        return super(GatewayTransport, self).send(self.url, data, timeout, idempotent)
+
+
+_gateway_transports = dict()
+_gateway_lock = threading.Lock()
+
+
+def default_transport():
+    """ A new UrllibTransport, or the process wide GatewayTransport for
+    USPS_GATEWAY when it is set.
+    """
+    address = os.environ.get('USPS_GATEWAY')
+    if not address:
+        return UrllibTransport()
+    with _gateway_lock:
+        if address not in _gateway_transports:
+            _gateway_transports[address] = GatewayTransport(address)
+        return _gateway_transports[address]
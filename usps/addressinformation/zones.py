@@ -0,0 +1,85 @@
+'''
+ZIP3 to ZIP3 postal zone matrix.
+
+The matrix is a 1000 x 1000 uint8 file (one byte per origin/destination ZIP3
+pair, 0 when unknown) that is memory-mapped rather than read, so opening it
+is instant and processes share the same pages.  Build it once from the
+published zone charts flattened to CSV:
+
+    Origin,DestinationStart,DestinationEnd,Zone
+    801,005,098,7
+    801,100,212,6
+    ...
+
+zone_matrix = ZoneMatrix.build('zone_charts.csv', 'zones.bin')
+zone_matrix = ZoneMatrix('zones.bin')
+zone_matrix.zone(80537, '20770')
+
+The batch lookup ZoneMatrix.zones requires numpy.
+'''
+
+import csv
+import mmap
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+
+def zip3(zip_code):
+    """ First three digits of a ZIP, ZIPs stored as ints lose their leading zeros """
+    text = str(zip_code).strip()
+    if text.isdigit() and len(text) < 5:
+        text = text.zfill(5)
+    return int(text[:3])
+
+
+class ZoneMatrix(object):
+    SIZE = 1000
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as source:
+            self._map = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) != self.SIZE * self.SIZE:
+            self._map.close()
+            raise ValueError('%s is not a %dx%d zone matrix' % (path, self.SIZE, self.SIZE))
+        self._matrix = None
+
+    @classmethod
+    def build(cls, chart_path, output_path):
+        matrix = bytearray(cls.SIZE * cls.SIZE)
+        with open(chart_path, newline='') as source:
+            for row in csv.DictReader(source):
+                origin = int(row['Origin'])
+                zone = int(row['Zone'])
+                start = origin * cls.SIZE + int(row['DestinationStart'])
+                end = origin * cls.SIZE + int(row['DestinationEnd']) + 1
+                matrix[start:end] = bytes([zone]) * (end - start)
+        with open(output_path, 'wb') as output:
+            output.write(matrix)
+        return cls(output_path)
+
+    def zone(self, origin_zip, destination_zip):
+        """ Zone between two ZIP codes, 0 when the charts do not cover the pair """
+        return self._map[zip3(origin_zip) * self.SIZE + zip3(destination_zip)]
+
+    def zones(self, origin_zips, destination_zips):
+        """ Vectorized zone lookup returning a uint8 numpy array """
+        if np is None:
+            raise ImportError('numpy is required for batch zone lookups, pip install numpy')
+        if self._matrix is None:
+            self._matrix = np.frombuffer(self._map, dtype=np.uint8).reshape(self.SIZE, self.SIZE)
+        return self._matrix[self._zip3_array(origin_zips), self._zip3_array(destination_zips)]
+
+    @staticmethod
+    def _zip3_array(zip_codes):
+        values = np.asarray(zip_codes)
+        if values.dtype.kind in 'iu':
+            return (values // 100) % 1000
+        return np.fromiter((zip3(value) for value in values.tolist()), dtype=np.intp, count=len(values))
+
+    def close(self):
+        self._matrix = None
+        self._map.close()
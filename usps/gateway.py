@@ -0,0 +1,447 @@
+'''
+Local USPS gateway shared by every worker process on a host.
+
+    python -m usps.gateway --user-id YOUR_USER_ID --socket /run/usps/gateway.sock
+    python -m usps.gateway --user-id KEY1 --user-id KEY2 --rate 5 --port 8765 --max-wait 0.01
+
+Workers keep calling Address, DomesticRate, Track and the other services as
+before, with USPS_GATEWAY=/run/usps/gateway.sock in their environment (or
+transport=GatewayTransport(...)), and send their requests here instead of to
+USPS.  The gateway owns the one PooledTransport, result cache and
+CredentialPool for all of them.  Verify, ZipCodeLookup, CityStateLookup,
+RateV4, IntlRateV2 and TrackV2 items arriving within --max-wait of each
+other are merged into full USPS batches and their IDs mapped back for each
+caller; other APIs are passed through.  Requests are signed with the
+gateway's USERIDs, whatever the caller sent.  GET /stats returns counters
+as JSON.
+'''
+
+import argparse
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from copy import deepcopy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from lxml import etree
+from lxml.etree import Element, SubElement
+
+from usps.addressinformation import Address, ZipCodeLookup, CityStateLookup, DomesticRate, IntlRateV2, Track, \
+    USPSXMLError, CredentialPool, PooledTransport, TTLCache
+from usps.addressinformation.base import USPSService
+
+# API: most items USPS takes in one request
+BATCHED = dict((service.API, service.MAX_BATCH_SIZE)
+               for service in (Address, ZipCodeLookup, CityStateLookup, DomesticRate, IntlRateV2, Track))
+# The ID of a TrackID is the tracking number itself, so it is never renumbered
+KEEP_IDS = ('TrackV2',)
+# Tracking events change by the minute, only these results are cached
+CACHED = ('Verify', 'ZipCodeLookup', 'CityStateLookup', 'RateV4', 'IntlRateV2')
+
+
+def error_body(info):
+    """ A USPS style Error document """
+    root = Element('Error')
+    for tag in ('Number', 'Source', 'Description'):
+        SubElement(root, tag).text = info.get(tag) or ''
+    return etree.tostring(root, xml_declaration=True, encoding='UTF-8')
+
+
+class GatewayService(USPSService):
+    """ Sends requests for one API upstream as they are """
+
+    def __init__(self, api, *args, **kwargs):
+        super(GatewayService, self).__init__(*args, **kwargs)
+        self.API = api
+
+
+class BatchQueue(object):
+    """ Items for one API and request header, sent upstream size at a time.
+    A batch goes out once it is full or its oldest item has waited max_wait.
+    After idle seconds without items the queue retires from its gateway and
+    its thread exits.
+    """
+
+    def __init__(self, gateway, api, tag, header, size, max_wait, idle=60.0):
+        self.gateway = gateway
+        self.api = api
+        self.tag = tag
+        self.header = header
+        self.size = size
+        self.max_wait = max_wait
+        self.idle = idle
+        self.pending = deque()
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name='usps-gateway-%s' % api, daemon=True)
+        self.thread.start()
+
+    @property
+    def key(self):
+        return self.api, self.tag, self.header
+
+    def put(self, item):
+        """ Queue item, the caller holds the gateway lock so the queue cannot retire meanwhile """
+        future = Future()
+        with self.condition:
+            self.pending.append((item, future, time.monotonic()))
+            if len(self.pending) == 1 or len(self.pending) >= self.size:
+                self.condition.notify()
+        return future
+
+    def _run(self):
+        while True:
+            with self.condition:
+                idle_until = time.monotonic() + self.idle
+                while not self.pending and not self.closed:
+                    remaining = idle_until - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                if not self.pending:
+                    if self.closed:
+                        return
+                    batch = None
+                else:
+                    flush_at = self.pending[0][2] + self.max_wait
+                    while len(self.pending) < self.size and not self.closed:
+                        remaining = flush_at - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self.condition.wait(remaining)
+                    batch = [self.pending.popleft() for _ in range(min(self.size, len(self.pending)))]
+            if batch is None:
+                # The gateway lock is taken outside the condition, in the same order as put()
+                if self.gateway.retire(self):
+                    return
+                continue
+            self.gateway.executor.submit(self.gateway.send_batch, self, batch)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+
+class Gateway(object):
+    """ Answers USPS Web Tools requests from local workers through one shared
+    transport, cache and CredentialPool.
+
+    cache is a TTLCache or shared backend for the CACHED APIs (None to turn
+    caching off) and max_wait how long the first item of a batch waits for
+    others to fill it.  There is one BatchQueue per API and request header,
+    at most max_queues at once; requests that would need another are
+    forwarded unbatched.  timeout bounds each worker request as a whole.
+    """
+
+    def __init__(self, url='https://secure.shippingapis.com/ShippingAPI.dll', user_ids=(), rate=None,
+                 transport=None, cache=None, max_wait=0.005, timeout=None, max_workers=32, credentials=None,
+                 max_queues=64, idle=60.0):
+        self.url = url
+        self.transport = transport or PooledTransport(maxsize=max_workers)
+        self.cache = cache
+        self.credentials = credentials or CredentialPool(user_ids, rate=rate)
+        if not len(self.credentials):
+            raise ValueError('The gateway needs at least one USPS USERID')
+        self.max_wait = max_wait
+        self.timeout = timeout
+        self.max_queues = max_queues
+        self.idle = idle
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='usps-gateway')
+        self.services = dict()
+        self.queues = dict()
+        self.counters = dict(requests=0, forwarded=0, items=0, cache_hits=0, batches=0, batched_items=0,
+                             over_queue_limit=0)
+        self._lock = threading.Lock()
+
+    def _count(self, **counts):
+        with self._lock:
+            for name, count in counts.items():
+                self.counters[name] += count
+
+    def service(self, api):
+        with self._lock:
+            if api not in self.services:
+                self.services[api] = GatewayService(api, self.url, transport=self.transport, timeout=self.timeout,
+                                                    credentials=self.credentials)
+            return self.services[api]
+
+    def enqueue(self, api, tag, header, items):
+        """ Futures for items on the queue for (api, tag, header), None when
+        that queue does not exist and max_queues are already running.
+        """
+        key = (api, tag, header)
+        with self._lock:
+            queue = self.queues.get(key)
+            if queue is None:
+                if len(self.queues) >= self.max_queues:
+                    return None
+                queue = self.queues[key] = BatchQueue(self, api, tag, header, BATCHED[api], self.max_wait,
+                                                      self.idle)
+            return [queue.put(item) for item in items]
+
+    def retire(self, queue):
+        """ Drop an idle queue, False if items arrived in the meantime """
+        with self._lock:
+            with queue.condition:
+                if queue.pending:
+                    return False
+                queue.closed = True
+            if self.queues.get(queue.key) is queue:
+                del self.queues[queue.key]
+            return True
+
+    def handle(self, api, xml):
+        """ Response bytes for one request from a worker """
+        self._count(requests=1)
+        request = etree.fromstring(xml)
+        items = [child for child in request if child.get('ID') is not None]
+        if api not in BATCHED or not items:
+            return self.forward(api, request)
+
+        header = b''.join(etree.tostring(child) for child in request if child.get('ID') is None)
+        original_ids = [item.get('ID') for item in items]
+        keys = list()
+        for item in items:
+            if api not in KEEP_IDS:
+                item.set('ID', '')
+            keys.append('%s|%s' % (api, etree.tostring(item).decode('utf8')))
+        cached = dict()
+        if self.cache is not None and api in CACHED:
+            cached = self.cache.get_many(keys)
+
+        missing = [item for key, item in zip(keys, items) if key not in cached]
+        futures = self.enqueue(api, request.tag, header, missing) if missing else list()
+        if futures is None:
+            self._count(over_queue_limit=1)
+            for item, item_id in zip(items, original_ids):
+                item.set('ID', item_id)
+            return self.forward(api, request)
+        self._count(items=len(items), cache_hits=len(cached))
+
+        # One deadline for the whole request, however many items it has
+        done, not_done = wait(futures, self.timeout)
+        if not_done:
+            for future in not_done:
+                future.cancel()
+            raise TimeoutError('No upstream answer for %d of %d %s items within %.3fs'
+                               % (len(not_done), len(items), api, self.timeout))
+        for future in futures:
+            if isinstance(future.exception(), USPSXMLError):
+                # The whole upstream request was refused, answer like USPS would
+                return error_body(future.exception().info)
+
+        name = request.tag[:-len('Request')] if request.tag.endswith('Request') else request.tag
+        response = Element(name + 'Response')
+        fresh = dict()
+        answers = iter(futures)
+        for key, item_id in zip(keys, original_ids):
+            if key in cached:
+                result = etree.fromstring(cached[key])
+            else:
+                result = next(answers).result()
+                if result.find('.//Error') is None:
+                    fresh[key] = etree.tostring(result).decode('utf8')
+            result = deepcopy(result)
+            result.set('ID', item_id)
+            response.append(result)
+        if fresh and self.cache is not None and api in CACHED:
+            self.cache.set_many(fresh)
+        return etree.tostring(response, xml_declaration=True, encoding='UTF-8')
+
+    def forward(self, api, request):
+        self._count(forwarded=1)
+        try:
+            root = self.service(api).submit_xml(request, partial=True)
+        except USPSXMLError as error:
+            return error_body(error.info)
+        return etree.tostring(root, xml_declaration=True, encoding='UTF-8')
+
+    def send_batch(self, queue, batch):
+        """ One upstream request for batch, resolving each item's future """
+        root = Element(queue.tag)
+        for child in etree.fromstring(b'<Header>' + queue.header + b'</Header>'):
+            root.append(child)
+        # Items whose request already timed out were cancelled, leave them out
+        batch = [entry for entry in batch if entry[1].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        waiting = dict()
+        for position, (item, future, _) in enumerate(batch):
+            if queue.api not in KEEP_IDS:
+                item.set('ID', str(position))
+            waiting.setdefault(item.get('ID'), deque()).append(future)
+            root.append(item)
+        self._count(batches=1, batched_items=len(batch))
+        try:
+            response = self.service(queue.api).submit_xml(root, partial=True)
+        except Exception as error:
+            for _, future, _ in batch:
+                future.set_exception(error)
+            return
+        for result in list(response):
+            futures = waiting.get(result.get('ID'))
+            if futures:
+                futures.popleft().set_result(result)
+        for item_id, futures in waiting.items():
+            for future in futures:
+                missing = Element(batch[0][0].tag, ID=item_id)
+                error = SubElement(missing, 'Error')
+                SubElement(error, 'Number').text = ''
+                SubElement(error, 'Source').text = queue.api
+                SubElement(error, 'Description').text = 'No result for ID %s' % item_id
+                future.set_result(missing)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['queued'] = sum(len(queue.pending) for queue in self.queues.values())
+        stats['credentials'] = self.credentials.metrics()
+        if self.cache is not None and hasattr(self.cache, '__len__'):
+            stats['cache_size'] = len(self.cache)
+        return stats
+
+    def close(self):
+        with self._lock:
+            queues = list(self.queues.values())
+        for queue in queues:
+            queue.close()
+        for queue in queues:
+            queue.thread.join()
+        self.executor.shutdown(wait=True)
+        self.transport.close()
+
+
+class GatewayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        # TCP_NODELAY does not exist for Unix sockets
+        self.disable_nagle_algorithm = self.server.address_family != socket.AF_UNIX
+        BaseHTTPRequestHandler.setup(self)
+
+    def _send(self, status, body, content_type='text/xml'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _answer(self, form):
+        try:
+            api, xml = form['API'][0], form['XML'][0]
+        except KeyError:
+            self._send(400, b'API and XML are required', 'text/plain')
+            return
+        try:
+            body = self.server.gateway.handle(api, xml.encode('utf8'))
+        except etree.XMLSyntaxError as error:
+            self._send(400, str(error).encode('utf8'), 'text/plain')
+        except Exception as error:
+            self._send(502, ('%s: %s' % (type(error).__name__, error)).encode('utf8'), 'text/plain')
+        else:
+            self._send(200, body)
+
+    def do_POST(self):
+        self._answer(parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode('utf8')))
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        if parts.path == '/stats':
+            self._send(200, json.dumps(self.server.gateway.stats()).encode('utf8'), 'application/json')
+            return
+        self._answer(parse_qs(parts.query))
+
+    def address_string(self):
+        # Unix socket peers have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, *args)
+
+
+class GatewayHTTPServer(ThreadingHTTPServer):
+    """ The gateway on a loopback TCP port """
+    daemon_threads = True
+
+    def __init__(self, gateway, host='127.0.0.1', port=8765, verbose=False):
+        ThreadingHTTPServer.__init__(self, (host, port), GatewayHandler)
+        self.gateway = gateway
+        self.verbose = verbose
+
+    @property
+    def address(self):
+        return '%s:%d' % self.server_address[:2]
+
+
+class GatewayUnixServer(socketserver.ThreadingUnixStreamServer):
+    """ The gateway on a Unix socket, file permissions decide who may use it """
+    daemon_threads = True
+
+    def __init__(self, gateway, path, verbose=False):
+        if os.path.exists(path):
+            os.unlink(path)
+        socketserver.ThreadingUnixStreamServer.__init__(self, path, GatewayHandler)
+        self.gateway = gateway
+        self.verbose = verbose
+
+    @property
+    def address(self):
+        return self.server_address
+
+    def server_close(self):
+        socketserver.ThreadingUnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m usps.gateway', description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--user-id', action='append', required=True, help='USPS USERID, repeat for several')
+    parser.add_argument('--rate', type=float, help='requests per second allowed for each USERID')
+    parser.add_argument('--url', default='https://secure.shippingapis.com/ShippingAPI.dll', help='upstream USPS url')
+    parser.add_argument('--socket', help='listen on this Unix socket instead of TCP')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--max-wait', type=float, default=0.005,
+                        help='seconds an item may wait for others to fill its batch')
+    parser.add_argument('--cache-ttl', type=float, default=3600, help='seconds to keep results, 0 turns caching off')
+    parser.add_argument('--cache-size', type=int, default=100000)
+    parser.add_argument('--timeout', type=float, help='seconds a worker request may take, upstream included')
+    parser.add_argument('--connections', type=int, default=32, help='upstream connections and batches in flight')
+    parser.add_argument('--max-queues', type=int, default=64,
+                        help='batch queues open at once, requests past it are forwarded unbatched')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    arguments = parser.parse_args(argv)
+
+    cache = TTLCache(ttl=arguments.cache_ttl, maxsize=arguments.cache_size) if arguments.cache_ttl > 0 else None
+    gateway = Gateway(arguments.url, arguments.user_id, rate=arguments.rate, cache=cache, max_wait=arguments.max_wait,
+                      timeout=arguments.timeout, max_workers=arguments.connections, max_queues=arguments.max_queues)
+    if arguments.socket:
+        server = GatewayUnixServer(gateway, arguments.socket, arguments.verbose)
+    else:
+        server = GatewayHTTPServer(gateway, arguments.host, arguments.port, arguments.verbose)
+    # serve_forever returns once shutdown is called from another thread
+    signal.signal(signal.SIGTERM, lambda received, frame: threading.Thread(target=server.shutdown).start())
+    sys.stderr.write('usps.gateway listening on %s\n' % server.address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        gateway.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,246 @@
+'''
+End-to-end throughput harness for usps.addressinformation.
+
+    python -m usps.loadtest --duration 30 --concurrency 32
+    python -m usps.loadtest --service address --service rate --requests 100000 --server-latency 0.05
+    python -m usps.loadtest --url http://127.0.0.1:8080/ShippingAPI.dll --duration 60 --json
+
+Worker threads push synthetic requests (usps.workload) through the public
+service classes and a shared PooledTransport, so XML building, HTTP, parsing
+and result handling are all on the measured path.  Unless --url is given a
+FakeUSPSServer is started on loopback, --server-latency and --server-errors
+make it slow or flaky.  The report gives sustained requests/second, latency
+percentiles, error rates per service and the peak RSS of this process
+(n/a where the resource module does not exist, as on Windows).
+'''
+
+import argparse
+import json
+import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+from usps.addressinformation import Address, DomesticRate, IntlRateV2, Track, CarrierPickupAvailability, \
+    CarrierPickupSchedule, CarrierPickupCancel, CarrierPickupChange, MailService, ServiceDelivery, PooledTransport
+from usps.addressinformation.base import CarrierPickupInquiry
+from usps.addressinformation.fake import FakeUSPSServer
+from usps.workload import WorkloadGenerator
+
+
+def _batch(service, items):
+    return service.execute_batch(items)
+
+
+def _single(service, items):
+    item, = items
+    return service.submit_xml(service.make_xml(item))
+
+
+# name: (service class, workload kind, call, items per request)
+SCENARIOS = OrderedDict([
+    ('address', (Address, 'address', _batch, Address.MAX_BATCH_SIZE)),
+    ('rate', (DomesticRate, 'domestic_package', _batch, DomesticRate.MAX_BATCH_SIZE)),
+    ('intl', (IntlRateV2, 'intl_package', _batch, IntlRateV2.MAX_BATCH_SIZE)),
+    ('track', (Track, 'tracking_id', _batch, Track.MAX_BATCH_SIZE)),
+    ('pickup_availability', (CarrierPickupAvailability, 'pickup_availability', _single, 1)),
+    ('pickup_schedule', (CarrierPickupSchedule, 'pickup_schedule', _single, 1)),
+    ('pickup_change', (CarrierPickupChange, 'pickup_change', _single, 1)),
+    ('pickup_cancel', (CarrierPickupCancel, 'pickup_cancel', _single, 1)),
+    ('pickup_inquiry', (CarrierPickupInquiry, 'pickup_cancel', _single, 1)),
+    ('mail_service', (MailService, 'mail_service',
+                      lambda service, items: service.submit_xml(service.make_xml(items[0], 'PriorityMail')), 1)),
+    ('sdc', (ServiceDelivery, 'service_delivery', lambda service, items: service.get_locations(items[0]), 1)),
+])
+
+
+def peak_rss():
+    """ Peak resident set size of this process in bytes, None where it cannot be read """
+    try:
+        import resource
+    except ImportError:
+        # Unix only
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class ServiceStats(object):
+
+    def __init__(self):
+        self.latencies = array('d')
+        self.items = 0
+        self.errors = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, latency, items, error=None):
+        with self._lock:
+            self.latencies.append(latency)
+            self.items += items
+            if error is not None:
+                name = type(error).__name__
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    def report(self, elapsed):
+        ordered = sorted(self.latencies)
+        requests = len(ordered)
+        errors = sum(self.errors.values())
+        return {'requests': requests,
+                'items': self.items,
+                'errors': errors,
+                'error_rate': errors / requests if requests else 0.0,
+                'error_types': dict(self.errors),
+                'requests_per_second': requests / elapsed if elapsed else 0.0,
+                'p50': percentile(ordered, 0.50),
+                'p90': percentile(ordered, 0.90),
+                'p99': percentile(ordered, 0.99),
+                'p999': percentile(ordered, 0.999),
+                'max': ordered[-1] if ordered else 0.0}
+
+
+class LoadTest(object):
+    """ Runs the named scenarios round robin from concurrency threads until
+    duration seconds pass or requests requests were sent.
+    """
+
+    def __init__(self, url, services=None, concurrency=16, user_id='LOADTEST', seed=0, pool=2000, invalid_rate=0.0,
+                 transport=None):
+        self.url = url
+        self.names = list(services or SCENARIOS)
+        self.concurrency = concurrency
+        self.transport = transport or PooledTransport(maxsize=concurrency)
+        self.stats = OrderedDict((name, ServiceStats()) for name in self.names)
+        self.services = dict()
+        self.items = dict()
+        generator = WorkloadGenerator(seed=seed, invalid_rate=invalid_rate)
+        for name in self.names:
+            service_class, kind, _, _ = SCENARIOS[name]
+            self.services[name] = service_class(user_id, url=url, transport=self.transport)
+            # Generated up front so the harness's own work stays off the measured path
+            self.items[name] = list(generator.stream(kind, pool))
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def _next(self, limit):
+        with self._lock:
+            if limit is not None and self._counter >= limit:
+                return None
+            self._counter += 1
+            return self._counter
+
+    def _worker(self, offset, stop_at, limit):
+        position = offset
+        while time.monotonic() < stop_at:
+            number = self._next(limit)
+            if number is None:
+                return
+            name = self.names[number % len(self.names)]
+            service = self.services[name]
+            _, _, call, size = SCENARIOS[name]
+            pool = self.items[name]
+            items = [pool[(position + index) % len(pool)] for index in range(size)]
+            position += size
+            error = None
+            started = time.perf_counter()
+            try:
+                call(service, items)
+            except Exception as exception:
+                error = exception
+            self.stats[name].record(time.perf_counter() - started, size, error)
+
+    def run(self, duration=None, requests=None):
+        if duration is None and requests is None:
+            raise ValueError('Give a duration, a number of requests or both')
+        started = time.monotonic()
+        stop_at = started + duration if duration is not None else float('inf')
+        threads = [threading.Thread(target=self._worker, args=(index * 7919, stop_at, requests), daemon=True)
+                   for index in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.report(time.monotonic() - started)
+
+    def report(self, elapsed):
+        services = OrderedDict((name, stats.report(elapsed)) for name, stats in self.stats.items())
+        total = ServiceStats()
+        for stats in self.stats.values():
+            total.latencies.extend(stats.latencies)
+            total.items += stats.items
+            for name, count in stats.errors.items():
+                total.errors[name] = total.errors.get(name, 0) + count
+        return {'elapsed': elapsed,
+                'concurrency': self.concurrency,
+                'peak_rss': peak_rss(),
+                'total': total.report(elapsed),
+                'services': services}
+
+
+def format_report(report):
+    lines = ['%-20s %9s %9s %9s %7s %9s %9s %9s %9s' % ('service', 'requests', 'items', 'req/s', 'errors',
+                                                        'p50 ms', 'p90 ms', 'p99 ms', 'p99.9 ms')]
+    rows = list(report['services'].items()) + [('total', report['total'])]
+    for name, row in rows:
+        lines.append('%-20s %9d %9d %9.1f %6.2f%% %9.2f %9.2f %9.2f %9.2f' % (
+            name, row['requests'], row['items'], row['requests_per_second'], row['error_rate'] * 100,
+            row['p50'] * 1000, row['p90'] * 1000, row['p99'] * 1000, row['p999'] * 1000))
+    peak = 'n/a' if report['peak_rss'] is None else '%.1f MiB' % (report['peak_rss'] / 1048576.0)
+    lines.append('%.1fs at concurrency %d, peak RSS %s' % (report['elapsed'], report['concurrency'], peak))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m usps.loadtest', description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--service', choices=list(SCENARIOS), action='append',
+                        help='scenario to run, repeat for several (default: all)')
+    parser.add_argument('--concurrency', type=int, default=16, help='worker threads')
+    parser.add_argument('--duration', type=float, help='seconds to run (default 10 unless --requests is given)')
+    parser.add_argument('--requests', type=int, help='stop after this many requests')
+    parser.add_argument('--pool', type=int, default=2000, help='distinct synthetic items per scenario')
+    parser.add_argument('--invalid-rate', type=float, default=0.0,
+                        help='share of addresses and tracking numbers that should be rejected')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--user-id', default='LOADTEST')
+    parser.add_argument('--url', help='server to load instead of the built-in stand-in')
+    parser.add_argument('--server-latency', type=float, default=0.0, help='mean stand-in server delay in seconds')
+    parser.add_argument('--server-errors', type=float, default=0.0, help='share of stand-in responses that are 503')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    arguments = parser.parse_args(argv)
+
+    duration = arguments.duration
+    if duration is None and arguments.requests is None:
+        duration = 10.0
+
+    server = None
+    url = arguments.url
+    if url is None:
+        server = FakeUSPSServer(latency=arguments.server_latency, error_rate=arguments.server_errors,
+                                seed=arguments.seed).start()
+        url = server.url
+    load_test = LoadTest(url, arguments.service, arguments.concurrency, arguments.user_id, arguments.seed,
+                         arguments.pool, arguments.invalid_rate)
+    try:
+        report = load_test.run(duration, arguments.requests)
+    finally:
+        load_test.transport.close()
+        if server is not None:
+            server.stop()
+
+    if arguments.json:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        print(format_report(report))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,174 @@
+'''
+Phase level profiler for usps.addressinformation workloads.
+
+    python -m usps.profile --service address --count 5000
+    python -m usps.profile --service rate --count 2000 --batch 25 --memory
+    python -m usps.profile --service track --fixture track_response.xml --cprofile track.prof
+    python -m usps.profile --service address --url http://127.0.0.1:8080/ShippingAPI.dll
+
+Each request is split into make_xml, network (transport round trip including
+reading the body), lxml_parse (read_response), parse_xml and, for Address,
+format_response, and wall time, CPU time and optionally tracemalloc
+allocations are reported per service class and phase.  By default requests
+are answered in-process by FakeTransport, --fixture replays a recorded
+response and --url sends them to a (stand-in) server.  --cprofile writes a
+cProfile file that snakeviz, gprof2dot or flameprof can turn into a call graph
+or flame graph.
+'''
+
+import argparse
+import cProfile
+import io
+import itertools
+import json
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from usps.addressinformation import Address, DomesticRate, IntlRateV2, Track, FakeTransport, PooledTransport
+
+SAMPLES = {
+    'address': (Address, [{'Address2': '500 E. third st', 'City': 'Loveland', 'State': 'CO', 'Zip5': '80537'},
+                          {'Address1': 'Suite 200', 'Address2': '760 Charcot Ave', 'City': 'San Jose', 'State': 'CA'},
+                          {'FirmName': 'PostGround Corp', 'Address2': '1 Infinite Loop', 'City': 'Cupertino',
+                           'State': 'CA', 'Zip5': '95014'}]),
+    'rate': (DomesticRate, [{'Service': 'PRIORITY', 'ZipOrigination': '44106', 'ZipDestination': '20770',
+                             'Pounds': 1, 'Ounces': 8, 'Container': 'VARIABLE', 'Machinable': True},
+                            {'Service': 'FIRST CLASS', 'FirstClassMailType': 'LETTER', 'ZipOrigination': '44106',
+                             'ZipDestination': '94107', 'Pounds': 0, 'Ounces': 3.5, 'Container': 'VARIABLE'}]),
+    'intl': (IntlRateV2, [{'Pounds': 1, 'Ounces': 8, 'MailType': 'Package', 'ValueOfContents': 200,
+                           'Country': 'Australia', 'Container': 'RECTANGULAR', 'Width': 15, 'Length': 30,
+                           'Height': 15, 'OriginZip': 18701},
+                          {'Pounds': 0, 'Ounces': 12, 'MailType': 'Envelope', 'ValueOfContents': 20,
+                           'Country': 'Canada', 'Container': 'VARIABLE', 'OriginZip': 18701}]),
+    'track': (Track, ['9405536897846333893331', '9400111899223197428490', '9205590164917312751089']),
+}
+
+
+class PhaseProfiler(object):
+    """ Accumulates wall time, CPU time and allocations per (service, phase) """
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.phases = OrderedDict()
+
+    @contextmanager
+    def phase(self, service, name):
+        if self.memory:
+            before, _ = tracemalloc.get_traced_memory()
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            stats = self.phases.setdefault((service, name), {'calls': 0, 'wall': 0.0, 'cpu': 0.0,
+                                                            'allocated': 0, 'peak': 0})
+            stats['calls'] += 1
+            stats['wall'] += wall
+            stats['cpu'] += cpu
+            if self.memory:
+                after, peak = tracemalloc.get_traced_memory()
+                stats['allocated'] += max(0, after - before)
+                stats['peak'] = max(stats['peak'], peak - before)
+
+    def report(self):
+        total = sum(stats['wall'] for stats in self.phases.values()) or 1.0
+        rows = list()
+        for (service, name), stats in self.phases.items():
+            row = dict(stats, service=service, phase=name, share=stats['wall'] / total)
+            rows.append(row)
+        return rows
+
+    def format(self):
+        lines = ['%-14s %-16s %8s %10s %10s %7s %12s %12s' % ('service', 'phase', 'calls', 'wall s', 'cpu s',
+                                                             'share', 'alloc KiB', 'peak KiB')]
+        for row in self.report():
+            lines.append('%-14s %-16s %8d %10.4f %10.4f %6.1f%% %12.1f %12.1f' % (
+                row['service'], row['phase'], row['calls'], row['wall'], row['cpu'], row['share'] * 100,
+                row['allocated'] / 1024.0, row['peak'] / 1024.0))
+        return '\n'.join(lines)
+
+
+def run(service, items, count, batch, profiler):
+    """ Push count items through service in batches, timing every phase """
+    name = type(service).__name__
+    batch = max(1, min(batch, service.MAX_BATCH_SIZE))
+    source = itertools.cycle(items)
+    done = 0
+    while done < count:
+        chunk = list(itertools.islice(source, min(batch, count - done)))
+        with profiler.phase(name, 'make_xml'):
+            xml = service.make_batch_xml(chunk)
+        with profiler.phase(name, 'network'):
+            body = service.send_xml(xml).read()
+        with profiler.phase(name, 'lxml_parse'):
+            root = service.read_response(io.BytesIO(body))
+        with profiler.phase(name, 'parse_xml'):
+            results = service.parse_xml(root)
+        if isinstance(service, Address):
+            with profiler.phase(name, 'format_response'):
+                for result in results:
+                    service.format_response(result, True)
+        done += len(chunk)
+
+
+def make_transport(arguments):
+    if arguments.url:
+        return PooledTransport()
+    if arguments.fixture:
+        with open(arguments.fixture, 'rb') as source:
+            recorded = source.read()
+        return FakeTransport(lambda api, xml: recorded)
+    return FakeTransport()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m usps.profile', description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--service', choices=sorted(SAMPLES), action='append',
+                        help='workload to run, repeat for several (default: all)')
+    parser.add_argument('--count', type=int, default=1000, help='items per service')
+    parser.add_argument('--batch', type=int, default=25, help='items per request, capped at the API maximum')
+    parser.add_argument('--user-id', default='PROFILE')
+    parser.add_argument('--url', help='send requests to this server instead of answering in-process')
+    parser.add_argument('--fixture', help='file holding a recorded response to replay for every request')
+    parser.add_argument('--memory', action='store_true', help='trace allocations with tracemalloc (slower)')
+    parser.add_argument('--cprofile', metavar='FILE', help='write cProfile stats to FILE')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    arguments = parser.parse_args(argv)
+
+    profiler = PhaseProfiler(memory=arguments.memory)
+    transport = make_transport(arguments)
+    if arguments.memory:
+        tracemalloc.start()
+    cprofile = cProfile.Profile() if arguments.cprofile else None
+    if cprofile is not None:
+        cprofile.enable()
+    try:
+        for key in arguments.service or sorted(SAMPLES):
+            service_class, items = SAMPLES[key]
+            kwargs = {'transport': transport}
+            if arguments.url:
+                kwargs['url'] = arguments.url
+            run(service_class(arguments.user_id, **kwargs), items, arguments.count, arguments.batch, profiler)
+    finally:
+        if cprofile is not None:
+            cprofile.disable()
+            cprofile.dump_stats(arguments.cprofile)
+        if arguments.memory:
+            tracemalloc.stop()
+        transport.close()
+
+    if arguments.json:
+        json.dump(profiler.report(), sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        print(profiler.format())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
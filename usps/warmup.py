@@ -0,0 +1,92 @@
+'''
+Pre-populate a result cache from historical requests and write a snapshot.
+
+    python -m usps.warmup --service address --input addresses.jsonl --snapshot address.snap --user-id YOUR_USER_ID
+    python -m usps.warmup --service rate --input packages.jsonl --snapshot rate.snap --ttl 86400
+    python -m usps.warmup --service sdc --input sdc.jsonl --snapshot sdc.snap --merge
+
+The input holds one request dict per line, in the form passed to the
+service (Address fields, RateV4 Package fields or SDCGetLocations fields).
+Distinct requests are sent in batches of the API maximum and a rejected
+item only loses its own result, not the rest of its batch.  New
+processes load the result with TTLCache.restore.
+'''
+
+import argparse
+import json
+import os
+import sys
+import time
+
+from usps.addressinformation import (Address, DomesticRate, ServiceDelivery, TTLCache, USPSXMLError,
+                                     PooledTransport, normalize_address)
+
+SERVICES = {
+    'address': Address,
+    'rate': DomesticRate,
+    'sdc': ServiceDelivery,
+}
+
+
+def read_requests(path):
+    with open(path) as source:
+        for line in source:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def warm(service, requests):
+    """ Send requests through service.execute_cached, returns (sent, entries
+    added, failed).  Only entries fetched from USPS count as added, not ones
+    already in the cache or restored from a merged snapshot.
+    """
+    requests = list(requests)
+    keys = [service.cache_key(request) for request in requests]
+    known = set(service.cache.get_many(set(key for key in keys if key is not None)))
+    results = service.execute_cached(requests, partial=True)
+    failed = sum(1 for result in results if isinstance(result, USPSXMLError))
+    added = set(key for key, result in zip(keys, results)
+                if key is not None and key not in known and not isinstance(result, USPSXMLError))
+    return len(requests), len(added), failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m usps.warmup', description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--service', choices=sorted(SERVICES), required=True)
+    parser.add_argument('--input', required=True, help='JSON lines file of historical requests')
+    parser.add_argument('--snapshot', required=True, help='snapshot file to write')
+    parser.add_argument('--merge', action='store_true', help='keep the live entries of an existing snapshot')
+    parser.add_argument('--ttl', type=int, default=86400, help='seconds the warmed entries stay valid')
+    parser.add_argument('--normalize', action='store_true', help='normalize addresses before sending them')
+    parser.add_argument('--user-id', default=os.environ.get('USPS_USER_ID', ''))
+    parser.add_argument('--url', help='send requests to this server instead of USPS')
+    arguments = parser.parse_args(argv)
+
+    cache = TTLCache(ttl=arguments.ttl, maxsize=sys.maxsize)
+    if arguments.merge and os.path.exists(arguments.snapshot):
+        cache.restore(arguments.snapshot)
+
+    transport = PooledTransport()
+    kwargs = {'transport': transport, 'cache': cache}
+    if arguments.url:
+        kwargs['url'] = arguments.url
+    service = SERVICES[arguments.service](arguments.user_id, **kwargs)
+
+    requests = read_requests(arguments.input)
+    if arguments.service == 'address' and arguments.normalize:
+        requests = (normalize_address(request) for request in requests)
+
+    started = time.perf_counter()
+    try:
+        sent, added, failed = warm(service, requests)
+    finally:
+        transport.close()
+    written = cache.snapshot(arguments.snapshot)
+    print('%d requests, %d new entries, %d failed, %d entries written to %s in %.1fs' % (
+        sent, added, failed, written, arguments.snapshot, time.perf_counter() - started))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,178 @@
+'''
+Synthetic request data for load tests and benchmarks.
+
+generator = WorkloadGenerator(seed=7)
+addresses = list(generator.stream('address', 100000))
+packages = [generator.domestic_package() for _ in range(1000)]
+
+Addresses mix street name spellings, units and firm names the way customer
+input does, packages draw services, containers, first class mail types and
+special services from usps.constants, and a share of every stream repeats
+earlier items with a Zipf-like skew so caches see realistic hit rates.
+invalid_rate makes that share of addresses and tracking numbers ones the
+stand-in server rejects.
+'''
+
+import datetime
+import random
+
+from usps.addressinformation.normalize import STREET_SUFFIXES, SECONDARY_UNITS
+from usps.constants import CARRIER_PICKUP_SCHEDULE_REQUEST_SERVICE_TYPE, CONTAINER, FIRST_CLASS_MAIL_TYPE, \
+    SPECIAL_SERVICE
+
+CITIES = [('New York', 'NY', '10001'), ('Los Angeles', 'CA', '90012'), ('Chicago', 'IL', '60601'),
+          ('Houston', 'TX', '77002'), ('Phoenix', 'AZ', '85004'), ('Philadelphia', 'PA', '19103'),
+          ('San Antonio', 'TX', '78205'), ('San Diego', 'CA', '92101'), ('Dallas', 'TX', '75201'),
+          ('San Jose', 'CA', '95113'), ('Austin', 'TX', '78701'), ('Columbus', 'OH', '43215'),
+          ('Charlotte', 'NC', '28202'), ('Indianapolis', 'IN', '46204'), ('Seattle', 'WA', '98101'),
+          ('Denver', 'CO', '80202'), ('Loveland', 'CO', '80537'), ('Boston', 'MA', '02108'),
+          ('Nashville', 'TN', '37203'), ('Portland', 'OR', '97204'), ('Cleveland', 'OH', '44106'),
+          ('Bowie', 'MD', '20770'), ('Cupertino', 'CA', '95014'), ('San Juan', 'PR', '00901')]
+STREETS = ['Main', 'Oak', 'Pine', 'Maple', 'Cedar', 'Elm', 'Washington', 'Lake', 'Hill', 'Park', 'Third',
+           'First', 'Second', 'Charcot', 'Sunset', 'Lincoln', 'Jackson', 'Church', 'Highland', 'Infinite']
+DIRECTIONS = ['', '', '', 'N', 'S', 'E', 'W', 'North', 'East']
+FIRMS = ['PostGround Corp', 'Acme Widgets', 'Blue Sky Books', 'Rocky Mountain Supply', 'Harbor Freight Co']
+COUNTRIES = ['Canada', 'Mexico', 'United Kingdom (Great Britain and Northern Ireland)', 'Germany', 'France',
+             'Australia', 'Japan', 'Brazil', 'India', 'South Africa', 'Netherlands', 'Korea, Republic of (South Korea)']
+DOMESTIC_SERVICES = ['PRIORITY', 'PRIORITY', 'FIRST CLASS', 'PRIORITY MAIL EXPRESS', 'PARCEL SELECT GROUND',
+                     'MEDIA', 'LIBRARY', 'ALL']
+INTL_MAIL_TYPES = ['Package', 'Envelope', 'LargeEnvelope', 'FlatRate', 'Postcards']
+SUFFIX_SPELLINGS = sorted(STREET_SUFFIXES)
+UNIT_SPELLINGS = sorted(SECONDARY_UNITS)
+
+
+class WorkloadGenerator(object):
+    """ Deterministic for a given seed.  repeat_share of each stream is drawn
+    again from the items already produced, earlier ones more often.
+    """
+    KINDS = ('address', 'domestic_package', 'intl_package', 'tracking_id', 'pickup_availability',
+             'pickup_schedule', 'pickup_change', 'pickup_cancel', 'mail_service', 'service_delivery')
+
+    def __init__(self, seed=None, repeat_share=0.3, invalid_rate=0.0, pool_size=10000):
+        self.random = random.Random(seed)
+        self.repeat_share = repeat_share
+        self.invalid_rate = invalid_rate
+        self.pool_size = pool_size
+        self._pools = dict()
+        self._rejected = False
+
+    def stream(self, kind, count):
+        """ Yield count items of kind (one of KINDS) """
+        make = getattr(self, kind)
+        pool = self._pools.setdefault(kind, list())
+        for _ in range(count):
+            if pool and self.random.random() < self.repeat_share:
+                # paretovariate gives a long tail, most repeats hit the first few items
+                index = int(self.random.paretovariate(1.2)) - 1
+                yield pool[min(index, len(pool) - 1)]
+                continue
+            self._rejected = False
+            item = make()
+            # Rejected input tends to get fixed rather than resent, keep it out of the repeats
+            if len(pool) < self.pool_size and not self._rejected:
+                pool.append(item)
+            yield item
+
+    def _invalid(self):
+        self._rejected = self.random.random() < self.invalid_rate
+        return self._rejected
+
+    def _city(self):
+        return self.random.choice(CITIES)
+
+    def _street(self):
+        direction = self.random.choice(DIRECTIONS)
+        parts = [str(self.random.randint(1, 9999))]
+        if direction:
+            parts.append(direction)
+        parts.append(self.random.choice(STREETS))
+        parts.append(self.random.choice(SUFFIX_SPELLINGS).title())
+        line = ' '.join(parts)
+        return line.upper() if self.random.random() < 0.3 else line
+
+    def _zip(self):
+        return self._city()[2]
+
+    def address(self):
+        city, state, zip5 = self._city()
+        address = {'Address1': '', 'Address2': self._street(), 'City': city, 'State': state,
+                   'Zip5': zip5 if self.random.random() < 0.8 else '', 'Zip4': ''}
+        if self.random.random() < 0.25:
+            address['Address1'] = '%s %d' % (self.random.choice(UNIT_SPELLINGS).title(), self.random.randint(1, 400))
+        if self.random.random() < 0.1:
+            address['FirmName'] = self.random.choice(FIRMS)
+        if self._invalid():
+            address['Address2'] = ''
+        return address
+
+    def domestic_package(self):
+        service = self.random.choice(DOMESTIC_SERVICES)
+        package = {'Service': service, 'ZipOrigination': self._zip(), 'ZipDestination': self._zip(),
+                   'Pounds': self.random.randint(0, 20), 'Ounces': round(self.random.uniform(0, 15.9), 1),
+                   'Container': self.random.choice(CONTAINER), 'Machinable': self.random.random() < 0.8}
+        if service == 'FIRST CLASS':
+            package['FirstClassMailType'] = self.random.choice(FIRST_CLASS_MAIL_TYPE)
+            package['Pounds'] = 0
+        if package['Container'] in ('RECTANGULAR', 'NONRECTANGULAR', 'VARIABLE'):
+            package.update(Width=self.random.randint(1, 24), Length=self.random.randint(1, 36),
+                           Height=self.random.randint(1, 24))
+        if self.random.random() < 0.2:
+            package['Value'] = round(self.random.uniform(5, 500), 2)
+            package['SpecialServices'] = [{'SpecialService': service_id}
+                                          for service_id in self.random.sample(SPECIAL_SERVICE, 2)]
+        return package
+
+    def intl_package(self):
+        package = {'Pounds': self.random.randint(0, 20), 'Ounces': round(self.random.uniform(0, 15.9), 1),
+                   'MailType': self.random.choice(INTL_MAIL_TYPES),
+                   'ValueOfContents': round(self.random.uniform(5, 1000), 2),
+                   'Country': self.random.choice(COUNTRIES), 'Container': self.random.choice(CONTAINER),
+                   'OriginZip': self._zip()}
+        if package['Container'] in ('RECTANGULAR', 'NONRECTANGULAR'):
+            package.update(Width=self.random.randint(1, 24), Length=self.random.randint(1, 36),
+                           Height=self.random.randint(1, 24))
+        return package
+
+    def tracking_id(self):
+        if self._invalid():
+            return '0%021d' % self.random.randrange(10 ** 21)
+        return '94%020d' % self.random.randrange(10 ** 20)
+
+    def _pickup_location(self):
+        city, state, zip5 = self._city()
+        return {'FirmName': self.random.choice(FIRMS), 'SuiteOrApt': '', 'Address2': self._street(),
+                'Urbanization': '', 'City': city, 'State': state, 'ZIP5': zip5, 'ZIP4': ''}
+
+    def _pickup_date(self):
+        return (datetime.date(2030, 1, 7) + datetime.timedelta(days=self.random.randint(0, 30))).isoformat()
+
+    def pickup_availability(self):
+        location = self._pickup_location()
+        location['Date'] = self._pickup_date()
+        return location
+
+    def pickup_schedule(self):
+        request = self._pickup_location()
+        request.update({'FirstName': 'Pat', 'LastName': 'Jones', 'Phone': '5555551234', 'Extension': '',
+                        'EstimatedWeight': str(self.random.randint(1, 60)), 'PackageLocation': 'Front Door',
+                        'SpecialInstructions': '', 'EmailAddress': 'shipping@example.com'})
+        request['Package'] = [{'ServiceType': service_type, 'Count': str(self.random.randint(1, 5))}
+                              for service_type in self.random.sample(CARRIER_PICKUP_SCHEDULE_REQUEST_SERVICE_TYPE, 2)]
+        return request
+
+    def pickup_change(self):
+        request = self.pickup_schedule()
+        request['ConfirmationNumber'] = 'WTC%09d' % self.random.randrange(10 ** 9)
+        return request
+
+    def pickup_cancel(self):
+        request = self._pickup_location()
+        request['ConfirmationNumber'] = 'WTC%09d' % self.random.randrange(10 ** 9)
+        return request
+
+    def mail_service(self):
+        return {'OriginZip': self._zip(), 'DestinationZip': self._zip(), 'DestinationType': '1'}
+
+    def service_delivery(self):
+        return {'MailClass': str(self.random.randint(0, 6)), 'OriginZIP': self._zip(),
+                'DestinationZIP': self._zip(), 'AcceptDate': self._pickup_date()}